@@ -3,6 +3,28 @@ from pyswip import Prolog
 from pathlib import Path
 import re
 
+from walle.OurOriginal.PrologBatchCheck import StepBatchChecker, prolog_string
+from walle.OurOriginal.PrologRuleBase import declare_schema
+
+# ルール文字列を1回だけパースして rule_applies/2 の節にする
+# (本体のない action_failed(H). は常に成り立つ rule_applies(Id, H) になる)
+# (action_failed 以外の節はルールから呼ばれる補助述語としてそのままassertする)
+RULE_COMPILE_QUERY = (
+    "term_string(T, {rule}), "
+    "( T = (action_failed(H) :- B) -> assertz((rule_applies({id}, H) :- B)), assertz(rule_id({id})) "
+    "; T = action_failed(H) -> assertz(rule_applies({id}, H)), assertz(rule_id({id})) "
+    "; assertz(T) )"
+)
+
+# ステップの action/1 とルールのヘッドを単一化し、条件が満たされるルール番号を1回の呼び出しで集める
+# (未定義述語のエラーは条件不成立、それ以外のエラーは表示して条件不成立とする)
+STEP_QUERY = (
+    "action(A), A =.. [Name|Args], "
+    "findall(I, (rule_id(I), "
+    "catch(catch(once(rule_applies(I, A)), error(existence_error(_, _), _), fail), "
+    "E, (print_message(error, E), fail))), Applied)"
+)
+
 class PrologRuleProbabilityCalculator:
     def __init__(self, json_file, fact_folder, rules_file):
         """
@@ -15,6 +37,12 @@ class PrologRuleProbabilityCalculator:
         self.fact_folder = fact_folder
         self.rules_file = rules_file
         
+        # ルールとステップのファクトを読み込むProlog
+        self.prolog = Prolog()
+        declare_schema(self.prolog)
+        list(self.prolog.query("dynamic(rule_applies/2), dynamic(rule_id/1)"))
+        self.checker = StepBatchChecker(self.prolog)
+        
         # fact_*.plファイルを自動的に検索
         self.fact_files = self._load_fact_files()
     
@@ -55,156 +83,54 @@ class PrologRuleProbabilityCalculator:
                 rules.append(line)
         return rules
     
-    def extract_action_info(self, fact_file):
+    def compile_rules(self, rules):
         """
-        factファイルからaction述語の情報を抽出
+        ルールを1回だけパースし、rule_applies(ルール番号, 行動) の節としてassertする
+        例: action_failed(take(I, L)) :- Body.  ->  rule_applies(3, take(I, L)) :- Body.
+        ヘッドの変数はステップの action/1 との単一化で束縛されるので、文字列の置換は行わない
         Returns:
-            dict: {'action_name': str, 'args': [arg1, arg2, ...]} or None
+            list: assertできたルールの番号
         """
-        try:
-            prolog = Prolog()
-            prolog.consult(fact_file)
-            
-            # action述語を取得
-            result = list(prolog.query("action(Action)"))
-            del prolog
-            
-            if result:
-                action_term = str(result[0]['Action'])
-                # 例: "take(egg_3, fridge_1)" -> action_name='take', args=['egg_3', 'fridge_1']
-                match = re.match(r'(\w+)\((.+)\)', action_term)
-                if match:
-                    action_name = match.group(1)
-                    args_str = match.group(2)
-                    # 引数をカンマで分割（ネストした括弧も考慮）
-                    args = [arg.strip() for arg in args_str.split(',')]
-                    return {
-                        'action_name': action_name,
-                        'args': args
-                    }
-            return None
-        except Exception as e:
-            print(f"    action抽出エラー: {e}")
-            return None
+        list(self.prolog.query("retractall(rule_applies(_, _)), retractall(rule_id(_))"))
+        compiled = []
+        for i, rule in enumerate(rules):
+            try:
+                list(self.prolog.query(RULE_COMPILE_QUERY.format(
+                    rule=prolog_string(rule.strip().rstrip('.')), id=i)))
+                compiled.append(i)
+            except Exception as e:
+                print(f"    ルールのパースエラー: {rule[:70]}... ({str(e)[:100]})")
+        print(f"{len(compiled)}/{len(rules)}個のルールをコンパイルしました")
+        return compiled
     
-    def extract_variables_from_rule_head(self, head):
-        """
-        ルールのヘッドから変数名とその位置を抽出
-        例: action_failed(take(Item, Location)) -> ['Item', 'Location']
-        例: action_failed(goto(Target)) -> ['Target']
+    def check_step(self, fact_file):
         """
-        # action_failed(action_name(vars...)) のパターンをマッチ
-        match = re.search(r'action_failed\(\w+\(([^)]+)\)\)', head)
-        if match:
-            vars_str = match.group(1)
-            # カンマで分割して変数名を抽出
-            variables = [var.strip() for var in vars_str.split(',')]
-            return variables
-        return []
-    
-    def bind_variables_in_body(self, rule_body, variables, values):
-        """
-        ルールの条件部分の変数を実際の値でバインド
-        Args:
-            rule_body: ルールの条件部分
-            variables: 変数名のリスト ['Item', 'Location']
-            values: 実際の値のリスト ['egg_3', 'fridge_1']
-        Returns:
-            str: 変数が置換された条件文
-        """
-        bound_body = rule_body
-        
-        # 各変数を対応する値で置換
-        for var, val in zip(variables, values):
-            # 変数全体を置換（部分一致を避けるため\bを使用）
-            bound_body = re.sub(r'\b' + var + r'\b', val, bound_body)
-        
-        return bound_body
-    
-    def check_rule_applies_with_bindings(self, fact_file, rule, action_info):
-        """
-        ルールの条件部分が満たされるかチェック（複数変数のバインディングを考慮）
+        ステップのファクトを読み込んだ状態で、条件が満たされるルールをまとめて求める
         Args:
             fact_file: factファイルのパス
-            rule: 完全なルール文字列
-            action_info: extractで取得したアクション情報
         Returns:
-            bool: 条件が満たされる場合True
+            (action_info, applied)
+            action_info: {'action_name': str, 'args': [arg1, arg2, ...]} or None
+            applied: 条件が満たされたルール番号の集合
         """
+        with open(fact_file, 'r', encoding='utf-8') as f:
+            facts = f.read()
+        self.checker.load_facts(facts)
         try:
-            # ルールからヘッドと条件を分離
-            if ':-' not in rule:
-                return False
-            
-            head, body = rule.split(':-', 1)
-            head = head.strip()
-            body = body.strip().rstrip('.')
-            
-            # ヘッドから変数名を抽出
-            variables = self.extract_variables_from_rule_head(head)
-            
-            if not variables:
-                # 変数がない場合は通常の方法でチェック
-                return self.check_rule_applies_simple(fact_file, body)
-            
-            # アクション情報から値を取得
-            if not action_info or 'args' not in action_info:
-                return False
-            
-            values = action_info['args']
-            
-            # 変数の数と値の数が一致するか確認
-            if len(variables) != len(values):
-                print(f"    警告: 変数数({len(variables)})と引数数({len(values)})が一致しません")
-                return False
-            
-            # 新しいPrologインスタンスを作成
-            prolog = Prolog()
-            prolog.consult(fact_file)
-            
-            # 変数を実際の値でバインド
-            bound_body = self.bind_variables_in_body(body, variables, values)
-            
-            # デバッグ出力
-            # print(f"    元の条件: {body}")
-            # print(f"    バインド後: {bound_body}")
-            
-            # クエリを実行
-            query = f"({bound_body})"
-            result = list(prolog.query(query))
-            
-            del prolog
-            return len(result) > 0
-                
+            solution = next(iter(self.prolog.query(STEP_QUERY, maxresult=1)), None)
         except Exception as e:
-            if "existence_error" in str(e):
-                return False
             print(f"    クエリエラー: {str(e)[:150]}")
-            return False
-    
-    def check_rule_applies_simple(self, fact_file, rule_body):
-        """
-        変数バインディングが不要な単純なルールチェック
-        Args:
-            fact_file: factファイルのパス
-            rule_body: ルールの条件部分（:- 以降）
-        Returns:
-            bool: 条件が満たされる場合True
-        """
-        try:
-            prolog = Prolog()
-            prolog.consult(fact_file)
-            
-            query = f"({rule_body})"
-            result = list(prolog.query(query))
-            
-            del prolog
-            return len(result) > 0
-        except Exception as e:
-            if "existence_error" in str(e):
-                return False
-            print(f"    クエリエラー: {str(e)[:100]}")
-            return False
+            solution = None
+        finally:
+            self.checker.clear()
+        
+        if solution is None:
+            return None, set()
+        action_info = {
+            'action_name': str(solution['Name']),
+            'args': [str(arg) for arg in solution['Args']]
+        }
+        return action_info, {int(i) for i in solution['Applied']}
     
     def extract_action_from_rule(self, rule):
         """
@@ -221,8 +147,9 @@ class PrologRuleProbabilityCalculator:
         # JSONデータを読み込む
         data = self.load_json_data()
         
-        # ルールを読み込む
+        # ルールを読み込み、コンパイル済みの節としてassertする
         rules = self.load_rules()
+        self.compile_rules(rules)
         
         # 各ルールの統計を収集
         rule_stats = {}
@@ -257,8 +184,8 @@ class PrologRuleProbabilityCalculator:
                 action_data = step_data.get('action', {})
                 action_name = action_data.get('action_name', '')
                 
-                # factファイルからアクション情報を抽出
-                action_info = self.extract_action_info(fact_file)
+                # factファイルからアクション情報と、条件が満たされるルールを求める
+                action_info, applied = self.check_step(fact_file)
                 
                 print(f" - アクション: {action_name}", end="")
                 if action_info and action_info.get('args'):
@@ -266,14 +193,14 @@ class PrologRuleProbabilityCalculator:
                 print(f", Success: {success}")
                 
                 # 各ルールをチェック
-                for rule in rules:
+                for i, rule in enumerate(rules):
                     # このルールが対象とするアクションと一致するか確認
                     rule_action = self.extract_action_from_rule(rule)
                     if rule_action and rule_action != action_name:
                         continue
                     
-                    # ルールの条件が満たされるかチェック（変数バインディング考慮）
-                    applies = self.check_rule_applies_with_bindings(fact_file, rule, action_info)
+                    # ヘッドの変数は action/1 との単一化で束縛済み
+                    applies = i in applied
                     
                     if applies:
                         print(f"    ✓ ルールが適用: {rule[:70]}...")
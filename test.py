@@ -40,6 +40,11 @@ parser.add_argument('--random_all_groups_n', type=int, help='全グループか
 parser.add_argument('--task', type=str, help='単一タスクID（例: F3）')
 parser.add_argument('--tasks', nargs='+', help='複数タスクID（例: F1 F2 F3）')
 parser.add_argument('--all', action='store_true', help='全タスクを昇順で実行')
+parser.add_argument('--log_level', type=str, default=None, help='ログレベル（例: DEBUG, INFO）。未指定なら環境変数 WALLE_LOG_LEVEL')
+parser.add_argument('--log_jsonl', type=str, default=None, help='JSONLログの出力先（解析用）。未指定なら無効')
+parser.add_argument('--problog_rules', type=str, default=None, help='確率ルールファイル（例: ./probabilistic_rules.pl）。指定するとProbLogでWMを判定し、確信が持てない場合だけLLMに問い合わせる')
+parser.add_argument('--problog_threshold', type=float, default=0.8, help='ProbLog World Modelがローカルで判定する確信度（0.5〜1.0）')
+parser.add_argument('--nsl_full_every', type=int, default=0, help='新しいD_incがなくてもNSLearningの学習全体（マイニング〜ルール選定）を行う間隔（ステップ数）。0なら予測を外したステップだけ')
 
 args = parser.parse_args()
 
@@ -59,6 +64,9 @@ from alfworld.alfworld.agents.environment.alfred_thor_env import AlfredThorEnv
 from utils.state_parser import *
 from utils.trajectory_parser import *
 from utils.make_action_command import *
+from utils.logger import configure_logging, get_logger, LazyJSON
+from utils.prompt_log import PromptLogWriter
+from utils.state_encoder import CompactStateEncoder
 
 from walle.MPC.MPC import *
 from copy import deepcopy
@@ -66,6 +74,10 @@ from copy import deepcopy
 from walle.NSLearning.new_nslearning import *
 
 from walle.MPC.new_scene_graph import SceneGraph
+from walle.MPC.problog_world_model import ProbLogWorldModel
+
+configure_logging(args.log_level, args.log_jsonl)
+logger = get_logger("driver")
 
 # OpenAI APIキーの設定 (環境変数から取得することを推奨)
 try:
@@ -87,8 +99,13 @@ else:
     print("OpenAI API Key is set. Running MPC with LLMAgent and LLMWorldModel...")
 
     # エージェントとワールドモデルのインスタンス化
-    agent = LLMAgent(model="gpt-4.1")
-    world_model = LLMWorldModel(model="gpt-4.1")
+    # 観測 JSON は minify + relevance filter をかけて埋め込む (トークン削減)
+    state_encoder = CompactStateEncoder()
+    agent = LLMAgent(model="gpt-4.1", state_encoder=state_encoder)
+    world_model = LLMWorldModel(model="gpt-4.1", state_encoder=state_encoder)
+    if args.problog_rules:
+        # 確率ルールで判定できる場合は LLM を呼ばない
+        world_model = ProbLogWorldModel(args.problog_rules, fallback=world_model, threshold=args.problog_threshold)
 
     # === 実行タスク選択ロジック ===
     selected_tasks = []
@@ -187,7 +204,7 @@ else:
         # 初期観測値(テキスト)からJSON形式に変換
         #######################################
         obs_state = parse_initial_observation(obs_text)
-        print(json.dumps(obs_state, indent=4))
+        logger.debug("%s", LazyJSON(obs_state))
         #######################################
 
         # ======================================================================================================================
@@ -209,7 +226,7 @@ else:
             
         while not done_flag and t_index < 30:
             print(f"\n--- Running MPC for Step {t_index} ---")
-            print(Rcode_t)
+            logger.debug("%s", Rcode_t)
             # ===============================================================================================
             # MPCを実行し、計画されたアクションと予測された次の状態(Ot+1)を取得.
             current_planned_action = MPC(obs_state, Rcode_t, agent, world_model, t_index, task_outdir, 3, task_name, sg)
@@ -230,8 +247,7 @@ else:
             # 行動後観測値(Ot+1)からJSON形式に変換
             obs_next_text = obs[0]
             obs_next_state = get_updated_state_from_observation(obs_state, obs_next_text)
-            print(f"{action_command} 実行後の観測値:")
-            print(json.dumps(obs_next_state, indent=4, ensure_ascii=False))
+            logger.debug("%s 実行後の観測値:\n%s", action_command, LazyJSON(obs_next_state))
             # ===============================================================================================
 
             # もし、action_command =「goto」だった場合の追加処理(lookコマンド)
@@ -271,7 +287,8 @@ else:
     
             # コードルールの箇所 ================================================================================
             
-            code_rule = New_NSLearning(real_trajectory, predicted_trajectory, scene_graph, task_outdir, task_name)
+            code_rule = New_NSLearning(real_trajectory, predicted_trajectory, scene_graph, task_outdir, task_name,
+                                       full_every=args.nsl_full_every)
             print("剪定されたコードルールの確認:")
             print(code_rule)
             # Rcode_t = code_rule
@@ -280,5 +297,16 @@ else:
         
             obs_state = obs_next_state        
             t_index += 1
+
+        # エピソード終了: プロンプトログのキューを書き切る
+        PromptLogWriter.close_all()
     
+    # プロンプトキャッシュ計測モード (WALLE_MEASURE_PROMPT_CACHE=1) の集計
+    for meter in (agent.cache_meter, world_model.cache_meter):
+        if meter.enabled:
+            logger.info("[PromptCache] %s", meter.summary())
+    logger.info("[CompactStateEncoder] %s", state_encoder.summary())
+    if isinstance(world_model, ProbLogWorldModel):
+        logger.info("[ProbLogWorldModel] %s", world_model.summary())
+
     print("\n✅ 全タスクの実行が完了しました！")
\ No newline at end of file
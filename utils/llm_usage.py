@@ -0,0 +1,93 @@
+"""
+LLM 呼び出しの usage (プロンプトキャッシュのヒット量) を計測するユーティリティ。
+
+OpenAI のプロンプトキャッシュは、プロンプト先頭の一致部分 (1024 トークン以上) に対して自動で効く。
+計測モードを有効にすると、各呼び出しの prompt_tokens / cached_tokens / レイテンシを記録し、
+ログとサマリで報告する。
+
+有効化: PromptCacheMeter(enabled=True) を渡すか、環境変数 WALLE_MEASURE_PROMPT_CACHE=1。
+"""
+import os
+import time
+from typing import Dict, List, Optional
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def measure_prompt_cache_from_env() -> bool:
+    return os.getenv("WALLE_MEASURE_PROMPT_CACHE", "").lower() in ("1", "true", "yes")
+
+
+def extract_cached_tokens(usage) -> int:
+    """usage.prompt_tokens_details.cached_tokens を取り出す (未対応のモデル・SDK では 0)。"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is None:
+        return 0
+    if isinstance(details, dict):
+        return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", 0) or 0
+
+
+class PromptCacheMeter:
+    """
+    呼び出し元 (LLMAgent / LLMWorldModel など) ごとに 1 つ持たせる計測器。
+    """
+
+    def __init__(self, name: str, enabled: Optional[bool] = None):
+        self.name = name
+        self.enabled = measure_prompt_cache_from_env() if enabled is None else enabled
+        self.records: List[Dict] = []
+
+    def start(self) -> float:
+        return time.perf_counter()
+
+    def record(self, response, started: float) -> None:
+        """chat.completions.create のレスポンスから usage を記録する。"""
+        if not self.enabled:
+            return
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        cached_tokens = extract_cached_tokens(usage)
+        record = {
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+            "latency_sec": time.perf_counter() - started,
+        }
+        self.records.append(record)
+
+        hit_rate = cached_tokens / prompt_tokens if prompt_tokens else 0.0
+        logger.info(
+            "[%s] prompt_tokens=%d cached_tokens=%d (%.1f%%) latency=%.2fs",
+            self.name, prompt_tokens, cached_tokens, hit_rate * 100, record["latency_sec"],
+        )
+
+    def summary(self) -> Dict:
+        """これまでの呼び出しの合計と平均を返す。"""
+        calls = len(self.records)
+        prompt_tokens = sum(r["prompt_tokens"] for r in self.records)
+        cached_tokens = sum(r["cached_tokens"] for r in self.records)
+        latency = sum(r["latency_sec"] for r in self.records)
+        return {
+            "name": self.name,
+            "calls": calls,
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "cache_hit_rate": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+            "mean_latency_sec": latency / calls if calls else 0.0,
+        }
+
+
+def prompt_cache_kwargs(prompt_cache_key: Optional[str]) -> Dict:
+    """
+    chat.completions.create に渡す追加引数。prompt_cache_key を指定すると、
+    同じ静的プレフィックスを持つリクエストが同じキャッシュに振り分けられやすくなる。
+    """
+    if not prompt_cache_key:
+        return {}
+    return {"extra_body": {"prompt_cache_key": prompt_cache_key}}
@@ -0,0 +1,157 @@
+"""
+WALL-E 全体で使うロギングユーティリティ。
+
+- レベル制御: WALLE_LOG_LEVEL (DEBUG / INFO / WARNING ...) で出力量を切り替える。
+- 遅延フォーマット: LazyJSON で包んだオブジェクトは、そのレベルが有効な場合にだけ json.dumps される。
+- JSONL シンク: WALLE_LOG_JSONL にパスを指定すると、全レコードを 1 行 1 JSON で追記する(機械解析用)。
+
+使用例:
+    logger = get_logger(__name__)
+    logger.debug("=== current_observation_state ===\n%s", LazyJSON(state))
+"""
+import json
+import logging
+import os
+import sys
+from typing import Any, Optional
+
+ROOT_LOGGER_NAME = "walle"
+
+_configured = False
+
+
+class LazyJSON:
+    """
+    ログが実際に出力されるときにだけシリアライズされる JSON ラッパー。
+    logging の %s 引数として渡すこと (f-string で先に展開しないこと)。
+    """
+    __slots__ = ("obj", "indent")
+
+    def __init__(self, obj: Any, indent: Optional[int] = 4):
+        self.obj = obj
+        self.indent = indent
+
+    def __str__(self) -> str:
+        return json.dumps(self.obj, indent=self.indent, ensure_ascii=False, default=str)
+
+
+class _DataPlaceholder:
+    """JSONL 出力時に、メッセージ中の LazyJSON を data フィールドへの参照に置き換える。"""
+    __slots__ = ("index",)
+
+    def __init__(self, index: int):
+        self.index = index
+
+    def __str__(self) -> str:
+        return f"<data[{self.index}]>"
+
+
+class JSONLHandler(logging.Handler):
+    """
+    ログレコードを JSON Lines 形式でファイルに追記するハンドラ。
+    LazyJSON 引数は文字列化せず、元のオブジェクトのまま "data" に格納する。
+    """
+
+    def __init__(self, path: str, level: int = logging.DEBUG):
+        super().__init__(level)
+        dir_name = os.path.dirname(path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        self.path = path
+        self.stream = open(path, "a", encoding="utf-8")
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            data = []
+            message = record.msg
+            if record.args and isinstance(record.args, tuple):
+                args = []
+                for arg in record.args:
+                    if isinstance(arg, LazyJSON):
+                        args.append(_DataPlaceholder(len(data)))
+                        data.append(arg.obj)
+                    else:
+                        args.append(arg)
+                try:
+                    message = str(record.msg) % tuple(args)
+                except (TypeError, ValueError):
+                    message = record.getMessage()
+            else:
+                message = record.getMessage()
+
+            payload = {
+                "time": record.created,
+                "level": record.levelname,
+                "logger": record.name,
+                "message": message,
+            }
+            if data:
+                payload["data"] = data
+            self.stream.write(json.dumps(payload, ensure_ascii=False, default=str) + "\n")
+            self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+    def close(self) -> None:
+        try:
+            self.stream.close()
+        finally:
+            super().close()
+
+
+def _to_level(level) -> int:
+    if level is None:
+        return logging.INFO
+    if isinstance(level, int):
+        return level
+    value = logging.getLevelName(str(level).upper())
+    return value if isinstance(value, int) else logging.INFO
+
+
+def configure_logging(level=None, jsonl_path: Optional[str] = None, jsonl_level=logging.DEBUG) -> logging.Logger:
+    """
+    walle ロガーを初期化する。複数回呼ぶと設定を上書きする。
+
+    Args:
+        level: コンソール出力のレベル。None の場合は環境変数 WALLE_LOG_LEVEL (既定 INFO)。
+        jsonl_path: JSONL シンクの出力先。None の場合は環境変数 WALLE_LOG_JSONL (未設定なら無効)。
+        jsonl_level: JSONL シンクのレベル。
+    """
+    global _configured
+
+    console_level = _to_level(level if level is not None else os.getenv("WALLE_LOG_LEVEL"))
+    jsonl_path = jsonl_path if jsonl_path is not None else os.getenv("WALLE_LOG_JSONL")
+    jsonl_level = _to_level(jsonl_level)
+
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setLevel(console_level)
+    console.setFormatter(logging.Formatter("%(message)s"))
+    root.addHandler(console)
+
+    effective_level = console_level
+    if jsonl_path:
+        root.addHandler(JSONLHandler(jsonl_path, jsonl_level))
+        effective_level = min(console_level, jsonl_level)
+
+    # ロガー自体のレベルを最小値にしておくことで、無効なレベルの呼び出しは isEnabledFor で即座に弾かれる
+    root.setLevel(effective_level)
+    root.propagate = False
+
+    _configured = True
+    return root
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    walle 配下のロガーを取得する。未初期化なら環境変数から初期化する。
+    """
+    if not _configured:
+        configure_logging()
+    if name == ROOT_LOGGER_NAME or name.startswith(ROOT_LOGGER_NAME + "."):
+        return logging.getLogger(name)
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
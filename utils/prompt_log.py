@@ -0,0 +1,205 @@
+"""
+LLM プロンプトログの非同期書き出しユーティリティ。
+
+- system プロンプトは sha256 で重複排除し、system_prompts/<hash>.txt に一度だけ保存する。
+- 呼び出しごとのレコード (system プロンプトはハッシュ参照) は、ディレクトリごとに 1 つの
+  gzip 圧縮 JSONL アーカイブ (prompts.jsonl.gz) に追記する。
+- 書き込みはバックグラウンドスレッドがまとめて行うため、呼び出し側はキューに積むだけで済む。
+
+使用例:
+    writer = PromptLogWriter.for_dir(os.path.join(outdir, "prompt_log"))
+    writer.log("agent", messages, t_index=t_index, replan=replan_count)
+
+    for record in iter_prompt_log(os.path.join(outdir, "prompt_log")):
+        print(render_prompt_text(record))
+"""
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+ARCHIVE_NAME = "prompts.jsonl.gz"
+SYSTEM_PROMPT_DIR = "system_prompts"
+
+_STOP = object()
+
+
+class PromptLogWriter:
+    """
+    ディレクトリ単位のプロンプトログライタ。for_dir() で取得したインスタンスはプロセス内で共有される。
+    """
+    _instances: Dict[str, "PromptLogWriter"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, log_dir: str, flush_interval: float = 1.0, batch_size: int = 64):
+        self.log_dir = log_dir
+        self.archive_path = os.path.join(log_dir, ARCHIVE_NAME)
+        self.system_dir = os.path.join(log_dir, SYSTEM_PROMPT_DIR)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        os.makedirs(self.system_dir, exist_ok=True)
+        self._known_hashes = {name[:-4] for name in os.listdir(self.system_dir) if name.endswith(".txt")}
+
+        self._queue: "queue.Queue" = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f"PromptLogWriter({log_dir})", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def for_dir(cls, log_dir: str) -> "PromptLogWriter":
+        """log_dir 用のライタを取得する (なければ作成)。"""
+        key = os.path.abspath(log_dir)
+        with cls._instances_lock:
+            writer = cls._instances.get(key)
+            if writer is None or writer._closed:
+                writer = cls(log_dir)
+                cls._instances[key] = writer
+            return writer
+
+    @classmethod
+    def close_all(cls) -> None:
+        """全ライタのキューを書き切って閉じる (エピソード終了時・プロセス終了時に呼ぶ)。"""
+        with cls._instances_lock:
+            writers = list(cls._instances.values())
+            cls._instances.clear()
+        for writer in writers:
+            writer.close()
+
+    # ------------------------------------------------------------------
+
+    def log(self, kind: str, messages: List[Dict[str, str]], **meta) -> None:
+        """
+        1 回分の LLM 呼び出しのメッセージを記録する。ディスク I/O は行わずキューに積むだけ。
+
+        Args:
+            kind: レコードの種別 (例: "agent", "wm", "verify_code_rule")
+            messages: chat.completions に渡したメッセージのリスト
+            **meta: t_index や replan などの付加情報
+        """
+        if self._closed:
+            raise RuntimeError(f"PromptLogWriter for {self.log_dir} is already closed.")
+        self._queue.put((time.time(), kind, messages, meta))
+
+    def flush(self) -> None:
+        """キューに積まれたレコードがすべて書き出されるまで待つ。"""
+        self._queue.join()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    # ------------------------------------------------------------------
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            batch = []
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            deadline = time.time() + self.flush_interval
+            while True:
+                if item is _STOP:
+                    stop = True
+                    self._queue.task_done()
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    print(f"[PromptLogWriter] Failed to write prompt log to {self.archive_path}: {e}")
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+
+    def _store_system_prompt(self, content: str) -> str:
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        if digest not in self._known_hashes:
+            path = os.path.join(self.system_dir, f"{digest}.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(content)
+            self._known_hashes.add(digest)
+        return digest
+
+    def _write_batch(self, batch) -> None:
+        lines = []
+        for created, kind, messages, meta in batch:
+            record = {"time": created, "kind": kind}
+            record.update(meta)
+            system_hashes = []
+            other_messages = []
+            for msg in messages:
+                if msg.get("role") == "system":
+                    system_hashes.append(self._store_system_prompt(msg.get("content", "")))
+                else:
+                    other_messages.append(msg)
+            record["system"] = system_hashes
+            record["messages"] = other_messages
+            lines.append(json.dumps(record, ensure_ascii=False, default=str))
+
+        # バッチごとに gzip メンバーとして追記する (途中で落ちても既存メンバーは読める)
+        with gzip.open(self.archive_path, "at", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+atexit.register(PromptLogWriter.close_all)
+
+
+def iter_prompt_log(log_dir: str, kind: Optional[str] = None) -> Iterator[Dict]:
+    """
+    アーカイブを読み出し、system プロンプトを復元したレコードを順に返す。
+    """
+    archive_path = os.path.join(log_dir, ARCHIVE_NAME)
+    system_dir = os.path.join(log_dir, SYSTEM_PROMPT_DIR)
+    if not os.path.exists(archive_path):
+        return
+
+    system_cache: Dict[str, str] = {}
+    with gzip.open(archive_path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if kind is not None and record.get("kind") != kind:
+                continue
+            system_messages = []
+            for digest in record.get("system", []):
+                if digest not in system_cache:
+                    with open(os.path.join(system_dir, f"{digest}.txt"), "r", encoding="utf-8") as sf:
+                        system_cache[digest] = sf.read()
+                system_messages.append({"role": "system", "content": system_cache[digest]})
+            record["messages"] = system_messages + record.get("messages", [])
+            yield record
+
+
+def render_prompt_text(record: Dict) -> str:
+    """
+    レコードを、従来の *_prompt_*.txt と同じテキスト形式に整形する。
+    """
+    log_text = ""
+    for msg in record.get("messages", []):
+        if msg["role"] == "system":
+            log_text += "--- System Prompt ---\n"
+        else:
+            log_text += f"--- {msg['role'].capitalize()} ---\n"
+        log_text += msg["content"] + "\n\n"
+    return log_text
@@ -0,0 +1,217 @@
+"""
+LLM プロンプトに埋め込む状態 JSON をコンパクトにするエンコーダ。
+
+- minify: インデント・空白なしで出力する。
+- relevance filter: タスク文・提案行動・現在位置・手持ちアイテムに関係する場所/アイテムだけを詳細に残し、
+  それ以外の訪問済みの場所は {"status": 開閉状態, "items": [関係するアイテムのみ], "items_omitted": 省いた数} に
+  縮約する (訪問済みであることと開閉状態は残し、アイテムを省いたことが分かるようにする)。
+  提案行動に関係する場所の詳細は action_details() で別に取り出せるので、観測を行動に依存させずに済む。
+- delta: 前ステップの状態との差分だけを出力する (前の状態を文脈に持っている呼び出し向け)。
+
+使用例:
+    encoder = CompactStateEncoder()
+    obs_json = encoder.encode(obs_state, task=task_name)
+    print(encoder.summary())
+"""
+import json
+import re
+from typing import Any, Dict, List, Optional, Set
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _ENCODING = None
+
+
+def count_tokens(text: str) -> int:
+    """トークン数を数える。tiktoken がなければ 4 文字 = 1 トークンで近似する。"""
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    return (len(text) + 3) // 4
+
+
+def dumps_compact(data: Any) -> str:
+    """空白なしの JSON 文字列 (ensure_ascii=False)。"""
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def base_name(name: Optional[str]) -> str:
+    """'desklamp 1' -> 'desklamp' のように末尾の番号を取り除く。"""
+    if not name:
+        return ""
+    return re.sub(r"\s+\d+$", "", str(name).strip().lower())
+
+
+def _words(text: str) -> Set[str]:
+    return set(re.findall(r"[a-z]+", (text or "").lower()))
+
+
+def state_delta(previous: Dict, current: Dict) -> Dict:
+    """
+    2 つの状態の差分を返す。
+    戻り値: {"changed": {"a.b.c": value, ...}, "removed": ["a.b", ...]}
+    (リストは要素ごとではなく丸ごと比較する)
+    """
+    changed: Dict[str, Any] = {}
+    removed: List[str] = []
+
+    def walk(prev, curr, path):
+        if isinstance(prev, dict) and isinstance(curr, dict):
+            for key, value in curr.items():
+                sub = f"{path}.{key}" if path else key
+                if key not in prev:
+                    changed[sub] = value
+                else:
+                    walk(prev[key], value, sub)
+            for key in prev:
+                if key not in curr:
+                    removed.append(f"{path}.{key}" if path else key)
+        elif prev != curr:
+            changed[path] = curr
+
+    walk(previous or {}, current or {}, "")
+    return {"changed": changed, "removed": removed}
+
+
+class CompactStateEncoder:
+    """
+    状態 JSON のエンコーダ。呼び出しごとに元の pretty-print と比べたトークン削減量を集計する。
+    """
+
+    def __init__(self, minify: bool = True, relevance_filter: bool = True, delta: bool = False, measure: bool = True):
+        """
+        measure: False にすると削減量の集計 (元の pretty-print との比較) を行わない
+        """
+        self.minify = minify
+        self.relevance_filter = relevance_filter
+        self.delta = delta
+        self.measure = measure
+        self.calls = 0
+        self.original_tokens = 0
+        self.encoded_tokens = 0
+
+    def prompt_note(self, task: bool = True) -> str:
+        """
+        エンコード方式をプロンプトで説明する一文 (設定ごとに不変なので静的プレフィックスに置ける)。
+        task: encode() にタスク文を渡すか (False ならゴールに関係するかどうかには触れない)
+        """
+        notes = []
+        if self.relevance_filter:
+            related = "the goal, current position or held item" if task else "the current position or held item"
+            notes.append(f"Visited locations unrelated to {related} list only their relevant items; "
+                         "'items_omitted' is the number of other items there that are not shown.")
+        if self.delta:
+            notes.append("When 'delta_from_previous_step' is given, only the fields that changed since the previous step are listed.")
+        return "\n".join(notes)
+
+    # ------------------------------------------------------------------
+
+    def relevant_names(self, state: Dict, task: str = "", action: Optional[Dict] = None) -> Set[str]:
+        """関係する場所/アイテムの「番号を除いた名前」の集合。"""
+        names = set(_words(task))
+        if action:
+            for value in (action.get("args") or {}).values():
+                if value:
+                    names.add(base_name(value))
+        hand = (state.get("item_in_hand") or {}).get("item_name")
+        if hand:
+            names.add(base_name(hand))
+        return names
+
+    def filter_state(self, state: Dict, task: str = "", action: Optional[Dict] = None) -> Dict:
+        """関係しない場所の詳細を落とした状態を返す (元の state は変更しない)。"""
+        items_in_locations = state.get("items_in_locations")
+        if not isinstance(items_in_locations, dict):
+            return state
+
+        names = self.relevant_names(state, task, action)
+        exact = set()
+        if action:
+            exact = {v for v in (action.get("args") or {}).values() if v}
+        current = (state.get("current_position") or {}).get("location_name")
+
+        filtered_locations = {}
+        for loc, info in items_in_locations.items():
+            info = info or {}
+            items = info.get("items") or []
+            if loc == current or loc in exact or base_name(loc) in names:
+                filtered_locations[loc] = info
+                continue
+            relevant_items = [item for item in items if item in exact or base_name(item) in names]
+            # 開閉状態は残し、アイテムを省いたことが分かるように省いた数を付ける (空の場所と区別する)
+            abbreviated = {"status": info.get("status"), "items": relevant_items}
+            if len(items) > len(relevant_items):
+                abbreviated["items_omitted"] = len(items) - len(relevant_items)
+            filtered_locations[loc] = abbreviated
+
+        filtered = dict(state)
+        filtered["items_in_locations"] = filtered_locations
+        return filtered
+
+    def action_details(self, observation: Dict, action: Optional[Dict], task: str = "") -> Dict:
+        """
+        task だけでフィルタすると縮約される場所のうち、提案行動に関係する場所の詳細 ({場所: 情報})。
+        encode(observation, task=task) の観測を行動に依存させず、行動ごとに変わる部分をこちらに分けるために使う。
+        """
+        state = observation.get("state") if isinstance(observation.get("state"), dict) else observation
+        items_in_locations = state.get("items_in_locations")
+        if not self.relevance_filter or not action or not isinstance(items_in_locations, dict):
+            return {}
+        base = self.filter_state(state, task)["items_in_locations"]
+        with_action = self.filter_state(state, task, action)["items_in_locations"]
+        return {loc: info for loc, info in with_action.items() if info != base.get(loc)}
+
+    def _apply_filter(self, observation: Dict, task: str, action: Optional[Dict]) -> Dict:
+        if "state" in observation and isinstance(observation["state"], dict):
+            result = dict(observation)
+            result["state"] = self.filter_state(observation["state"], task, action)
+            return result
+        return self.filter_state(observation, task, action)
+
+    # ------------------------------------------------------------------
+
+    def encode(self, observation: Dict, task: str = "", action: Optional[Dict] = None, previous: Optional[Dict] = None) -> str:
+        """
+        観測 (state を含む辞書、または state そのもの) をプロンプト用の JSON 文字列にする。
+
+        Args:
+            task: タスク文 (relevance filter 用)
+            action: 提案行動 (relevance filter 用)
+            previous: delta=True の場合の前ステップの観測
+        """
+        data = observation
+        if self.relevance_filter:
+            data = self._apply_filter(data, task, action)
+        if self.delta and previous is not None:
+            prev_data = self._apply_filter(previous, task, action) if self.relevance_filter else previous
+            data = {"delta_from_previous_step": state_delta(prev_data, data)}
+
+        encoded = dumps_compact(data) if self.minify else json.dumps(data, indent=4, ensure_ascii=False)
+        if self.measure:
+            self._record(observation, encoded)
+        return encoded
+
+    def _record(self, observation: Dict, encoded: str) -> None:
+        original = json.dumps(observation, indent=4, ensure_ascii=False)
+        original_tokens = count_tokens(original)
+        encoded_tokens = count_tokens(encoded)
+        self.calls += 1
+        self.original_tokens += original_tokens
+        self.encoded_tokens += encoded_tokens
+        logger.debug("[CompactStateEncoder] %d -> %d tokens", original_tokens, encoded_tokens)
+
+    def summary(self) -> Dict:
+        """累計のトークン削減量。"""
+        saved = self.original_tokens - self.encoded_tokens
+        return {
+            "calls": self.calls,
+            "original_tokens": self.original_tokens,
+            "encoded_tokens": self.encoded_tokens,
+            "saved_tokens": saved,
+            "saved_ratio": saved / self.original_tokens if self.original_tokens else 0.0,
+        }
@@ -4,6 +4,8 @@ from typing import Dict, Any
 import openai
 import textwrap
 
+from utils.state_encoder import dumps_compact
+
 client = openai.OpenAI()
 
 def parse_initial_observation(text: str) -> Dict[str, Any]:
@@ -54,7 +56,8 @@ def get_updated_state_from_observation(prev_obs: Dict, next_obs_text: str) -> Di
     generates the next state S_t using an LLM.
     """
 
-    prev_obs_json = json.dumps(prev_obs, indent=4)
+    # 状態更新は全フィールドを返す必要があるので、relevance filter はかけず空白の除去だけ行う
+    prev_obs_json = dumps_compact(prev_obs)
 
     # Construct the prompt
     prompt = textwrap.dedent(f"""
@@ -11,6 +11,12 @@ import argparse
 from typing import List, Callable, Tuple, Dict, Optional
 
 from .new_scene_graph import *
+from utils.logger import get_logger, LazyJSON
+from utils.prompt_log import PromptLogWriter
+from utils.llm_usage import PromptCacheMeter, prompt_cache_kwargs
+from utils.state_encoder import CompactStateEncoder, dumps_compact
+
+logger = get_logger(__name__)
 
 # OpenAI APIキーの設定 (環境変数から取得することを推奨)
 try:
@@ -21,42 +27,14 @@ except Exception as e:
     print("Please ensure your OPENAI_API_KEY environment variable is set correctly.")
     client = None 
 
-class LLMAgent:
-    """
-    OpenAI "gpt-3.5-turbo" を使用するLLMベースのエージェント。
-    観測としてJSON形式の状態と過去のアクションを含む辞書を直接受け取り、行動を生成する。
-    """
-    def __init__(self, model: str = "gpt-3.5-turbo"):
-        self.model = model
-        self.client = client 
-
-        if self.client is None:
-            print("[LLMAgent] Warning: OpenAI client is not initialized. LLM calls will fail.")
-
-    def generate_action(self, observation_data: Dict, feedback: str, suggestion: str, step: int, task: str) -> Dict:
-        """
-        現在の観測データ (state, action, action_result を含む辞書)、
-        フィードバック、提案に基づいて行動を生成する。
-        行動はJSON形式で「action_type」と「object」フィールドを持ち、
-        さらにALFWorld環境用の「command」文字列フィールドも持つことを期待する。
-        step_index: 生成された行動を保存する際のファイル名に含めるためのオプションのインデックス。
-        """
-        if self.client is None:
-            print("[LLMAgent] Error: OpenAI client is not available. Cannot generate action.")
-        
-        # with open("./input/admissible_commands.txt", "r", encoding="utf-8") as f:
-        #    admissible_commands = f.read()
-
-        current_obs_json = json.dumps(observation_data, indent=4, ensure_ascii=False)
-        task_name = task
+# プロンプトキャッシュ ==============================================================================
+# OpenAI のプロンプトキャッシュはプロンプト先頭の一致部分にだけ効く。プロンプトは元から
+# 「不変の system プロンプト → タスク・観測 → フィードバック/提案行動」の順なので、この並びを崩さないこと
+# (観測に提案行動やフィードバックに依存する内容を入れると、再計画のたびにプレフィックスが変わる)。
+# キャッシュのヒット量は PromptCacheMeter で計測する。
 
-        print("=== Feedback ===")
-        print(feedback)
-        print("=== Suggestion ===")
-        print(suggestion)
-            
-        # 英語プロンプト(改良後) ===================================================================
-        system_prompt = textwrap.dedent("""
+# 英語プロンプト(改良後) ===================================================================
+AGENT_SYSTEM_PROMPT = textwrap.dedent("""
 ROLE
 You are WALL-E, a high-level planning agent. Your task is to generate the single, optimal next action to achieve a goal by reasoning backwards from the goal's preconditions.
 
@@ -188,115 +166,9 @@ Example outputs:
 {"action_name": "take", "args": {"obj": "book 1", "recep": "bed 1"}}
 {"action_name": "use", "args": {"tool": "desklamp 1"}}
         """)
-        
-        header = textwrap.dedent(f"""
-GOAL
-Your final objective is to: "{task_name}"
-CURRENT OBSERVATION (o_t)
-This JSON object represents your current perception and memory.
-        """)
-
-        footer = textwrap.dedent(f"""
-FEEDBACK FROM WORLD MODELFeedback on your MOST RECENT proposed action.
-Prioritize this to correct your immediate next step.
-feedback: "{feedback}"
-suggestion: "{suggestion}"
-        """)
-
-        user_prompt = header + current_obs_json + "\n" + footer
-
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-
-        # プロンプトのログ残す用
-        # ========================================================
-        log_text = "--- System Prompt ---\n"
-        log_text += system_prompt + "\n\n"
-        
-        for msg in messages[1:]:
-            log_text += f"--- {msg['role'].capitalize()} ---\n"
-            log_text += msg['content'] + "\n\n"
-        # ========================================================
 
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                response_format={"type": "json_object"},
-                max_tokens=2000,
-                temperature=0.5,
-            )
-
-            content = response.choices[0].message.content
-            print(f"[LLMAgent] Raw response content: {content}")
-            action_data = json.loads(content)
-
-            if action_data:
-                return action_data, log_text
-            else:
-                print(f"[LLMAgent] Warning: Missing 'action_type' in LLM response: {action_data}")
-
-        except openai.APITimeoutError:
-            print("[LLMAgent] API request timed out.")
-          
-        except openai.APIConnectionError as e:
-            print(f"[LLMAgent] API connection error: {e}")
-
-        except openai.RateLimitError:
-            print("[LLMAgent] OpenAI API rate limit exceeded. Waiting 5 seconds...")
-            time.sleep(5)
-            return self.generate_action(observation_data, feedback, suggestion, step, task)
-
-        except openai.APIStatusError as e:
-            print(f"[LLMAgent] OpenAI API status error: {e.status_code} - {e.response}")
-
-        except json.JSONDecodeError:
-            print(f"[LLMAgent] JSON decode error from LLM response: {content}")
-    
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}")
-        
-
-
-class LLMWorldModel:
-    """
-    OpenAI を使用する"gpt-3.5-turbo"LLMベースのWorld Model。
-    現在の観測と提案された行動から、その行動が「成功」するか「失敗」するかを予測する。
-    """
-    def __init__(self, model="gpt-3.5-turbo"):
-        self.model = model
-        self.client = client
-
-        if self.client is None:
-            print("[LLMWorldModel] Warning: OpenAI client is not initialized. LLM calls will fail.")
-
-    def predict_transition_outcome(self, current_observation_state, proposed_action):
-        """
-        現在の観測状態と提案された行動に基づいて、その行動が成功するか失敗するかを予測し、
-        失敗の場合はその理由と提案も返す。
-        戻り値: dict 形式
-        {
-        "success": bool,
-        "feedback": str,
-        "suggestion": str
-        }
-        """
-        if self.client is None:
-            print("[LLMWorldModel] Error: OpenAI client is not available. Cannot predict transition outcome.")
-            return {"success": False, "feedback": "OpenAI client not initialized.", "suggestion": "Initialize the client before calling this method."}
-
-        # with open("./input/admissible_commands.txt", "r", encoding="utf-8") as f:
-        #     admissible_commands = f.read()
-
-        current_obs_json = json.dumps(current_observation_state, indent=4, ensure_ascii=False)
-        proposed_action_json = json.dumps(proposed_action, indent=4, ensure_ascii=False)
-
-        # =================================================================================
-
-        # 英語プロンプト(改良後) =================================================================
-        system_prompt = textwrap.dedent("""
+# 英語プロンプト(改良後) =================================================================
+WM_SYSTEM_PROMPT = textwrap.dedent("""
 ROLE
 You are an All-in-One World Model for WALL-E. Your purpose is to act as a strict, procedural referee. You must predict if a proposed action will succeed or fail by meticulously following a step-by-step evaluation process. Your primary function is to enforce deterministic rules.
 
@@ -500,48 +372,222 @@ Example for FAILURE (tool not found):
 }
         """)
 
-        header = textwrap.dedent("""
+WM_OBSERVATION_HEADER = textwrap.dedent("""
 CURRENT OBSERVATION (o_t)
 This JSON object represents the state of the environment.
         """)
 
-        footer = textwrap.dedent("""
+WM_ACTION_HEADER = textwrap.dedent("""
 PROPOSED ACTION (a_t)
 This is the action you must evaluate.
         """)
 
-        user_prompt = header + current_obs_json + "\n" + footer + proposed_action_json
+WM_ACTION_DETAILS_HEADER = textwrap.dedent("""
+LOCATIONS RELATED TO THE PROPOSED ACTION
+Full entries of the locations this action refers to (abbreviated in the observation).
+        """)
+
+
+def build_prompt_messages(system_prompt: str, static_context: str, dynamic_suffix: str) -> List[Dict]:
+    """
+    静的プレフィックス/動的サフィックスの順でメッセージを組み立てる。
+    system_prompt: 全呼び出しで不変 (モジュール定数)
+    static_context: 同じステップの再計画中は不変 (タスク・観測)
+    dynamic_suffix: 呼び出しごとに変わる部分 (フィードバック・提案行動)
+    """
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": static_context + dynamic_suffix}
+    ]
+
+
+class LLMAgent:
+    """
+    OpenAI "gpt-3.5-turbo" を使用するLLMベースのエージェント。
+    観測としてJSON形式の状態と過去のアクションを含む辞書を直接受け取り、行動を生成する。
+    """
+    def __init__(self, model: str = "gpt-3.5-turbo", measure_cache: Optional[bool] = None, prompt_cache_key: Optional[str] = None, state_encoder: Optional[CompactStateEncoder] = None):
+        """
+        measure_cache: True で usage の cached_tokens を計測・報告する (None なら環境変数 WALLE_MEASURE_PROMPT_CACHE)
+        prompt_cache_key: 指定するとリクエストに prompt_cache_key を付け、同じキャッシュに振り分けられやすくする
+        state_encoder: 指定すると観測 JSON をコンパクト化して埋め込む (None なら従来の indent=4)
+        """
+        self.model = model
+        self.client = client 
+        self.cache_meter = PromptCacheMeter("LLMAgent", measure_cache)
+        self.prompt_cache_key = prompt_cache_key
+        self.state_encoder = state_encoder
+
+        if self.client is None:
+            print("[LLMAgent] Warning: OpenAI client is not initialized. LLM calls will fail.")
+
+    def generate_action(self, observation_data: Dict, feedback: str, suggestion: str, step: int, task: str) -> Dict:
+        """
+        現在の観測データ (state, action, action_result を含む辞書)、
+        フィードバック、提案に基づいて行動を生成する。
+        行動はJSON形式で「action_type」と「object」フィールドを持ち、
+        さらにALFWorld環境用の「command」文字列フィールドも持つことを期待する。
+        step_index: 生成された行動を保存する際のファイル名に含めるためのオプションのインデックス。
+        """
+        if self.client is None:
+            print("[LLMAgent] Error: OpenAI client is not available. Cannot generate action.")
+        
+        # with open("./input/admissible_commands.txt", "r", encoding="utf-8") as f:
+        #    admissible_commands = f.read()
+
+        task_name = task
+        if self.state_encoder is not None:
+            current_obs_json = self.state_encoder.encode(observation_data, task=task_name)
+            encoding_note = self.state_encoder.prompt_note()
+        else:
+            current_obs_json = json.dumps(observation_data, indent=4, ensure_ascii=False)
+            encoding_note = ""
+
+        logger.debug("=== Feedback ===\n%s", feedback)
+        logger.debug("=== Suggestion ===\n%s", suggestion)
+            
+        header = textwrap.dedent(f"""
+GOAL
+Your final objective is to: "{task_name}"
+CURRENT OBSERVATION (o_t)
+This JSON object represents your current perception and memory.
+        """)
+        if encoding_note:
+            header += encoding_note + "\n"
+
+        footer = textwrap.dedent(f"""
+FEEDBACK FROM WORLD MODELFeedback on your MOST RECENT proposed action.
+Prioritize this to correct your immediate next step.
+feedback: "{feedback}"
+suggestion: "{suggestion}"
+        """)
+
+        # タスク・観測は同じステップの再計画中は不変なので先に置き、フィードバックは末尾に回す
+        messages = build_prompt_messages(AGENT_SYSTEM_PROMPT, header + current_obs_json + "\n", footer)
 
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
+        try:
+            started = self.cache_meter.start()
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                response_format={"type": "json_object"},
+                max_tokens=2000,
+                temperature=0.5,
+                **prompt_cache_kwargs(self.prompt_cache_key),
+            )
+            self.cache_meter.record(response, started)
+
+            content = response.choices[0].message.content
+            logger.debug("[LLMAgent] Raw response content: %s", content)
+            action_data = json.loads(content)
+
+            if action_data:
+                return action_data, messages
+            else:
+                print(f"[LLMAgent] Warning: Missing 'action_type' in LLM response: {action_data}")
+
+        except openai.APITimeoutError:
+            print("[LLMAgent] API request timed out.")
+          
+        except openai.APIConnectionError as e:
+            print(f"[LLMAgent] API connection error: {e}")
+
+        except openai.RateLimitError:
+            print("[LLMAgent] OpenAI API rate limit exceeded. Waiting 5 seconds...")
+            time.sleep(5)
+            return self.generate_action(observation_data, feedback, suggestion, step, task)
+
+        except openai.APIStatusError as e:
+            print(f"[LLMAgent] OpenAI API status error: {e.status_code} - {e.response}")
+
+        except json.JSONDecodeError:
+            print(f"[LLMAgent] JSON decode error from LLM response: {content}")
+    
+        except Exception as e:
+            print(f"An unexpected error occurred: {e}")
         
-        # 追加の処理:ログ残す用
-        # ========================================================
-        log_text = "--- System Prompt ---\n"
-        log_text += system_prompt + "\n\n"
-        for msg in messages[1:]:
-            log_text += f"--- {msg['role'].capitalize()} ---\n"
-            log_text += msg['content'] + "\n\n"
-        # ========================================================
+
+
+class LLMWorldModel:
+    """
+    OpenAI を使用する"gpt-3.5-turbo"LLMベースのWorld Model。
+    現在の観測と提案された行動から、その行動が「成功」するか「失敗」するかを予測する。
+    """
+    def __init__(self, model="gpt-3.5-turbo", measure_cache: Optional[bool] = None, prompt_cache_key: Optional[str] = None, state_encoder: Optional[CompactStateEncoder] = None):
+        """
+        measure_cache: True で usage の cached_tokens を計測・報告する (None なら環境変数 WALLE_MEASURE_PROMPT_CACHE)
+        prompt_cache_key: 指定するとリクエストに prompt_cache_key を付け、同じキャッシュに振り分けられやすくする
+        state_encoder: 指定すると観測 JSON をコンパクト化して埋め込む (None なら従来の indent=4)
+        """
+        self.model = model
+        self.client = client
+        self.cache_meter = PromptCacheMeter("LLMWorldModel", measure_cache)
+        self.prompt_cache_key = prompt_cache_key
+        self.state_encoder = state_encoder
+
+        if self.client is None:
+            print("[LLMWorldModel] Warning: OpenAI client is not initialized. LLM calls will fail.")
+
+    def predict_transition_outcome(self, current_observation_state, proposed_action):
+        """
+        現在の観測状態と提案された行動に基づいて、その行動が成功するか失敗するかを予測し、
+        失敗の場合はその理由と提案も返す。
+        戻り値: dict 形式
+        {
+        "success": bool,
+        "feedback": str,
+        "suggestion": str
+        }
+        """
+        if self.client is None:
+            print("[LLMWorldModel] Error: OpenAI client is not available. Cannot predict transition outcome.")
+            return {"success": False, "feedback": "OpenAI client not initialized.", "suggestion": "Initialize the client before calling this method."}
+
+        # with open("./input/admissible_commands.txt", "r", encoding="utf-8") as f:
+        #     admissible_commands = f.read()
+
+        if self.state_encoder is not None:
+            # 観測は提案行動に依存させずにフィルタし (再計画中も同じ文字列になる)、
+            # 提案行動に関係する場所の詳細は提案行動と一緒に末尾に置く
+            current_obs_json = self.state_encoder.encode(current_observation_state)
+            proposed_action_json = dumps_compact(proposed_action)
+            action_details = self.state_encoder.action_details(current_observation_state, proposed_action)
+            if action_details:
+                proposed_action_json += "\n" + WM_ACTION_DETAILS_HEADER + dumps_compact(action_details)
+            observation_header = WM_OBSERVATION_HEADER
+            encoding_note = self.state_encoder.prompt_note(task=False)
+            if encoding_note:
+                observation_header += encoding_note + "\n"
+        else:
+            current_obs_json = json.dumps(current_observation_state, indent=4, ensure_ascii=False)
+            proposed_action_json = json.dumps(proposed_action, indent=4, ensure_ascii=False)
+            observation_header = WM_OBSERVATION_HEADER
+
+        # =================================================================================
+
+        # 観測は同じステップの再計画中は不変なので先に置き、提案行動は末尾に回す
+        messages = build_prompt_messages(
+            WM_SYSTEM_PROMPT, observation_header + current_obs_json + "\n" + WM_ACTION_HEADER, proposed_action_json)
         
-        print("使用しているモデルの確認:", self.model)
+        logger.debug("使用しているモデルの確認: %s", self.model)
 
         try:
+            started = self.cache_meter.start()
             response = self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
                 response_format={"type": "json_object"},
                 max_tokens=2000,
                 temperature=0,
+                **prompt_cache_kwargs(self.prompt_cache_key),
             )
+            self.cache_meter.record(response, started)
             
             content = response.choices[0].message.content
-            print(f"[LLMWorldModel] Raw outcome prediction content: {content}")
+            logger.debug("[LLMWorldModel] Raw outcome prediction content: %s", content)
             outcome_data = json.loads(content)
             
-            return outcome_data, log_text
+            return outcome_data, messages
         
         except Exception as e:
             print(f"[LLMWorldModel] Unexpected error: {e}")
@@ -565,25 +611,21 @@ def MAPEXECUTE(Rcode: List[Callable], llm_wm_predicted_success: bool, llm_wm_pre
     """
 
     # Current Observation =========================================================================
-    print("=== current_observation_state ===")
-    print(json.dumps(current_observation_state, indent=4, ensure_ascii=False))
+    logger.debug("=== current_observation_state ===\n%s", LazyJSON(current_observation_state))
     # ====================================================================================================
 
     # Proposed Action ===================================================================================
-    print("=== proposed_action ===")
-    print(json.dumps(proposed_action, indent=4, ensure_ascii=False))
+    logger.debug("=== proposed_action ===\n%s", LazyJSON(proposed_action))
     # ====================================================================================================
     
     if not Rcode:
         # Rcodeが提供されない場合のデフォルト動作
-        print("***************** Rcodeは渡されませんでした *********************")
-        print("***************** WMの予測だけで判定します *****************")
+        logger.debug("***************** Rcodeは渡されませんでした. WMの予測だけで判定します *****************")
         final_feedback = llm_wm_predicted_feedback
         final_suggestion = llm_wm_predicted_suggestion
         final_flag = llm_wm_predicted_success
     else:
-        print("***************** Rcodeが渡されました *********************")
-        print("***************** Rcode, WMの予測を比較して判定します *****************")
+        logger.debug("***************** Rcodeが渡されました. Rcode, WMの予測を比較して判定します *****************")
 
         ################### LLMの予測 ##########################
         llm_feedback = llm_wm_predicted_feedback
@@ -614,27 +656,27 @@ def MAPEXECUTE(Rcode: List[Callable], llm_wm_predicted_success: bool, llm_wm_pre
 
         # === LLM WMの予測とRcodeの判断の比較 ===
         if llm_success != rule_success:
-            print(f"矛盾が検出されました. [LLM]: {llm_success}, [Rcode]: {rule_success}.")
+            logger.info("矛盾が検出されました. [LLM]: %s, [Rcode]: %s.", llm_success, rule_success)
             if rule_success: # Rcodeは成功と言っているのにLLMは失敗と予測
-                print("Rcodeは成功と判定、LLMは失敗と判定:")
+                logger.debug("Rcodeは成功と判定、LLMは失敗と判定:")
                 final_feedback = rule_feedback
                 final_suggestion = rule_suggestion
                 final_flag = rule_success
             else: # Rcodeは失敗と言っているのにLLMは成功と予測
-                print("Rcodeは失敗と判定、LLMは成功と判定:")
+                logger.debug("Rcodeは失敗と判定、LLMは成功と判定:")
                 final_feedback = rule_feedback
                 final_suggestion = rule_suggestion
                 final_flag = rule_success
             
         else: # LLMの予測とRcodeの判断が一致する場合
-            print(f"LLMとRcodeで一致しました. [LLM]: {llm_success}, [Rcode]: {rule_success}.")
+            logger.debug("LLMとRcodeで一致しました. [LLM]: %s, [Rcode]: %s.", llm_success, rule_success)
             if rule_success: # 両方成功
-                print("どちらも成功と判定:")
+                logger.debug("どちらも成功と判定:")
                 final_feedback = rule_feedback
                 final_suggestion = rule_suggestion
                 final_flag = rule_success
             else: # 両方失敗
-                print("どちらも失敗と判定:")
+                logger.debug("どちらも失敗と判定:")
                 final_feedback = rule_feedback
                 final_suggestion = rule_suggestion
                 final_flag = rule_success
@@ -642,7 +684,7 @@ def MAPEXECUTE(Rcode: List[Callable], llm_wm_predicted_success: bool, llm_wm_pre
     # === 次の状態 (oˆt+1) の構築ロジック ===
     # LLM World Modelが直接ot+1を予測しないため、MAPEXECUTEがその役割を担う
 
-    print(f"[MAPEXECUTE] 最終的な結果: Flag={final_flag}, Feedback='{final_feedback}', Sugg='{final_suggestion}'")
+    logger.info("[MAPEXECUTE] 最終的な結果: Flag=%s, Feedback='%s', Sugg='%s'", final_flag, final_feedback, final_suggestion)
     return final_feedback, final_suggestion, final_flag
 
 
@@ -656,51 +698,49 @@ def MPC(ot: Dict, Rcode: List[Callable], LLM_AGENT: LLMAgent, LLM_WORLD_MODEL: L
     LLM_WORLD_MODEL: LLMWorldModelのインスタンス
     REPLANLIMIT: リプランの最大回数
     """
-    print("\n--- Starting MPC Loop ---")
+    logger.info("\n--- Starting MPC Loop ---")
     feedback = ""
     sugg = ""
     replan_count = 0
     action_log = {}
 
     # 保存処理 (outdir を使う)
-    agent_prompt_dir = os.path.join(outdir, "agent_prompts_log")
-    wm_prompt_dir = os.path.join(outdir, "wm_prompts_log")
+    # プロンプトはエピソード単位の圧縮アーカイブにバックグラウンドで追記する (utils/prompt_log.py)
+    prompt_writer = PromptLogWriter.for_dir(os.path.join(outdir, "prompt_log"))
     iteration_dir = os.path.join(outdir, "iteration_log")
 
-    os.makedirs(agent_prompt_dir, exist_ok=True)
-    os.makedirs(wm_prompt_dir, exist_ok=True)
     os.makedirs(iteration_dir, exist_ok=True)
 
     while replan_count < REPLANLIMIT:
-        print(f"\n[MPC] イテレーション回数: {replan_count + 1}/{REPLANLIMIT}")
+        logger.info("\n[MPC] イテレーション回数: %d/%d", replan_count + 1, REPLANLIMIT)
 
         feedbacks = {k: v for k, v in action_log.items() if k.startswith("Feedback_")}
         merged_feedback = " ".join(feedbacks.values())
 
         # 4: at ← LLMAGENT(ot, feedback, sugg)
         # LLMAgentが現在の観測、フィードバック、サジェスチョンに基づいて行動を生成
-        at, agent_prompt = LLM_AGENT.generate_action(ot, feedback=merged_feedback, suggestion=sugg, step=replan_count, task=task_name)
+        at, agent_messages = LLM_AGENT.generate_action(ot, feedback=merged_feedback, suggestion=sugg, step=replan_count, task=task_name)
 
          # 5: o_t1 ← LLM_WORLD_MODEL.predict_transition_outcome(ot['state'], at)
-        o_t1, wm_prompt = LLM_WORLD_MODEL.predict_transition_outcome(ot, at)
+        o_t1, wm_messages = LLM_WORLD_MODEL.predict_transition_outcome(ot, at)
 
         flag = o_t1.get("flag")
         feedback = o_t1.get("feedback")
         sugg = o_t1.get("suggestion")
 
-        print(f"[MPC] LLM World Modelが予測した成功判定: {flag}")
+        logger.info("[MPC] LLM World Modelが予測した成功判定: %s", flag)
         if not flag:
-            print(f"[MPC] Feedback from WM: {feedback}")
-            print(f"[MPC] Suggestion from WM: {sugg}")
+            logger.info("[MPC] Feedback from WM: %s", feedback)
+            logger.info("[MPC] Suggestion from WM: %s", sugg)
         
-        print("==========================MAPEXECUTE[実行]===========================================")
+        logger.debug("==========================MAPEXECUTE[実行]===========================================")
 
         # 6: MAPEXECUTEに渡して結果を得る
         feedback, sugg, final_flag = MAPEXECUTE(Rcode, flag, feedback, sugg, ot, at, outdir, t_index, scene_graph)
 
-        print(f"[MPC] MAPEXECUTE関数の結果 → Flag: {final_flag}, Feedback: '{feedback}', Suggestion: '{sugg}'")
+        logger.debug("[MPC] MAPEXECUTE関数の結果 → Flag: %s, Feedback: '%s', Suggestion: '%s'", final_flag, feedback, sugg)
 
-        print("==========================MAPEXECUTE[終了]===========================================")
+        logger.debug("==========================MAPEXECUTE[終了]===========================================")
 
 
         # リプラン回数付きキーで記録
@@ -710,15 +750,10 @@ def MPC(ot: Dict, Rcode: List[Callable], LLM_AGENT: LLMAgent, LLM_WORLD_MODEL: L
         action_log[f"Suggestion_{idx}"] = sugg
 
         # ==================================================================================================
-        # エージェントのプロンプト保存
-
-        agent_prompt_file_name = os.path.join(agent_prompt_dir, f"agent_prompt_{t_index}_{replan_count}.txt")
-        with open(agent_prompt_file_name, "w", encoding="utf-8") as f:
-            f.write(agent_prompt)
+        # エージェント・WMのプロンプト保存 (キューに積むだけで、書き込みはバックグラウンド)
 
-        wm_prompt_file_name = os.path.join(wm_prompt_dir, f"wm_prompt_{t_index}_{replan_count}.txt")
-        with open(wm_prompt_file_name, "w", encoding="utf-8") as f:
-            f.write(wm_prompt)
+        prompt_writer.log("agent", agent_messages, t_index=t_index, replan=replan_count)
+        prompt_writer.log("wm", wm_messages, t_index=t_index, replan=replan_count)
 
         # ==================================================================================================
         
@@ -726,10 +761,9 @@ def MPC(ot: Dict, Rcode: List[Callable], LLM_AGENT: LLMAgent, LLM_WORLD_MODEL: L
 
         # MAPEXECUTE関数でTrueになったら...
         if final_flag:
-            print(f"[MPC] 以下の Action が受け入れられました.")
-            print(f"{json.dumps(at, indent=4, ensure_ascii=False)}")
+            logger.info("[MPC] 以下の Action が受け入れられました.\n%s", LazyJSON(at))
 
-            print(f"{t_index}ステップ目のイテレーション結果を保存します.")
+            logger.debug("%dステップ目のイテレーション結果を保存します.", t_index)
             iteration_file_name = os.path.join(iteration_dir, f"iteration_log_{t_index}.txt")
             with open(iteration_file_name, "w", encoding="utf-8") as f:
                 f.write(json.dumps(action_log, indent=4, ensure_ascii=False))
@@ -737,9 +771,9 @@ def MPC(ot: Dict, Rcode: List[Callable], LLM_AGENT: LLMAgent, LLM_WORLD_MODEL: L
             return at
 
     # リプラン回数を超過した場合の処理
-    print(f"[MPC] REPLANLIMITに到達しました. ({REPLANLIMIT})")
+    logger.info("[MPC] REPLANLIMITに到達しました. (%d)", REPLANLIMIT)
 
-    print(f"{t_index}ステップ目のイテレーション結果を保存します.")
+    logger.debug("%dステップ目のイテレーション結果を保存します.", t_index)
     iteration_file_name = os.path.join(iteration_dir, f"iteration_log_{t_index}.txt")
     with open(iteration_file_name, "w", encoding="utf-8") as f:
         f.write(json.dumps(action_log, indent=4, ensure_ascii=False))
@@ -0,0 +1,242 @@
+"""
+確率ルール (probabilistic_rules.pl) を使うローカルの World Model。
+
+PrologRuleProbCalc が出力する `p :: action_failed(Action) :- Body.` 形式のルールを ProbLog で読み込み、
+現在の観測から作ったファクトの下で発火するルールを求め、P(action_failed(a_t)) = 発火したルールの p の最大値 とする。
+ルールは似た条件のものが重なって生成されるため、noisy-or で合成すると同じ根拠を何度も数えてしまう
+(p=0.5 の take のルールが 5 つ重なると 0.97 になる)。変数名だけが違うルールは読み込み時に 1 つにまとめる。
+
+- P >= threshold       : 失敗と予測 (発火したルールを feedback に入れる)
+- P <= 1 - threshold   : 成功と予測
+- それ以外 / 提案行動の種類にルールがない / 発火したルールがない : fallback (LLMWorldModel) に任せる
+
+LLMWorldModel と同じ predict_transition_outcome(ot, at) -> (outcome, messages) を持つので、
+MPC にそのまま渡せる。ローカルで判定した場合、messages には判定内容を 1 件だけ入れる (プロンプトログ用)。
+"""
+import os
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+from utils.llm_usage import PromptCacheMeter
+from utils.logger import get_logger
+from utils.state_encoder import dumps_compact
+from walle.OurOriginal.JSONtoFacts import state_action_to_facts
+
+try:
+    from problog import get_evaluatable
+    from problog.engine import DefaultEngine
+    from problog.logic import And, Clause, Constant, Not, Or, Term
+    from problog.program import PrologString
+except ImportError:
+    DefaultEngine = None
+
+logger = get_logger(__name__)
+
+# state_action_to_facts が生成するファクト (述語名/引数の数)
+FACT_SIGNATURES = {
+    "action/1", "current_position/1", "location_status/2", "reachable_location/1",
+    "items_in_location/2", "empty/1", "item_in_hand/2",
+}
+
+FIRED = "wm_rule_fired"
+
+_VARIABLE = re.compile(r"'(?:[^'\\]|\\.)*'|\b[A-Z_][A-Za-z0-9_]*")
+
+
+def _body_goals(body) -> List:
+    """ルール本体のゴール (And/Or/否定を展開したリテラル) を列挙する。"""
+    if body is None:
+        return []
+    if isinstance(body, (And, Or)):
+        return _body_goals(body.op1) + _body_goals(body.op2)
+    if isinstance(body, Not):
+        return _body_goals(body.child)
+    if isinstance(body, Term) and body.functor in ("\\+", "not", "call") and body.arity == 1:
+        return _body_goals(body.args[0])
+    return [body]
+
+
+def _signature(term) -> str:
+    return f"{term.functor}/{term.arity}"
+
+
+def _canonical(text: str) -> str:
+    """変数を出現順に V0, V1, ... と付け直した節の文字列 (変数名だけが違う節は同じになる)。"""
+    names: Dict[str, str] = {}
+
+    def rename(match):
+        token = match.group(0)
+        if token.startswith("'"):
+            return token
+        return names.setdefault(token, f"V{len(names)}")
+    return _VARIABLE.sub(rename, text)
+
+
+class ProbLogWorldModel:
+    """
+    probabilistic_rules.pl による World Model。確信が持てないときだけ fallback の LLM に問い合わせる。
+    """
+
+    def __init__(self, rules_file: str = "./probabilistic_rules.pl", fallback=None, threshold: float = 0.8):
+        """
+        rules_file: `p :: action_failed(...) :- ...` 形式の確率ルールファイル (更新されたら自動で読み直す)
+        fallback: 確信が持てない場合に使う World Model (LLMWorldModel)。None ならローカルの P で決める
+        threshold: ローカルで判定する確信度 (0.5 < threshold <= 1)
+        """
+        if DefaultEngine is None:
+            raise ImportError("ProbLogWorldModel requires problog (pip install problog).")
+        if not 0.5 < threshold <= 1.0:
+            raise ValueError(f"threshold must be in (0.5, 1.0]: {threshold}")
+        self.rules_file = rules_file
+        self.fallback = fallback
+        self.threshold = threshold
+        self.cache_meter = fallback.cache_meter if fallback is not None else PromptCacheMeter("ProbLogWorldModel", False)
+
+        # ファクトが 1 つもない述語 (例: 手に何も持っていない場合の item_in_hand) は失敗扱い
+        self.engine = DefaultEngine(unknown=DefaultEngine.UNKNOWN_FAIL)
+        self._db = None
+        self._mtime = None
+        self.rules: List[Tuple[float, str, str]] = []
+        self.rule_actions: Set[str] = set()
+
+        self.local_count = 0
+        self.escalated_count = 0
+
+    # ------------------------------------------------------------------
+    # ルールの読み込み
+    # ------------------------------------------------------------------
+
+    def _load_rules(self) -> None:
+        """ルールファイルが更新されていれば ClauseDB を作り直す。"""
+        mtime = os.path.getmtime(self.rules_file) if os.path.exists(self.rules_file) else None
+        if self._db is not None and mtime == self._mtime:
+            return
+        self._mtime = mtime
+        self.rules = []
+        self.rule_actions = set()
+
+        text = ""
+        if mtime is not None:
+            with open(self.rules_file, "r", encoding="utf-8") as f:
+                text = f.read()
+        clauses = list(PrologString(text))
+
+        # ルールファイル内で定義されている述語
+        defined = set(FACT_SIGNATURES) | set(self.engine.get_builtins())
+        for clause in clauses:
+            head = clause.head if isinstance(clause, Clause) else clause
+            defined.add(_signature(head))
+
+        program = []
+        seen: Dict[str, int] = {}
+        for clause in clauses:
+            if not isinstance(clause, Clause) or clause.head.functor != "action_failed" or clause.head.arity != 1:
+                program.append(clause)
+                continue
+            # 確率計算時 (PrologRuleProbCalc) に existence_error で一度も適用されなかったルールは除く
+            undefined = [_signature(g) for g in _body_goals(clause.body) if _signature(g) not in defined]
+            if undefined:
+                logger.debug("[ProbLogWorldModel] 未定義述語 %s を含むルールを除外: %s", undefined, clause)
+                continue
+
+            prob = float(clause.head.probability) if clause.head.probability is not None else 1.0
+            text = str(Clause(clause.head.with_probability(None), clause.body))
+            key = _canonical(text)
+            if key in seen:
+                # 変数名だけが違うルールは 1 つにまとめる (p は大きい方)
+                index = seen[key]
+                old_prob, old_text, functor = self.rules[index]
+                self.rules[index] = (max(old_prob, prob), old_text, functor)
+                continue
+
+            index = len(self.rules)
+            seen[key] = index
+            action_arg = clause.head.args[0]
+            functor = action_arg.functor if isinstance(action_arg, Term) and not action_arg.is_var() else None
+            self.rules.append((prob, text, functor))
+            if functor is not None:
+                self.rule_actions.add(functor)
+            # どのルールが発火したかを知るための決定的なコピー (確率は発火したルールの p の最大値で求める)
+            program.append(Clause(Term(FIRED, Constant(index), action_arg), clause.body))
+
+        db = self.engine.prepare(PrologString(""))
+        for clause in program:
+            db.add_statement(clause)
+        self._db = db
+        logger.info("[ProbLogWorldModel] %s から %d ルールを読み込みました (対象アクション: %s)",
+                    self.rules_file, len(self.rules), sorted(self.rule_actions))
+
+    # ------------------------------------------------------------------
+    # 推論
+    # ------------------------------------------------------------------
+
+    def failure_probability(self, state: Dict, action: Dict) -> Tuple[Optional[float], List[int]]:
+        """
+        P(action_failed(a)) (発火したルールの p の最大値) と発火したルールの番号を返す。
+        提案行動の種類にルールがない場合は (None, [])、発火したルールがない場合は (0.0, [])。
+        """
+        self._load_rules()
+        facts = state_action_to_facts({"state": state, "action": action})
+        action_line = next((line for line in facts.splitlines() if line.startswith("action(")), None)
+        if action_line is None:
+            return None, []
+        action_term = Term.from_string(action_line[len("action("):-len(").")])
+        if action_term.functor not in self.rule_actions:
+            return None, []
+
+        db = self._db.extend()
+        for fact in PrologString(facts):
+            db.add_statement(fact)
+
+        candidates = [i for i, (_, _, functor) in enumerate(self.rules) if functor in (None, action_term.functor)]
+        queries = [Term(FIRED, Constant(i), action_term) for i in candidates]
+        formula = self.engine.ground_all(db, queries=queries)
+        result = get_evaluatable().create_from(formula).evaluate()
+
+        fired = [i for i, q in zip(candidates, queries) if result.get(q, 0.0) > 0.0]
+        prob = max((self.rules[i][0] for i in fired), default=0.0)
+        return prob, fired
+
+    def predict_transition_outcome(self, current_observation_state, proposed_action):
+        """
+        LLMWorldModel.predict_transition_outcome と同じ形式で予測を返す。
+        戻り値: ({"flag": bool, "feedback": str, "suggestion": str}, messages)
+        """
+        try:
+            prob, fired = self.failure_probability(current_observation_state["state"], proposed_action)
+        except Exception as e:
+            logger.warning("[ProbLogWorldModel] ProbLog での推論に失敗しました: %s", e)
+            prob, fired = None, []
+
+        # どのルールも発火しなかった P=0 は「成功の根拠がある」わけではないので確信とみなさない
+        confident = prob is not None and bool(fired) and (prob >= self.threshold or prob <= 1.0 - self.threshold)
+        if not confident and self.fallback is not None:
+            self.escalated_count += 1
+            logger.info("[ProbLogWorldModel] P(action_failed)=%s (発火ルール %d件) のため LLM World Model に問い合わせます",
+                        prob, len(fired))
+            return self.fallback.predict_transition_outcome(current_observation_state, proposed_action)
+
+        self.local_count += 1
+        prob = prob if prob is not None else 0.0
+        if prob >= 0.5:
+            p, rule, _ = max((self.rules[i] for i in fired), default=(prob, "", None))
+            outcome = {
+                "flag": False,
+                "feedback": (f"Action '{proposed_action.get('action_name')}' with args {proposed_action.get('args')} "
+                             f"is predicted to fail (p={prob:.2f}). Matched rule ({p:.2f}): {rule}"),
+                "suggestion": "Satisfy the precondition violated by the matched rule before retrying this action.",
+            }
+        else:
+            outcome = {"flag": True, "feedback": "", "suggestion": ""}
+        logger.info("[ProbLogWorldModel] P(action_failed)=%.4f -> flag=%s (発火ルール %d件)", prob, outcome["flag"], len(fired))
+
+        messages = [{"role": "problog", "content": dumps_compact({
+            "rules_file": self.rules_file, "action": proposed_action, "p_failed": prob,
+            "fired_rules": [self.rules[i][1] for i in fired], "outcome": outcome,
+        })}]
+        return outcome, messages
+
+    def summary(self) -> str:
+        total = self.local_count + self.escalated_count
+        rate = self.local_count / total if total else 0.0
+        return f"local={self.local_count} escalated={self.escalated_count} local_rate={rate:.2%}"
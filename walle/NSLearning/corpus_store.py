@@ -0,0 +1,316 @@
+"""
+D_cor_all / D_inc_all 用のメモリマップ型バイナリコーパスストア。
+
+JSON のリストを毎回 json.load / json.dump すると、コーパス全体のオブジェクトが毎ステップ作られる。
+このストアは 2 つのファイルで構成され、開くのは O(1)、エントリは参照されたときに 1 件ずつ
+パースされる。
+
+    <base>.idx : ヘッダ (16 バイト) + 固定長レコード (1 件 32 バイト)
+                 offset(u64) length(u32) step_id(i32) task_hash(u64) global_id(i64)
+    <base>.dat : 各エントリの JSON (空白なし, UTF-8) を連結したもの
+
+- append(): .dat の末尾に追記し、.idx にレコードを 1 つ足す。
+- replace(): 新しい JSON を .dat の末尾に書き、.idx のレコードだけを書き換える
+  (内容が同じなら何もしない)。古い JSON は compact() で詰める。
+- index_of(task_id, step_id): .idx のレコードだけで引ける (JSON はパースしない)。
+- migrate_from_json() / export_json(): 従来の D_*_all.json との相互変換。エクスポートは
+  エントリの JSON をそのまま書き出すストリーミング処理で、パースしない。
+
+使用例:
+    store = CorpusStore.shared("./CodeRule/D_cor_all", migrate_from="./CodeRule/D_cor_all.json")
+    idx = store.index_of("put a mug in sinkbasin.", 3)
+    entry = store[idx]
+    store.export_json("./CodeRule/D_cor_all.json")
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+from typing import Dict, Iterator, List, Optional, Tuple
+
+MAGIC = b"WCS1"
+HEADER = struct.Struct("<4sI8x")
+RECORD = struct.Struct("<QIiQq")
+NO_STEP = -1
+
+
+def task_hash(task_id) -> int:
+    """task_id の 64 ビットハッシュ (.idx に格納する)。"""
+    return int.from_bytes(hashlib.blake2b(str(task_id).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _encode(entry: Dict) -> bytes:
+    return json.dumps(entry, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _step_int(step_id) -> int:
+    try:
+        return int(step_id)
+    except (TypeError, ValueError):
+        return NO_STEP
+
+
+class CorpusStore:
+    """
+    {"global_id", "task_id", "step_id", "step_data"} エントリのリストとして振る舞うストア。
+    書き込みはプロセス間で排他されないので、呼び出し側で FileLock を取ること。
+    """
+    _shared: Dict[str, "CorpusStore"] = {}
+
+    def __init__(self, base_path: str):
+        self.base_path = base_path
+        self.idx_path = base_path + ".idx"
+        self.dat_path = base_path + ".dat"
+        dir_name = os.path.dirname(base_path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        if not os.path.exists(self.idx_path):
+            with open(self.idx_path, "wb") as f:
+                f.write(HEADER.pack(MAGIC, 1))
+            open(self.dat_path, "wb").close()
+        with open(self.idx_path, "rb") as f:
+            magic, _ = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{self.idx_path} is not a corpus store index")
+
+        self._idx_map: Optional[mmap.mmap] = None
+        self._dat_map: Optional[mmap.mmap] = None
+        self._key_index: Optional[Dict[Tuple[int, int], List[int]]] = None
+        self._indexed = 0
+
+    @classmethod
+    def open(cls, base_path: str, migrate_from: Optional[str] = None) -> "CorpusStore":
+        """
+        ストアを開く。ストアがまだなく migrate_from の JSON があれば、そこから移行する。
+        """
+        fresh = not os.path.exists(base_path + ".idx")
+        store = cls(base_path)
+        if fresh and migrate_from and os.path.exists(migrate_from) and os.path.getsize(migrate_from) > 0:
+            store.migrate_from_json(migrate_from)
+        return store
+
+    @classmethod
+    def shared(cls, base_path: str, migrate_from: Optional[str] = None) -> "CorpusStore":
+        """
+        プロセス内で共有するストアを返す (索引を呼び出しをまたいで使い回す)。
+        他プロセスの追記は refresh() で取り込んでから返す。
+        """
+        key = os.path.abspath(base_path)
+        store = cls._shared.get(key)
+        if store is None or not os.path.exists(store.idx_path):
+            store = cls.open(base_path, migrate_from=migrate_from)
+            cls._shared[key] = store
+        else:
+            store.refresh()
+        return store
+
+    def refresh(self) -> int:
+        """
+        ファイルが外部 (他プロセス) で伸びていればマップを張り直し、索引に追加分を反映する。
+        増えた件数を返す。
+        """
+        if self._idx_map is not None and len(self._idx_map) != os.path.getsize(self.idx_path):
+            self._idx_map.close()
+            self._idx_map = None
+        if self._dat_map is not None and len(self._dat_map) != os.path.getsize(self.dat_path):
+            self._dat_map.close()
+            self._dat_map = None
+        before = self._indexed
+        if self._key_index is not None:
+            self._index_records(before, len(self))
+        return len(self) - before if self._key_index is not None else 0
+
+    def _index_records(self, start: int, stop: int) -> None:
+        for i in range(start, stop):
+            _, _, step, t_hash, _ = self.record(i)
+            self._key_index.setdefault((t_hash, step), []).append(i)
+        self._indexed = stop
+
+    # ------------------------------------------------------------------
+    # メモリマップ
+    # ------------------------------------------------------------------
+
+    def _map(self, path: str) -> Optional[mmap.mmap]:
+        if os.path.getsize(path) == 0:
+            return None
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _idx(self) -> mmap.mmap:
+        if self._idx_map is None:
+            self._idx_map = self._map(self.idx_path)
+        return self._idx_map
+
+    def _dat(self) -> Optional[mmap.mmap]:
+        if self._dat_map is None:
+            self._dat_map = self._map(self.dat_path)
+        return self._dat_map
+
+    def _unmap(self) -> None:
+        for m in (self._idx_map, self._dat_map):
+            if m is not None:
+                m.close()
+        self._idx_map = None
+        self._dat_map = None
+
+    def close(self) -> None:
+        self._unmap()
+        self._key_index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ------------------------------------------------------------------
+    # 読み出し
+    # ------------------------------------------------------------------
+
+    def __len__(self) -> int:
+        return (len(self._idx()) - HEADER.size) // RECORD.size
+
+    def record(self, i: int) -> Tuple[int, int, int, int, int]:
+        """(offset, length, step_id, task_hash, global_id)"""
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError(i)
+        return RECORD.unpack_from(self._idx(), HEADER.size + i * RECORD.size)
+
+    def raw(self, i: int) -> bytes:
+        """エントリの JSON バイト列 (パースしない)。"""
+        offset, length, _, _, _ = self.record(i)
+        dat = self._dat()
+        if dat is None or offset + length > len(dat):
+            # 他プロセスが .dat に追記した直後はマップを張り直す
+            if self._dat_map is not None:
+                self._dat_map.close()
+                self._dat_map = None
+            dat = self._dat()
+        return dat[offset:offset + length]
+
+    def __getitem__(self, i: int) -> Dict:
+        return json.loads(self.raw(i))
+
+    def __iter__(self) -> Iterator[Dict]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def offsets(self) -> List[int]:
+        """全エントリの .dat 上のオフセット (replace() / compact() で変わる)。JSON はパースしない。"""
+        n = len(self)
+        if n == 0:
+            return []
+        records = self._idx()[HEADER.size:HEADER.size + n * RECORD.size]
+        return [record[0] for record in RECORD.iter_unpack(records)]
+
+    def index_of(self, task_id, step_id) -> Optional[int]:
+        """(task_id, step_id) のエントリ番号。なければ None。"""
+        if self._key_index is None:
+            self._key_index = {}
+            self._index_records(0, len(self))
+        candidates = self._key_index.get((task_hash(task_id), _step_int(step_id)), [])
+        if len(candidates) == 1:
+            return candidates[0]
+        # ハッシュの衝突や整数でない step_id の場合だけ JSON を確認する
+        for i in candidates:
+            entry = self[i]
+            if entry.get("task_id") == task_id and str(entry.get("step_id")) == str(step_id):
+                return i
+        return None
+
+    # ------------------------------------------------------------------
+    # 書き込み
+    # ------------------------------------------------------------------
+
+    def _write_blob(self, blob: bytes) -> int:
+        with open(self.dat_path, "ab") as f:
+            offset = f.tell()
+            f.write(blob)
+        return offset
+
+    def append(self, entry: Dict) -> int:
+        """エントリを末尾に追加し、その番号を返す。"""
+        blob = _encode(entry)
+        self._unmap()
+        offset = self._write_blob(blob)
+        step = _step_int(entry.get("step_id"))
+        t_hash = task_hash(entry.get("task_id"))
+        with open(self.idx_path, "ab") as f:
+            f.write(RECORD.pack(offset, len(blob), step, t_hash, int(entry.get("global_id", -1))))
+        i = len(self) - 1
+        if self._key_index is not None:
+            # 他プロセスの追記分があればそれも含めて索引に入れる
+            self._index_records(self._indexed, i + 1)
+        return i
+
+    def replace(self, i: int, entry: Dict) -> bool:
+        """エントリ i を置き換える。内容が同じなら書き込まず False を返す。"""
+        blob = _encode(entry)
+        if self.raw(i) == blob:
+            return False
+        _, _, old_step, old_hash, _ = self.record(i)
+        if i < 0:
+            i += len(self)
+        self._unmap()
+        offset = self._write_blob(blob)
+        step = _step_int(entry.get("step_id"))
+        t_hash = task_hash(entry.get("task_id"))
+        with open(self.idx_path, "r+b") as f:
+            f.seek(HEADER.size + i * RECORD.size)
+            f.write(RECORD.pack(offset, len(blob), step, t_hash, int(entry.get("global_id", -1))))
+        if self._key_index is not None and (old_hash, old_step) != (t_hash, step):
+            self._key_index = None
+        return True
+
+    def compact(self) -> None:
+        """replace() で使われなくなった JSON を .dat から取り除く。"""
+        tmp_base = self.base_path + ".compact"
+        tmp = CorpusStore(tmp_base)
+        with open(tmp.dat_path, "wb") as dat, open(tmp.idx_path, "ab") as idx:
+            for i in range(len(self)):
+                _, _, step, t_hash, global_id = self.record(i)
+                blob = self.raw(i)
+                idx.write(RECORD.pack(dat.tell(), len(blob), step, t_hash, global_id))
+                dat.write(blob)
+        tmp.close()
+        self.close()
+        os.replace(tmp.dat_path, self.dat_path)
+        os.replace(tmp.idx_path, self.idx_path)
+
+    # ------------------------------------------------------------------
+    # JSON との相互変換
+    # ------------------------------------------------------------------
+
+    def migrate_from_json(self, json_path: str) -> int:
+        """従来の D_*_all.json (エントリのリスト) を読み込んで追加する。追加件数を返す。"""
+        with open(json_path, "r", encoding="utf-8") as f:
+            try:
+                entries = json.load(f)
+            except json.JSONDecodeError:
+                print(f"Warning: {json_path} のパース失敗。空のストアで開始。")
+                return 0
+        self._unmap()
+        with open(self.dat_path, "ab") as dat, open(self.idx_path, "ab") as idx:
+            for entry in entries:
+                blob = _encode(entry)
+                idx.write(RECORD.pack(dat.tell(), len(blob), _step_int(entry.get("step_id")),
+                                      task_hash(entry.get("task_id")), int(entry.get("global_id", -1))))
+                dat.write(blob)
+        self._key_index = None
+        print(f"✓ {json_path} から {len(entries)} 件を {self.base_path} に移行しました。")
+        return len(entries)
+
+    def export_json(self, json_path: str) -> None:
+        """エントリの JSON をパースせずにつなげて、JSON のリストとして書き出す。"""
+        tmp_path = json_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(b"[")
+            for i in range(len(self)):
+                f.write(b"\n    " if i == 0 else b",\n    ")
+                f.write(self.raw(i))
+            f.write(b"\n]" if len(self) else b"]")
+        os.replace(tmp_path, json_path)
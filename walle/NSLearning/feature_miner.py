@@ -0,0 +1,305 @@
+"""
+遷移のブール特徴と、失敗ルールのローカル学習 (決定リスト)。
+
+all_action_rules.json のルールの多くは「手に何も持っていなければ失敗」「対象の場所にいなければ失敗」
+「対象のアイテムが対象の場所になければ失敗」のような決まった形をしている。ここでは遷移ごとに固定の
+ブール特徴 (FEATURES) を TransitionTable の列演算で計算し (TransitionFeatures)、行動の種類ごとに
+
+    成功した遷移を 1 件も含まず、失敗した遷移を最も多く含む 1〜2 リテラルの連言
+
+を貪欲に選ぶ (決定リスト)。選んだルールはルール文 (final_rules と同じ形式) と Python 関数の両方で出力するので、
+STAGE3 の翻訳キャッシュに入れておけば LLM に翻訳させる必要もない。
+LLM のマイニングには、ここで説明できなかった失敗 (residual) だけを送る。
+
+特徴は D_inc_all / D_cor_all の StoreTable (ストアの隣に保存される列指向テーブル) から直接計算する。
+StoreTable は stage1 が replace() したエントリの古い行を live=False にしているので、現在の内容の行だけを使う。
+
+使用例:
+    features = TransitionFeatures([inc_table, cor_table])
+    rules = mine_failure_rules(features)
+    for i, rule in enumerate(rules, 1):
+        print(rule.text(i))
+"""
+from typing import Callable, List, Sequence, Tuple
+
+import numpy as np
+
+from .transition_table import StoreTable, TransitionTable
+
+
+class Feature:
+    """
+    遷移のブール特徴。
+    compute: TransitionTable -> 長さ n の bool 配列 (列演算)
+    expression: 同じ判定の Python 式 (生成するルール関数の中で、args / hand / position / locations を使う)
+    """
+
+    def __init__(self, name: str, args: Tuple[str, ...], true_text: str, false_text: str, check: str,
+                 expression: str, compute: Callable[[TransitionTable], np.ndarray]):
+        self.name = name
+        self.args = args              # 特徴が意味を持つために行動に必要な引数
+        self.true_text = true_text
+        self.false_text = false_text
+        self.check = check
+        self.expression = expression
+        self.compute = compute
+
+
+def _closed(table: TransitionTable) -> int:
+    return table.lookup("closed")
+
+
+def _recep_empty(table: TransitionTable) -> np.ndarray:
+    entries = table.location_entries(table.arg("recep"))
+    counts = np.diff(table.items_offsets)
+    if len(counts) == 0:
+        return np.zeros(table.n, dtype=bool)
+    return (entries >= 0) & (counts[np.maximum(entries, 0)] == 0)
+
+
+FEATURES: List[Feature] = [
+    Feature("hand_empty", (),
+            "the agent is holding nothing", "the agent is holding an item",
+            "state['item_in_hand']['item_name'] is None",
+            "not hand",
+            lambda t: ~t.truthy(t.hand)),
+    Feature("holding_obj", ("obj",),
+            "the agent is holding the target object", "the agent is not holding the target object",
+            "state['item_in_hand']['item_name'] == action['args']['obj']",
+            "bool(args.get('obj')) and hand == args.get('obj')",
+            lambda t: t.truthy(t.arg("obj")) & (t.hand == t.arg("obj"))),
+    Feature("at_recep", ("recep",),
+            "the agent is at the target location", "the agent is not at the target location",
+            "state['current_position']['location_name'] == action['args']['recep']",
+            "bool(args.get('recep')) and position.get('location_name') == args.get('recep')",
+            lambda t: t.truthy(t.arg("recep")) & (t.pos == t.arg("recep"))),
+    Feature("recep_reachable", ("recep",),
+            "the target location is reachable", "the target location is not in reachable_locations",
+            "action['args']['recep'] in state['reachable_locations']",
+            "args.get('recep') in (state.get('reachable_locations') or [])",
+            lambda t: t.in_reachable(t.arg("recep"))),
+    Feature("recep_known", ("recep",),
+            "the target location has been observed", "the target location has not been observed yet",
+            "action['args']['recep'] in state['items_in_locations']",
+            "args.get('recep') in locations",
+            lambda t: t.has_location(t.arg("recep"))),
+    Feature("recep_closed", ("recep",),
+            "the target location is closed", "the target location is not closed",
+            "state['items_in_locations'][action['args']['recep']]['status'] == 'closed'",
+            "(locations.get(args.get('recep')) or {}).get('status') == 'closed'",
+            lambda t: t.location_status(t.arg("recep")) == _closed(t)),
+    Feature("recep_open", ("recep",),
+            "the target location is open", "the target location is not open",
+            "state['items_in_locations'][action['args']['recep']]['status'] == 'open'",
+            "(locations.get(args.get('recep')) or {}).get('status') == 'open'",
+            lambda t: t.location_status(t.arg("recep")) == t.lookup("open")),
+    Feature("recep_empty", ("recep",),
+            "the target location has no items", "the target location has items",
+            "state['items_in_locations'][action['args']['recep']]['items'] is empty",
+            "args.get('recep') in locations and not (locations.get(args.get('recep')) or {}).get('items')",
+            _recep_empty),
+    Feature("obj_in_recep", ("obj", "recep"),
+            "the target object is in the target location", "the target object is not in the target location",
+            "action['args']['obj'] in state['items_in_locations'][action['args']['recep']]['items']",
+            "bool(args.get('obj')) and args.get('obj') in ((locations.get(args.get('recep')) or {}).get('items') or [])",
+            lambda t: t.in_location_list(t.arg("obj"), t.arg("recep"), "items")),
+    Feature("obj_at_pos", ("obj",),
+            "the target object is at the agent's current location", "the target object is not at the agent's current location",
+            "action['args']['obj'] in state['items_in_locations'][state['current_position']['location_name']]['items']",
+            "bool(args.get('obj')) and args.get('obj') in ((locations.get(position.get('location_name')) or {}).get('items') or [])",
+            lambda t: t.in_location_list(t.arg("obj"), t.pos, "items")),
+    Feature("pos_closed", (),
+            "the agent's current location is closed", "the agent's current location is not closed",
+            "state['current_position']['status'] == 'closed'",
+            "position.get('status') == 'closed'",
+            lambda t: t.pos_status == _closed(t)),
+    Feature("at_tool", ("tool",),
+            "the agent is at the tool", "the agent is not at the tool",
+            "state['current_position']['location_name'] == action['args']['tool']",
+            "bool(args.get('tool')) and position.get('location_name') == args.get('tool')",
+            lambda t: t.truthy(t.arg("tool")) & (t.pos == t.arg("tool"))),
+    Feature("tool_at_pos", ("tool",),
+            "the tool is at the agent's current location", "the tool is not at the agent's current location",
+            "action['args']['tool'] in state['items_in_locations'][state['current_position']['location_name']]['items']",
+            "bool(args.get('tool')) and args.get('tool') in ((locations.get(position.get('location_name')) or {}).get('items') or [])",
+            lambda t: t.in_location_list(t.arg("tool"), t.pos, "items")),
+]
+
+FEATURES_BY_NAME = {feature.name: feature for feature in FEATURES}
+_FEATURE_ARGS = sorted({key for feature in FEATURES for key in feature.args})
+
+# リテラル: (特徴名, 値)。("at_recep", False) は「対象の場所にいない」
+Literal = Tuple[str, bool]
+
+_RULE_TEMPLATE = '''def {name}(state, action, scene_graph):
+    if action.get("action_name") != {action!r}:
+        return "", True, ""
+    args = action.get("args") or {{}}
+    hand = (state.get("item_in_hand") or {{}}).get("item_name")
+    position = state.get("current_position") or {{}}
+    locations = state.get("items_in_locations") or {{}}
+    if {condition}:
+        return {feedback!r}, False, {suggestion!r}
+    return "", True, ""'''
+
+
+def feature_matrix(table: TransitionTable, features: Sequence[Feature] = FEATURES) -> np.ndarray:
+    """(n, 特徴数) の bool 行列。"""
+    if table.n == 0:
+        return np.zeros((0, len(features)), dtype=bool)
+    return np.stack([feature.compute(table) for feature in features], axis=1)
+
+
+class CandidateRule:
+    """ローカルで学習した失敗ルール (リテラルの連言)。"""
+
+    def __init__(self, action: str, literals: Sequence[Literal], failures: int, total_failures: int):
+        self.action = action
+        self.literals = tuple(literals)
+        self.failures = failures              # カバーした失敗の件数
+        self.total_failures = total_failures  # その行動の失敗の件数
+
+    def __repr__(self) -> str:
+        return f"CandidateRule({self.action}, {self.literals}, {self.failures}/{self.total_failures})"
+
+    def _texts(self, negate: bool = False) -> List[str]:
+        texts = []
+        for name, value in self.literals:
+            feature = FEATURES_BY_NAME[name]
+            texts.append(feature.true_text if value != negate else feature.false_text)
+        return texts
+
+    def condition(self) -> str:
+        parts = []
+        for name, value in self.literals:
+            expression = FEATURES_BY_NAME[name].expression
+            parts.append(f"({expression})" if value else f"not ({expression})")
+        return " and ".join(parts)
+
+    def function_name(self, number: int) -> str:
+        return f"Rule_{number}_{self.action}"
+
+    def text(self, number: int) -> str:
+        """final_rules と同じ形式のルール文。"""
+        checks = []
+        for name, value in self.literals:
+            check = FEATURES_BY_NAME[name].check
+            checks.append(check if value else f"not ({check})")
+        return (f"Rule {number}: For action '{self.action}', if {' and '.join(self._texts())}, the action will fail; "
+                f"Checking Method: check that {' and '.join(checks)}.")
+
+    def source(self, number: int) -> str:
+        """ルール文に対応するコードルール (Rule_<n>_<action>)。"""
+        return _RULE_TEMPLATE.format(
+            name=self.function_name(number), action=self.action, condition=self.condition(),
+            feedback=f"Action '{self.action}' will fail because {' and '.join(self._texts())}.",
+            suggestion=f"Make sure that {' and '.join(self._texts(negate=True))} before '{self.action}'.",
+        )
+
+    def covers(self, features: "TransitionFeatures") -> np.ndarray:
+        """ルールが失敗を予測する行。"""
+        mask = features.action == self.action
+        index = {feature.name: j for j, feature in enumerate(FEATURES)}
+        for name, value in self.literals:
+            mask &= features.matrix[:, index[name]] == value
+        return mask
+
+
+def _names(table: TransitionTable, ids: np.ndarray) -> np.ndarray:
+    """id 列を文字列 (None) の配列にする (テーブルごとに語彙が違うので、まとめるときは名前で持つ)。"""
+    names = np.asarray(list(table.names) + [None], dtype=object)
+    return names[np.where(ids >= 0, ids, len(table.names))]
+
+
+class TransitionFeatures:
+    """
+    1 つ以上のテーブルの行の特徴行列と、学習に使う列 (行動名・成否・引数の有無・タスク・ステップ)。
+    StoreTable は live_rows() (ストアの現在の内容) の行だけを使う。
+    """
+
+    def __init__(self, tables: Sequence[TransitionTable]):
+        parts = []
+        for table in tables:
+            rows = table.live_rows() if isinstance(table, StoreTable) else table.rows()
+            parts.append({
+                "matrix": feature_matrix(table)[rows],
+                "action": _names(table, table.action[rows]),
+                "success": np.asarray(table.success[rows]),
+                "task": _names(table, table.task[rows]),
+                "step": _names(table, table.step[rows]),
+                "args": {key: table.has_arg(key)[rows] for key in _FEATURE_ARGS},
+            })
+        self.n = sum(len(part["success"]) for part in parts)
+        self.matrix = np.concatenate([p["matrix"] for p in parts]) if parts else np.zeros((0, len(FEATURES)), dtype=bool)
+        for name in ("action", "success", "task", "step"):
+            setattr(self, name, np.concatenate([p[name] for p in parts]) if parts else np.zeros(0, dtype=object))
+        self.args = {key: np.concatenate([p["args"][key] for p in parts]) if parts else np.zeros(0, dtype=bool)
+                     for key in _FEATURE_ARGS}
+
+
+def mine_failure_rules(features: TransitionFeatures, min_support: int = 3, max_literals: int = 2,
+                       max_rules_per_action: int = 5) -> List[CandidateRule]:
+    """
+    行動の種類ごとに、成功した遷移を含まない連言で失敗した遷移を貪欲にカバーする (決定リスト)。
+    各ステップで「まだカバーしていない失敗」を最も多く含むリテラル 1 つ、またはペアを選ぶ
+    (同じ件数なら短い方)。min_support 件未満しかカバーできなくなったら止める。
+    失敗・成功がそれぞれ min_support 件未満の行動は対象にしない。
+    """
+    if features.n == 0:
+        return []
+    matrix = features.matrix
+    rules: List[CandidateRule] = []
+
+    for action in sorted({action for action in features.action if action is not None}):
+        rows = features.action == action
+        failed = ~features.success[rows]
+        # 成功例がほとんどない行動では「成功を含まない」ことが根拠にならないので学習しない
+        if failed.sum() < min_support or (~failed).sum() < min_support:
+            continue
+
+        # 行動に必要な引数が揃っている特徴だけを使う
+        usable = [j for j, feature in enumerate(FEATURES)
+                  if all(features.args[key][rows].all() for key in feature.args)]
+        if not usable:
+            continue
+        values = matrix[rows][:, usable]
+        literals: List[Literal] = ([(FEATURES[j].name, True) for j in usable]
+                                   + [(FEATURES[j].name, False) for j in usable])
+        lits = np.concatenate([values, ~values], axis=1)
+        succeeded_lits = lits[~failed].astype(np.int32)
+        single_succ = succeeded_lits.sum(axis=0)
+        pair_succ = succeeded_lits.T @ succeeded_lits if max_literals >= 2 else None
+
+        uncovered = failed.copy()
+        for _ in range(max_rules_per_action):
+            uncovered_lits = lits[uncovered].astype(np.int32)
+            single = np.where(single_succ == 0, uncovered_lits.sum(axis=0), 0)
+            best_count, best = int(single.max(initial=0)), None
+            if best_count > 0:
+                best = (int(single.argmax()),)
+            if pair_succ is not None:
+                pair = np.where(pair_succ == 0, uncovered_lits.T @ uncovered_lits, 0)
+                np.fill_diagonal(pair, 0)
+                i, j = np.unravel_index(int(pair.argmax()), pair.shape)
+                if pair[i, j] > best_count:
+                    best_count, best = int(pair[i, j]), (int(i), int(j))
+            if best is None or best_count < min_support:
+                break
+
+            covered = np.logical_and.reduce([lits[:, k] for k in best])
+            rules.append(CandidateRule(action, [literals[k] for k in best],
+                                       int((covered & failed).sum()), int(failed.sum())))
+            uncovered &= ~covered
+            if not uncovered.any():
+                break
+    return rules
+
+
+def residual_steps(features: TransitionFeatures, rules: Sequence[CandidateRule], task_id: str,
+                   steps: Sequence[str]) -> List[str]:
+    """steps (task_id の D_inc のステップ番号) のうち、rules のどれも失敗を予測しない (説明できない) もの。"""
+    covered = np.zeros(features.n, dtype=bool)
+    for rule in rules:
+        covered |= rule.covers(features)
+    own = features.task == task_id
+    return [step for step in steps if not covered[own & (features.step == str(step))].any()]
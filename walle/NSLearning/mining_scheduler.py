@@ -0,0 +1,155 @@
+"""
+ActionRules のルールマイニングのスケジューラ。
+
+従来は毎ステップ、直近 k=3 遷移の状態全体 (indent=4 の JSON) を generate_ActionRules と
+generate_ActionRulesImprove の 2 回の呼び出しに埋め込んでおり、連続する呼び出しで 3 遷移中 2 遷移が重複していた。
+MiningScheduler はタスクごとに
+
+- 新しい D_inc (予測を外した遷移) が出たステップだけマイニングを行う
+- 直近 k 遷移のうち、まだ LLM に送っていない遷移だけを送る
+- 2 件目以降の遷移の状態は、1 つ前の遷移の状態からの差分 (state_delta) にする
+
+を行う。new_nslearning.py は新しい D_inc が出たステップと full_every ステップごとの定期実行のときだけ
+LLM を使う学習を行い、それ以外のステップでは新しい D_cor で選定済みルールを検証し直すだけにする。
+マイニング自体は ActionRules.generate_ActionRulesImprove の 1 回の呼び出しで
+(既存の final_rules の検証・修正と新しいルールの追加を同時に) 行う。
+
+使用例:
+    scheduler = mining_scheduler_for(task_name, real_trajectory)
+    if scheduler.should_mine(D_inc):
+        transitions = scheduler.window(real_trajectory, k)
+        improve_ar = AR.generate_ActionRulesImprove(transitions, existing_rules, input_dir,
+                                                    transitions_note=TRANSITIONS_NOTE, compact=True)
+        scheduler.mark_sent(transitions, D_inc, real_trajectory)
+"""
+import json
+from typing import Dict, List, Set
+
+from utils.state_encoder import count_tokens, dumps_compact, state_delta
+
+TRANSITIONS_NOTE = (
+    "Only the first transition gives the full 'state'. Each following transition gives 'state_delta': "
+    "the fields of 'state' that changed since the previous transition ('changed' maps dotted paths to new values, "
+    "'removed' lists dotted paths that no longer exist)."
+)
+
+
+class MiningScheduler:
+    """
+    タスクごとのマイニングの状態。呼び出しをまたいで保持する。
+    """
+
+    def __init__(self, trajectory_id: int):
+        self.trajectory_id = trajectory_id   # 対象の実軌跡 (dict) の id
+        self.length = 0                      # 前回の呼び出しでの実軌跡の遷移数
+        self.seen_inc: Set[str] = set()      # マイニングのきっかけとして処理済みの D_inc のステップ番号
+        self.sent_steps: Set[int] = set()    # LLM に送った遷移のステップ番号
+        self.validated_cor: Set[str] = set() # 選定済みルールの Validity Check に使った D_cor のステップ番号
+        self.steps_since_full = 0            # 最後に学習全体 (マイニング〜ルール選定) を行ってからのステップ数
+        self.mined = 0
+        self.skipped = 0
+        self.sent_tokens = 0
+        self.full_tokens = 0
+
+    def should_mine(self, D_inc: Dict[str, Dict]) -> bool:
+        """まだマイニングに使っていない D_inc の遷移があれば True。"""
+        new_steps = self.new_inc_steps(D_inc)
+        if new_steps:
+            self.mined += 1
+        else:
+            self.skipped += 1
+        return bool(new_steps)
+
+    def new_inc_steps(self, D_inc: Dict[str, Dict]) -> List[str]:
+        """まだマイニングに使っていない D_inc のステップ番号。"""
+        return sorted(set(D_inc) - self.seen_inc, key=int)
+
+    def full_run_due(self, full_every: int = 0) -> bool:
+        """
+        呼び出しごとに 1 ステップ進め、full_every ステップ学習全体を行っていなければ True。
+        full_every が 0 なら常に False (新しい D_inc のときだけ学習する)。
+        """
+        self.steps_since_full += 1
+        return bool(full_every) and self.steps_since_full >= full_every
+
+    def mark_full_run(self, D_cor: Dict[str, Dict]) -> None:
+        """学習全体を行った (ルール選定で D_cor 全体を検証した) ことを記録する。"""
+        self.steps_since_full = 0
+        self.validated_cor.update(D_cor)
+
+    def new_cor_steps(self, D_cor: Dict[str, Dict]) -> List[str]:
+        """選定済みルールでまだ検証していない D_cor のステップ番号 (処理済みにする)。"""
+        steps = sorted(set(D_cor) - self.validated_cor, key=int)
+        self.validated_cor.update(steps)
+        return steps
+
+    def window(self, trajectory: Dict, k: int) -> List[Dict]:
+        """
+        直近 k 遷移のうち未送信のものを、プロンプト用の形式にしたリスト。
+        各要素: {"step", "state" | "state_delta", "action", "action_result"}
+        """
+        last = _count_transitions(trajectory) - 1
+        steps = [i for i in range(max(0, last - k + 1), last + 1) if i not in self.sent_steps]
+
+        transitions = []
+        previous_state = None
+        for i in steps:
+            state = trajectory.get(f"state_{i}", {})
+            transition = {"step": i}
+            if previous_state is None:
+                transition["state"] = state
+            else:
+                transition["state_delta"] = state_delta(previous_state, state)
+            transition["action"] = trajectory.get(f"action_{i}", {})
+            transition["action_result"] = trajectory.get(f"action_result_{i}", {})
+            transitions.append(transition)
+            previous_state = state
+        return transitions
+
+    def mark_sent(self, transitions: List[Dict], D_inc: Dict[str, Dict] = (), trajectory: Dict = None) -> None:
+        """
+        マイニングに成功した後に呼び、送った遷移ときっかけになった D_inc を処理済みにする
+        (失敗した場合は呼ばないので、次のステップでもう一度マイニングする)。
+        trajectory を渡すと従来形式 (状態全体) と比べたトークン数も集計する。
+        """
+        self.seen_inc.update(D_inc)
+        self.sent_steps.update(t["step"] for t in transitions if "step" in t)
+        self.sent_tokens += count_tokens(dumps_compact(transitions))
+        if trajectory is not None:
+            full = {}
+            for t in transitions:
+                if "step" not in t:
+                    continue
+                for key in ("state", "action", "action_result"):
+                    full[f"{key}_{t['step']}"] = trajectory.get(f"{key}_{t['step']}", {})
+            self.full_tokens += count_tokens(json.dumps(full, indent=4, ensure_ascii=False))
+
+    def summary(self) -> str:
+        return (f"mined={self.mined} skipped={self.skipped} steps_since_full={self.steps_since_full} "
+                f"sent_transitions={len(self.sent_steps)} transition_tokens={self.sent_tokens}"
+                + (f" (full: {self.full_tokens})" if self.full_tokens else ""))
+
+
+def _count_transitions(trajectory: Dict) -> int:
+    index = 0
+    while f"state_{index}" in trajectory:
+        index += 1
+    return index
+
+
+# task_name -> MiningScheduler
+_schedulers: Dict[str, MiningScheduler] = {}
+
+
+def mining_scheduler_for(task_name: str, trajectory: Dict) -> MiningScheduler:
+    """
+    タスクのスケジューラ。別の軌跡 (同名タスクの新しいエピソード) が渡された場合や
+    軌跡が短くなった場合は作り直す (GC 後に id が使い回されても、新しいエピソードは最初のステップから始まり前回より短いので区別できる)。
+    """
+    scheduler = _schedulers.get(task_name)
+    length = _count_transitions(trajectory)
+    if scheduler is None or scheduler.trajectory_id != id(trajectory) or length < scheduler.length:
+        scheduler = MiningScheduler(id(trajectory))
+        _schedulers[task_name] = scheduler
+    scheduler.length = length
+    return scheduler
@@ -129,7 +129,7 @@ and an array of rules:
         except openai.RateLimitError:
             print("[ActionRules] OpenAI API rate limit exceeded. Waiting 5 seconds...")
             time.sleep(5)
-            return self.generate_ActionRules(transitions_data)
+            return self.generate_ActionRules(transitions_data, input_dir, All_AR_dir)
 
         except openai.APIStatusError as e:
             print(f"[ActionRules] OpenAI API status error: {e.status_code} - {e.response}")
@@ -141,7 +141,11 @@ and an array of rules:
             print(f"An unexpected error occurred: {e}")
     
 
-    def generate_ActionRulesImprove(self, transitions_data, existing_rules, input_dir):
+    def generate_ActionRulesImprove(self, transitions_data, existing_rules, input_dir, transitions_note: str = "", compact: bool = False):
+        """
+        transitions_note: 遷移の形式の説明 (差分形式の遷移を渡す場合など)。transitions の前に入れる
+        compact: True なら遷移とルールをインデントなしの JSON で埋め込む (mining_scheduler.py)
+        """
        
         if self.client is None:
             print("[ActionRules] Error: OpenAI client is not available. Cannot generate action.")
@@ -151,10 +155,11 @@ and an array of rules:
             existing_rules = []
 
         # 変換された遷移データをJSON文字列に変換（インデント付きで可読性高く）
-        transitions_json_str = json.dumps(transitions_data, indent=4, ensure_ascii=False)
+        indent = None if compact else 4
+        transitions_json_str = json.dumps(transitions_data, indent=indent, ensure_ascii=False)
         
         # 既存のルールをJSON文字列に変換
-        existing_rules_json_str = json.dumps(existing_rules, indent=4, ensure_ascii=False)
+        existing_rules_json_str = json.dumps(existing_rules, indent=indent, ensure_ascii=False)
             
         # プロンプト ===================================================================
         system_prompt = textwrap.dedent("""
@@ -261,6 +266,8 @@ Instructions:
 My information is as follows: 
 transitions：
         """)
+        if transitions_note:
+            header = header.rstrip("\n") + "\n" + transitions_note + "\n"
 
         footer = textwrap.dedent(f"""
 given rules：
@@ -309,7 +316,7 @@ given rules：
         except openai.RateLimitError:
             print("[ActionRules] OpenAI API rate limit exceeded. Waiting 5 seconds...")
             time.sleep(5)
-            return self.generate_ActionRulesImprove(transitions_data)
+            return self.generate_ActionRulesImprove(transitions_data, existing_rules, input_dir, transitions_note, compact)
 
         except openai.APIStatusError as e:
             print(f"[ActionRules] OpenAI API status error: {e.status_code} - {e.response}")
@@ -1,3 +1,4 @@
+import atexit
 import json
 from openai import OpenAI
 import matplotlib.pyplot as plt
@@ -7,8 +8,9 @@ import re
 import importlib.util
 import sys
 import ast
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 
+import numpy as np
 
 from .stage1 import *
 from .new_action_rules import *
@@ -16,12 +18,24 @@ from .new_knowledge_graph import *
 from .new_scene_graph import *
 from .stage3 import *
 from .stage4 import *
+from .rule_registry import get_rule_registry
+from .corpus_store import CorpusStore
+from .transition_table import StoreTable
+from .transition_index import SIMILAR_TRANSITIONS_NOTE, TransitionIndex
+from .feature_miner import TransitionFeatures, mine_failure_rules, residual_steps
+from .rule_verifier import recent_entries, sample_transitions
+from .mining_scheduler import TRANSITIONS_NOTE, mining_scheduler_for
+from .translation_cache import TranslationCache, normalize_rule_text, rule_number
+from utils.state_encoder import CompactStateEncoder
 
 from networkx.readwrite import json_graph
 from filelock import FileLock
 
 
-def New_NSLearning(real_trajectory, predicted_trajectory, scene_graph, outdir, task_name):
+def New_NSLearning(real_trajectory, predicted_trajectory, scene_graph, outdir, task_name, full_every: int = 0):
+    """
+    full_every: 新しい D_inc がなくても学習全体 (マイニング〜ルール選定) を行う間隔 (ステップ数)。0 なら行わない
+    """
     coderule_dir = os.path.join(outdir, "CodeRule")
     os.makedirs(coderule_dir, exist_ok=True)
 
@@ -35,35 +49,34 @@ def New_NSLearning(real_trajectory, predicted_trajectory, scene_graph, outdir, t
     # RealTrajectory t-k:k
     # ====================================================================================================
     k = 3
-    TopK_real_trajectory = get_recent_history_dict(real_trajectory, k)
     # ====================================================================================================
 
     # Stage1
     # ====================================================================================================
-    # 既存D_incorrectのパス
+    # D_cor_all / D_inc_all はメモリマップ型のコーパスストアに保存する (corpus_store.py)
+    # 初回は従来の JSON から移行する
     D_inc_all_path = os.path.join("CodeRule", "D_inc_all.json")
-    os.makedirs(os.path.dirname(D_inc_all_path), exist_ok=True)
-    all_inc_list_existing = []
-    if os.path.exists(D_inc_all_path) and os.path.getsize(D_inc_all_path) > 0:
-        with open(D_inc_all_path, "r", encoding="utf-8") as f:
-            try:
-                all_inc_list_existing = json.load(f)
-            except json.JSONDecodeError:
-                print("Warning: D_inc_all.json のパース失敗。新規リストで開始。")
-    
-    # 既存D_incorrectのパス
     D_cor_all_path = os.path.join("CodeRule", "D_cor_all.json")
     os.makedirs(os.path.dirname(D_cor_all_path), exist_ok=True)
-    all_cor_list_existing = []
-    if os.path.exists(D_cor_all_path) and os.path.getsize(D_cor_all_path) > 0:
-        with open(D_cor_all_path, "r", encoding="utf-8") as f:
-            try:
-                all_cor_list_existing = json.load(f)
-            except json.JSONDecodeError:
-                print("Warning: D_cor_all.json のパース失敗。新規リストで開始。")
-    
-    D_cor, D_inc, D_cor_all, D_inc_all = implement_stage1(
-        real_trajectory, predicted_trajectory, all_inc_list_existing, all_cor_list_existing, scene_graph, task_name)
+
+    with FileLock(D_cor_all_path + ".lock"), FileLock(D_inc_all_path + ".lock"):
+        # ストアと索引はプロセス内で使い回す (他プロセスの追記は shared() が取り込む)
+        cor_store = CorpusStore.shared(os.path.splitext(D_cor_all_path)[0], migrate_from=D_cor_all_path)
+        inc_store = CorpusStore.shared(os.path.splitext(D_inc_all_path)[0], migrate_from=D_inc_all_path)
+
+        D_cor, D_inc, D_cor_all, D_inc_all = implement_stage1(
+            real_trajectory, predicted_trajectory, inc_store, cor_store, scene_graph, task_name)
+
+        # 列指向のテーブル (ストアの隣に保存) に追加・置き換えられたエントリだけを取り込む
+        cor_table = StoreTable.shared(cor_store)
+        inc_table = StoreTable.shared(inc_store)
+
+    # 従来の JSON とテーブルは学習全体を行ったとき・プロセス終了時にだけ書き出す (save_corpus_checkpoint)
+    _checkpoint_targets[D_cor_all_path] = (cor_store, cor_table)
+    _checkpoint_targets[D_inc_all_path] = (inc_store, inc_table)
+
+    print(f"✅ all_D_cor ({len(D_cor_all)}件) を更新しました。")
+    print(f"✅ all_D_inc ({len(D_inc_all)}件) を更新しました。")
 
     # D_cor の保存 
     Dcor_file_name = os.path.join(check_dir, "D_cor.json")
@@ -79,24 +92,18 @@ def New_NSLearning(real_trajectory, predicted_trajectory, scene_graph, outdir, t
         with open(Dinc_file_name, "w", encoding="utf-8") as f:
             json.dump(D_inc, f, indent=4, ensure_ascii=False)
     
-    # D_cor_all の保存
-    lock_path_all_cor = D_cor_all_path + ".lock"
-    with FileLock(lock_path_all_cor):
-        with open(D_cor_all_path, 'w', encoding="utf-8") as f:
-            json.dump(D_cor_all, f, indent=4, ensure_ascii=False) 
-
-    print(f"✅ all_D_cor.json ({len(D_cor_all)}件) を更新しました。")
-
-    # D_inc_all の保存
-    lock_path_all_inc = D_inc_all_path + ".lock"
-    with FileLock(lock_path_all_inc):
-        with open(D_inc_all_path, 'w', encoding="utf-8") as f:
-            json.dump(D_inc_all, f, indent=4, ensure_ascii=False) 
-    
-    print(f"✅ all_D_inc.json ({len(D_inc_all)}件) を更新しました。")
-
     # ====================================================================================================
 
+    # 新しい D_inc (予測を外した遷移) が出たとき・full_every ステップごとだけ LLM を使う学習を行う。
+    # それ以外のステップでは、新しい D_cor で選定済みのルールを検証し直すだけにする (mining_scheduler.py)
+    all_rules_path = "./CodeRule/all_code_rules.py"
+    scheduler = mining_scheduler_for(task_name, real_trajectory)
+    full_due = scheduler.full_run_due(full_every)
+    if not (scheduler.should_mine(D_inc) or full_due):
+        R_star = revalidate_selected_rules(cor_table, task_name, scheduler.new_cor_steps(D_cor), all_rules_path)
+        print(f"[NSLearning] 新しい D_inc なし: 学習をスキップ (選定済みルール {len(R_star)}件, {scheduler.summary()})")
+        return R_star
+
 
     # Stage2
     # ====================================================================================================
@@ -105,32 +112,60 @@ def New_NSLearning(real_trajectory, predicted_trajectory, scene_graph, outdir, t
     All_AR_file_name = os.path.join(All_AR_dir, "all_action_rules.json")
 
     # Action rules =======================================================================================
-    AR_file_name = os.path.join(output_dir, "action_rules.json")
     AR_imp_file_name = os.path.join(output_dir, "action_rules_improve.json")
     AR = ActionRules(model="gpt-4.1")
 
-    ar = AR.generate_ActionRules(TopK_real_trajectory, input_dir, All_AR_dir)
-    AR.save(AR_file_name, ar)
-    
-    improve_ar = AR.generate_ActionRulesImprove(TopK_real_trajectory, ar, input_dir)
-    AR.save(AR_imp_file_name, improve_ar)
+    existing_ar = {"final_rules": []}
+    if os.path.exists(All_AR_file_name):
+        with open(All_AR_file_name, "r", encoding="utf-8") as f:
+            existing_ar = json.load(f) or existing_ar
+
+    # 決まった形の失敗ルールはコーパス全体からローカルで学習し (feature_miner.py)、
+    # LLM にはそれで説明できない予測外れ (residual) だけを送る
+    new_inc = scheduler.new_inc_steps(D_inc)
+    local_rules, residual = mine_local_rules(inc_table, cor_table, task_name, new_inc, existing_ar.get("final_rules", []))
+
+    # 遷移をコンパクトな形式で送ってマイニングする。
+    # 既存ルールの検証・修正と新しいルールの追加は 1 回の呼び出しで行う (mining_scheduler.py)
+    # 予測を外した遷移があれば、直近 k 遷移の代わりに同じ種類の行動の似た過去の遷移を根拠にする (transition_index.py)
+    if residual:
+        transitions = similar_transitions(D_inc, residual, D_inc_all, D_cor_all, task_name)
+        note = SIMILAR_TRANSITIONS_NOTE
+    elif new_inc and not residual:
+        print(f"[Mining] 予測を外した遷移 {len(new_inc)}件はローカルで学習したルールで説明できるため LLM を使いません")
+        transitions = []
+    else:
+        transitions = scheduler.window(real_trajectory, k)
+        note = TRANSITIONS_NOTE
+    improve_ar = None
+    if transitions:
+        improve_ar = AR.generate_ActionRulesImprove(transitions, existing_ar.get("final_rules", []) + local_rules, input_dir,
+                                                    transitions_note=note, compact=True)
+    if improve_ar is not None and "final_rules" in improve_ar:
+        scheduler.mark_sent(transitions, D_inc, real_trajectory)
+    else:
+        if new_inc and not transitions:
+            scheduler.mark_sent([], D_inc)
+        improve_ar = dict(existing_ar)
+    improve_ar["final_rules"] = merge_rule_texts(improve_ar.get("final_rules", []), local_rules)
     AR.save(All_AR_file_name, improve_ar)
+    print(f"[Mining] {scheduler.summary()}")
+    AR.save(AR_imp_file_name, improve_ar)
 
     # stage3: コードルールの作成
     # ====================================================================================================
-    is_available_rule = False
-
     stage3 = STAGE3(model="gpt-4.1")
 
     with open(AR_imp_file_name, "r", encoding="utf-8") as f:
         action_rules = json.load(f)
     
-    count = 0
-    while not is_available_rule and count < 5:
-        print("コードルールリプランカウント:", count)
-        code_rule = stage3.generate_coderule(action_rules, input_dir)
-        is_available_rule = stage3.verify_code_rule_boolean(code_rule)
-        count += 1
+    # 検証用の遷移 (コーパスの直近分からアクションの種類ごとに数件ずつ)
+    verify_samples = sample_transitions([recent_entries(D_inc_all), recent_entries(D_cor_all)])
+
+    # ローカルで実行して検証し、通らなかった関数だけをエラー付きで作り直させる (最大5回)
+    code_rule = stage3.build_coderule(action_rules, input_dir, verify_samples, max_attempts=5)
+    if "def Rule_" not in code_rule:
+        code_rule = "# No valid code rules\n"
     
     CR_file_name = os.path.join(output_dir, "code_rules.py")
     stage3.save(CR_file_name, code_rule)
@@ -152,7 +187,6 @@ def New_NSLearning(real_trajectory, predicted_trajectory, scene_graph, outdir, t
     # --------------------------------------------------------------------------------------
 
     # 既存ルールのパス
-    all_rules_path = "./CodeRule/all_code_rules.py"
     os.makedirs(os.path.dirname(all_rules_path), exist_ok=True)
     # 既存ルールを読み込み
     existing_rules = []
@@ -170,30 +204,8 @@ def New_NSLearning(real_trajectory, predicted_trajectory, scene_graph, outdir, t
 
     # --------------------------------------------------------------------------------------
 
-    # 統合済み D_incをロード
-    merged_D_inc: Dict[str, Dict[str, Any]] = {}
-    for step_entry in D_inc_all: 
-        t_id = step_entry['task_id']
-        s_id = str(step_entry['step_id']) 
-        s_data = step_entry['step_data']
-        if t_id not in merged_D_inc:
-            merged_D_inc[t_id] = {}
-        merged_D_inc[t_id][s_id] = s_data
-    
-    # 統合済み D_corをロード
-    merged_D_cor: Dict[str, Dict[str, Any]] = {}
-    for step_entry in D_cor_all: 
-        t_id = step_entry['task_id']
-        s_id = str(step_entry['step_id']) 
-        s_data = step_entry['step_data']
-        if t_id not in merged_D_cor:
-            merged_D_cor[t_id] = {}
-        merged_D_cor[t_id][s_id] = s_data
-
-    # --------------------------------------------------------------------------------------
-
-    # 統合済み D_inc を使ってルール選定
-    R_star = greedy_rule_selection(merged_D_inc, merged_D_cor, merged_rules, 5, outdir)
+    # 統合済み D_inc / D_cor (ストアのテーブル) を使ってルール選定
+    R_star = greedy_rule_selection(inc_table, cor_table, merged_rules, 5, outdir)
 
     print("\n===選ばれたルール===")
     for rule in R_star:
@@ -201,6 +213,9 @@ def New_NSLearning(real_trajectory, predicted_trajectory, scene_graph, outdir, t
         print(f"  - {rule.__name__} (source: {'✓' if has_source else '✗'})")
     
     save_pruned_rules(R_star, all_rules_path)
+    scheduler.mark_full_run(D_cor)
+
+    save_corpus_checkpoint()
 
     return R_star
 
@@ -208,6 +223,29 @@ def New_NSLearning(real_trajectory, predicted_trajectory, scene_graph, outdir, t
 
     
 
+# {D_*_all.json のパス: (コーパスストア, テーブル)} と、最後に書き出したときの .dat のサイズ
+_checkpoint_targets: Dict[str, Tuple[CorpusStore, StoreTable]] = {}
+_exported_sizes: Dict[str, int] = {}
+
+
+def save_corpus_checkpoint():
+    """
+    コーパスストアを従来の D_*_all.json に書き出し (エントリの JSON をそのままつなぐだけでパースしない)、
+    列指向のテーブルを保存する。前回から変わっていないストアは書き出さない。
+    次のプロセスはテーブルをメモリマップで開いて差分だけを取り込む。
+    """
+    for json_path, (store, table) in _checkpoint_targets.items():
+        with FileLock(json_path + ".lock"):
+            size = os.path.getsize(store.dat_path)
+            if _exported_sizes.get(json_path) != size or not os.path.exists(json_path):
+                store.export_json(json_path)
+                _exported_sizes[json_path] = size
+            table.save()
+
+
+atexit.register(save_corpus_checkpoint)
+
+
 # 実軌跡の上位K件の辞書作成
 def get_recent_history_dict(data: dict, k: int) -> dict:
     """
@@ -290,6 +328,113 @@ def load_rules_from_file(filepath: str):
     return rules
 
 
+def similar_transitions(D_inc: Dict, steps: List[str], D_inc_all, D_cor_all, task_name: str,
+                        n_failed: int = 3, n_succeeded: int = 3) -> List[Dict]:
+    """
+    マイニングに送る遷移: 予測を外した遷移 (steps) と、それぞれと同じ種類の行動で状況の似た
+    過去の失敗 (D_inc_all) 最大 n_failed 件・成功 (D_cor_all) 最大 n_succeeded 件。
+    状態は行動に関係しない場所を縮約して送る。
+    """
+    index = TransitionIndex.shared()
+    index.sync(D_inc_all, "inc")
+    index.sync(D_cor_all, "cor")
+    stores = {"inc": D_inc_all, "cor": D_cor_all}
+    encoder = CompactStateEncoder(measure=False)
+
+    def compact(trans: Dict, source: str) -> Dict:
+        action = trans.get("action", {})
+        return {"source": source, "state": encoder.filter_state(trans.get("state", {}), action=action),
+                "action": action, "action_result": trans.get("action_result", {})}
+
+    transitions, chosen = [], set()
+    for step in steps:
+        trans = D_inc[step]
+        own = D_inc_all.index_of(task_name, int(step))
+        chosen.add(("inc", own))
+        transitions.append({"step": int(step), **compact(trans, "current")})
+        neighbours = (index.nearest(trans, n_failed, kind="inc", exclude=chosen)
+                      + index.nearest(trans, n_succeeded, kind="cor", exclude=chosen))
+        for score, key in neighbours:
+            chosen.add(key)
+            entry = stores[key[0]][key[1]]
+            transitions.append(compact(entry.get("step_data", entry), "failed" if key[0] == "inc" else "succeeded"))
+    print(f"[Mining] 予測を外した遷移 {len(steps)}件 + 似た過去の遷移 {len(transitions) - len(steps)}件")
+    return transitions
+
+
+def mine_local_rules(inc_table: StoreTable, cor_table: StoreTable, task_name: str, steps: List[str],
+                     final_rules: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    コーパス全体 (D_inc_all / D_cor_all のテーブル) から決まった形の失敗ルールを学習し (feature_miner.py)、
+    final_rules にないもののルール文と、steps (予測を外した遷移) のうち学習したルールで説明できないものを返す。
+    学習したルールのコードは STAGE3 の翻訳キャッシュに入れるので、LLM で翻訳し直さない。
+    """
+    features = TransitionFeatures([inc_table, cor_table])
+    candidates = mine_failure_rules(features)
+
+    known = {normalize_rule_text(rule) for rule in final_rules}
+    number = max([rule_number(rule) or 0 for rule in final_rules], default=0)
+    cache = TranslationCache()
+    texts = []
+    for candidate in candidates:
+        if normalize_rule_text(candidate.text(0)) in known:
+            continue
+        number += 1
+        text = candidate.text(number)
+        texts.append(text)
+        if cache.get(text) is None:
+            cache.put(text, candidate.function_name(number), candidate.source(number))
+    cache.save()
+
+    residual = residual_steps(features, candidates, task_name, steps)
+    print(f"[Mining] ローカルで学習したルール {len(candidates)}件 (新規 {len(texts)}件), "
+          f"説明できない予測外れ {len(residual)}/{len(steps)}件")
+    return texts, residual
+
+
+def merge_rule_texts(rules: List[str], extra: List[str]) -> List[str]:
+    """rules に extra を追加する (番号を除いて同じ内容のルールは追加しない)。"""
+    known = {normalize_rule_text(rule) for rule in rules}
+    return list(rules) + [rule for rule in extra if normalize_rule_text(rule) not in known]
+
+
+# 選定済みルール (all_code_rules.py) の読み込み結果 {パス: (mtime, ルール)}。ファイルが更新されたときだけ読み直す
+_selected_rules_cache: Dict[str, Tuple[float, List]] = {}
+
+
+def load_selected_rules(filepath: str):
+    """選定済みルールを読み込む (前回から更新がなければ読み込み済みの関数を返す)。"""
+    if not os.path.exists(filepath):
+        return []
+    mtime = os.path.getmtime(filepath)
+    cached = _selected_rules_cache.get(filepath)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, load_rules_from_file(filepath))
+        _selected_rules_cache[filepath] = cached
+    return cached[1]
+
+
+def revalidate_selected_rules(cor_table: StoreTable, task_name: str, steps: List[str], filepath: str):
+    """
+    学習をスキップするステップの増分更新。新しく D_cor に入った遷移 (steps) で選定済みルールの
+    Validity Check だけを行い、成功事例を『失敗』と予測したルールを外して保存し直す。
+    遷移は D_cor のテーブルの該当行だけをストアから読む。
+    """
+    rules = load_selected_rules(filepath)
+    if not rules or not steps:
+        return rules
+
+    step_ids = [cor_table.lookup(str(step)) for step in steps]
+    rows = np.nonzero((cor_table.task == cor_table.lookup(task_name)) & np.isin(cor_table.step, step_ids))[0]
+
+    valid, removed = revalidate_rules(rules, cor_table, rows)
+    if removed:
+        print(f"[NSLearning] 新しい D_cor で無効になったルールを外します: {[rule.__name__ for rule in removed]}")
+        save_pruned_rules(valid, filepath)
+        _selected_rules_cache[filepath] = (os.path.getmtime(filepath), valid)
+    return valid
+
+
 def save_pruned_rules(R_star, filepath):
     """
     選択されたルールを保存（関数に保存されたソースコードを使用）
@@ -325,18 +470,9 @@ def merge_rules(past_rules, new_rules):
     """
     過去のルールと新規ルールを統合し、重複を除去する
     関数名が同じ場合は新規ルールを優先する
+    関数名が違っても正規化 AST が同じルール (番号違いの同一ルール) は 1 つにまとめる (rule_registry.py)
     """
-    # 過去ルールの関数名セットを作成
-    past_rule_names = {rule.__name__ for rule in past_rules}
-    
-    # 新規ルールの関数名セットを作成
-    new_rule_names = {rule.__name__ for rule in new_rules}
-    
-    # 重複していない過去ルールを抽出
-    unique_past_rules = [rule for rule in past_rules if rule.__name__ not in new_rule_names]
-    
-    # 過去ルール(重複除外) + 新規ルールを結合
-    combined_rules = unique_past_rules + new_rules
+    combined_rules = get_rule_registry().merge(past_rules, new_rules)
     
     print(f"\n過去ルール: {len(past_rules)}件")
     print(f"新規ルール: {len(new_rules)}件")
@@ -0,0 +1,613 @@
+"""
+コードルール (Rule_*) を列指向の述語 IR に変換し、コーパス全体をまとめて評価する。
+
+STAGE3 が生成するルールの多くは次のような単純なチェックの組み合わせでできている:
+    action.get("action_name") != "goto"
+    state["current_position"]["location_name"] == recep
+    state["item_in_hand"]["item_name"] == obj
+    obj in state["items_in_locations"][recep]["items"]
+    state["items_in_locations"][recep].get("status") == "closed"
+
+この範囲のルールを AST から IR (タプルの木) に落とし、列指向の遷移テーブル (TransitionTable) に対する
+数回の比較演算で全遷移の success を一度に求める。範囲外の構文を含むルールは元の Python 関数で 1 件ずつ評価する。
+
+IR は KeyError 以外の例外 (item_in_hand が None のときの TypeError、@state / @args 以外の入れ子の
+キー欠落など) を表さないため、ルールごとに一度だけ、行動の種類ごとに数行ずつ取った行 (最大 VERIFY_ROWS 行)
+で元の関数と突き合わせる。一致しなければ、そのルールは以後 Python で評価する。
+一致したルールは、以後 _Translator が受け付けた構文の範囲で IR を信用し、元の関数は実行しない。
+
+使用例:
+    table = TransitionTable.from_transitions(transitions)
+    compiled = compile_rule(Rule_22_put)
+    success, errors = compiled.evaluate(table)
+"""
+import ast
+import textwrap
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from utils.logger import get_logger
+from .rule_registry import rule_hash, rule_source
+from .transition_table import LIST_KINDS, STATE_KEYS, StoreTable, TransitionTable
+
+logger = get_logger(__name__)
+
+# state のトップレベルキー → 参照の種類
+_STATE_REFS = {
+    "current_position": "@position",
+    "item_in_hand": "@hand",
+    "items_in_locations": "@locations",
+}
+_MESSAGE_NAMES = {"feedback", "suggestion", "msg", "message", "reason"}
+
+
+class UnsupportedRule(Exception):
+    """IR に変換できない構文を含むルール。"""
+
+
+# ============================================================
+# AST -> IR
+# ============================================================
+#
+# 項 (行ごとの id):    ("action",) ("arg", key) ("pos",) ("pos_status",) ("hand",) ("hand_status",)
+#                      ("const", value) ("loc_status", loc) ("select", cond, a, b)
+# リスト:              ("loc_list", loc, kind) ("reachable",) ("const_list", (values...)) ("select_list", cond, a, b)
+# 述語 (行ごとの bool): ("true",) ("false",) ("eq", a, b) ("not", p) ("and", p, ...) ("or", p, ...)
+#                      ("member", term, list) ("has_loc", loc) ("state_has", key)
+# 判定木:              ("ret", pred) ("if", pred, then, else)
+# ルール全体:          ("rule", 判定木, エラー条件)
+#
+# エラー条件は、Python では KeyError になる添字アクセス (action["args"]["obj"] で obj がない、
+# state["items_in_locations"][loc] で loc がない等) が実行される行を表す述語。
+# "@state" などの参照は変換途中でだけ使う (辞書アクセスの途中段階)。
+
+_TRUE = ("true",)
+_FALSE = ("false",)
+_NONE = ("const", None)
+_EMPTY = ("const", "")
+
+
+def _is_message_expr(node: ast.AST) -> bool:
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return True
+    if isinstance(node, ast.JoinedStr):
+        return True
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        return _is_message_expr(node.left) or _is_message_expr(node.right)
+    return False
+
+
+def _kind(value) -> str:
+    tag = value[0]
+    if tag.startswith("@"):
+        return "ref"
+    if tag in ("loc_list", "reachable", "const_list", "select_list"):
+        return "list"
+    if tag in ("true", "false", "eq", "not", "and", "or", "member", "has_loc", "has_arg", "state_has"):
+        return "pred"
+    if tag == "msg":
+        return "msg"
+    return "term"
+
+
+def _not(pred):
+    if pred == _TRUE:
+        return _FALSE
+    if pred == _FALSE:
+        return _TRUE
+    if pred[0] == "not":
+        return pred[1]
+    return ("not", pred)
+
+
+def _and(*preds):
+    if any(p == _FALSE for p in preds):
+        return _FALSE
+    preds = tuple(p for p in preds if p != _TRUE)
+    if not preds:
+        return _TRUE
+    return preds[0] if len(preds) == 1 else ("and",) + preds
+
+
+def _or(*preds):
+    if any(p == _TRUE for p in preds):
+        return _TRUE
+    preds = tuple(p for p in preds if p != _FALSE)
+    if not preds:
+        return _FALSE
+    return preds[0] if len(preds) == 1 else ("or",) + preds
+
+
+def _member(term, lst):
+    if lst[0] == "select_list":
+        _, cond, a, b = lst
+        return _or(_and(cond, _member(term, a)), _and(_not(cond), _member(term, b)))
+    if lst[0] == "const_list":
+        return _or(*[("eq", term, ("const", v)) for v in lst[1]])
+    return ("member", term, lst)
+
+
+class _Translator:
+    """1 つのルール関数を判定木に変換する。"""
+
+    def __init__(self, func: ast.FunctionDef):
+        params = [a.arg for a in func.args.args]
+        if len(params) != 3 or func.args.vararg or func.args.kwarg:
+            raise UnsupportedRule("signature is not (state, action, scene_graph)")
+        self.func = func
+        self.base_env = {params[0]: ("@state",), params[1]: ("@action",), params[2]: ("@scene_graph",)}
+        self.guard = _TRUE     # 現在の式が評価される行の条件
+        self.errors = []       # KeyError になる行の条件
+
+    def translate(self):
+        decision = self.block(self.func.body, dict(self.base_env))
+        return ("rule", decision, _or(*self.errors))
+
+    def guarded(self, guard, func, *args):
+        saved = self.guard
+        self.guard = guard
+        try:
+            return func(*args)
+        finally:
+            self.guard = saved
+
+    def strict(self, missing) -> None:
+        """添字アクセスが KeyError になる条件を、現在のガード付きで記録する。"""
+        error = _and(self.guard, missing)
+        if error != _FALSE:
+            self.errors.append(error)
+
+    # --- 文 ---------------------------------------------------------
+
+    def block(self, stmts: List[ast.stmt], env: Dict):
+        for i, stmt in enumerate(stmts):
+            rest = stmts[i + 1:]
+            if isinstance(stmt, ast.Pass):
+                continue
+            if isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant):
+                continue
+            if isinstance(stmt, ast.Assign):
+                self.assign(stmt, env)
+                continue
+            if isinstance(stmt, ast.Return):
+                return self.ret(stmt, env)
+            if isinstance(stmt, ast.If):
+                cond = self.pred(stmt.test, env)
+                if self.has_return(stmt.body) or self.has_return(stmt.orelse):
+                    guard = self.guard
+                    then = self.guarded(_and(guard, cond), self.block, stmt.body + rest, dict(env))
+                    other = self.guarded(_and(guard, _not(cond)), self.block, stmt.orelse + rest, dict(env))
+                    return then if cond == _TRUE else other if cond == _FALSE else ("if", cond, then, other)
+                self.conditional_assign(cond, stmt, env)
+                continue
+            raise UnsupportedRule(f"statement {type(stmt).__name__}")
+        raise UnsupportedRule("function may fall through without return")
+
+    def has_return(self, stmts: List[ast.stmt]) -> bool:
+        return any(isinstance(n, ast.Return) for stmt in stmts for n in ast.walk(stmt))
+
+    def assign(self, stmt: ast.Assign, env: Dict) -> None:
+        if len(stmt.targets) != 1 or not isinstance(stmt.targets[0], ast.Name):
+            raise UnsupportedRule("assignment target")
+        name = stmt.targets[0].id
+        if name in _MESSAGE_NAMES or _is_message_expr(stmt.value):
+            env[name] = ("msg",)
+        else:
+            env[name] = self.value(stmt.value, env)
+
+    def conditional_assign(self, cond, stmt: ast.If, env: Dict) -> None:
+        """if/else の中が代入だけの場合、代入された名前を select にする。"""
+        then_env, else_env = dict(env), dict(env)
+        guard = self.guard
+        self.guarded(_and(guard, cond), self.assign_block, stmt.body, then_env)
+        self.guarded(_and(guard, _not(cond)), self.assign_block, stmt.orelse, else_env)
+        for name in set(then_env) | set(else_env):
+            a, b = then_env.get(name), else_env.get(name)
+            if a == b:
+                env[name] = a
+                continue
+            if a is None or b is None:
+                raise UnsupportedRule(f"'{name}' is assigned in one branch only")
+            env[name] = self.select(cond, a, b)
+
+    def assign_block(self, stmts: List[ast.stmt], env: Dict) -> None:
+        for stmt in stmts:
+            if isinstance(stmt, ast.Assign):
+                self.assign(stmt, env)
+            elif isinstance(stmt, ast.If):
+                self.conditional_assign(self.pred(stmt.test, env), stmt, env)
+            elif isinstance(stmt, ast.Pass) or (isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant)):
+                continue
+            else:
+                raise UnsupportedRule(f"statement {type(stmt).__name__} inside conditional assignment")
+
+    def select(self, cond, a, b):
+        if cond == _TRUE:
+            return a
+        if cond == _FALSE:
+            return b
+        ka, kb = _kind(a), _kind(b)
+        if ka == "msg" and kb == "msg":
+            return a
+        if ka == kb == "term":
+            return ("select", cond, a, b)
+        if ka == kb == "list":
+            # adjacent = [] ; if loc in locations: adjacent = locations[loc]["adjacent"] の形は loc_list そのもの
+            if a[0] == "loc_list" and b == ("const_list", ()) and cond == ("has_loc", a[1]):
+                return a
+            return ("select_list", cond, a, b)
+        if ka == kb == "pred":
+            return _or(_and(cond, a), _and(_not(cond), b))
+        raise UnsupportedRule("conditional assignment of incompatible values")
+
+    def ret(self, stmt: ast.Return, env: Dict):
+        value = stmt.value
+        if not isinstance(value, ast.Tuple) or len(value.elts) != 3:
+            raise UnsupportedRule("return value is not a 3-tuple")
+        return ("ret", self.pred(value.elts[1], env))
+
+    # --- 式 ---------------------------------------------------------
+
+    def value(self, node: ast.AST, env: Dict):
+        """式を 項 / リスト / 述語 / 参照 のいずれかに変換する。"""
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, bool):
+                return _TRUE if node.value else _FALSE
+            if node.value is None or isinstance(node.value, str):
+                return ("const", node.value)
+            raise UnsupportedRule(f"constant {node.value!r}")
+        if isinstance(node, ast.Name):
+            if node.id not in env:
+                raise UnsupportedRule(f"free name '{node.id}'")
+            return env[node.id]
+        if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+            values = []
+            for elt in node.elts:
+                if not (isinstance(elt, ast.Constant) and (elt.value is None or isinstance(elt.value, str))):
+                    raise UnsupportedRule("non-constant list literal")
+                values.append(elt.value)
+            return ("const_list", tuple(values))
+        if isinstance(node, ast.Dict) and not node.keys:
+            return ("@empty",)
+        if isinstance(node, ast.Subscript):
+            return self.access(self.value(node.value, env), node.slice, env, strict=True)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "get" \
+                and not node.keywords and 1 <= len(node.args) <= 2:
+            base = self.value(node.func.value, env)
+            result = self.access(base, node.args[0], env)
+            if len(node.args) == 2:
+                self.check_default(result, self.value(node.args[1], env))
+            return result
+        if isinstance(node, ast.IfExp):
+            cond = self.pred(node.test, env)
+            body = self.guarded(_and(self.guard, cond), self.value, node.body, env)
+            orelse = self.guarded(_and(self.guard, _not(cond)), self.value, node.orelse, env)
+            return self.select(cond, body, orelse)
+        if isinstance(node, (ast.Compare, ast.BoolOp, ast.UnaryOp)):
+            return self.pred(node, env)
+        raise UnsupportedRule(f"expression {type(node).__name__}")
+
+    def check_default(self, result, default) -> None:
+        """.get(key, default) の default が、キー欠落時の IR の値と矛盾しないか確認する。"""
+        kind = _kind(result)
+        if kind == "ref" and default in (("@empty",), _NONE):
+            return
+        if kind == "list" and default in (("const_list", ()), _NONE):
+            return
+        if kind == "term" and default == _NONE:
+            return
+        raise UnsupportedRule("unsupported .get() default")
+
+    def access(self, base, key_node: ast.AST, env: Dict, strict: bool = False):
+        """
+        辞書アクセス base[key] / base.get(key) を変換する。
+        strict=True (添字アクセス) では、キーがない行をエラー条件に加える。
+        """
+        tag = base[0]
+        if tag == "@locations":
+            loc = self.value(key_node, env)
+            if _kind(loc) != "term":
+                raise UnsupportedRule("location key is not a term")
+            if strict:
+                self.strict(_not(("has_loc", loc)))
+            return ("@locinfo", loc)
+
+        if not (isinstance(key_node, ast.Constant) and isinstance(key_node.value, str)):
+            raise UnsupportedRule("non-constant key")
+        key = key_node.value
+        if strict:
+            if tag == "@state" and key in STATE_KEYS:
+                self.strict(_not(("state_has", key)))
+            elif tag == "@args":
+                self.strict(_not(("has_arg", key)))
+        if tag == "@state":
+            if key in _STATE_REFS:
+                return (_STATE_REFS[key],)
+            if key == "reachable_locations":
+                return ("reachable",)
+        elif tag == "@action":
+            if key == "action_name":
+                return ("action",)
+            if key == "args":
+                return ("@args",)
+        elif tag == "@args":
+            return ("arg", key)
+        elif tag == "@position":
+            if key == "location_name":
+                return ("pos",)
+            if key == "status":
+                return ("pos_status",)
+        elif tag == "@hand":
+            if key == "item_name":
+                return ("hand",)
+            if key == "status":
+                return ("hand_status",)
+        elif tag == "@locinfo":
+            if key in LIST_KINDS:
+                return ("loc_list", base[1], key)
+            if key == "status":
+                return ("loc_status", base[1])
+        raise UnsupportedRule(f"access {tag}[{key!r}]")
+
+    def pred(self, node: ast.AST, env: Dict):
+        if isinstance(node, ast.BoolOp):
+            # 短絡評価: 後ろのオペランドは前のオペランドが (and なら真 / or なら偽) の行でだけ評価される
+            is_and = isinstance(node.op, ast.And)
+            preds = []
+            guard = self.guard
+            for v in node.values:
+                preds.append(self.guarded(guard, self.pred, v, env))
+                guard = _and(guard, preds[-1] if is_and else _not(preds[-1]))
+            return _and(*preds) if is_and else _or(*preds)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return _not(self.pred(node.operand, env))
+        if isinstance(node, ast.Compare):
+            preds = []
+            left = node.left
+            for op, right in zip(node.ops, node.comparators):
+                preds.append(self.compare(left, op, right, env))
+                left = right
+            return _and(*preds)
+        return self.truthy(self.value(node, env))
+
+    def truthy(self, value):
+        kind = _kind(value)
+        if kind == "pred":
+            return value
+        if kind == "term":
+            # Python と同じく None と空文字列が偽
+            return _and(_not(("eq", value, _NONE)), _not(("eq", value, _EMPTY)))
+        if value[0] == "const_list":
+            return _TRUE if value[1] else _FALSE
+        raise UnsupportedRule(f"truth value of {value[0]}")
+
+    def compare(self, left_node, op, right_node, env: Dict):
+        if isinstance(op, (ast.In, ast.NotIn)):
+            item = self.value(left_node, env)
+            container = self.value(right_node, env)
+            if _kind(item) != "term":
+                raise UnsupportedRule("'in' with non-term operand")
+            if container == ("@locations",):
+                result = ("has_loc", item)
+            elif container == ("@state",) and item[0] == "const" and item[1] in STATE_KEYS:
+                result = ("state_has", item[1])
+            elif _kind(container) == "list":
+                result = _member(item, container)
+            else:
+                raise UnsupportedRule(f"'in' over {container[0]}")
+            return _not(result) if isinstance(op, ast.NotIn) else result
+
+        left, right = self.value(left_node, env), self.value(right_node, env)
+        if isinstance(op, (ast.Eq, ast.NotEq, ast.Is, ast.IsNot)):
+            if isinstance(op, (ast.Is, ast.IsNot)) and _NONE not in (left, right):
+                raise UnsupportedRule("'is' against non-None")
+            if _kind(left) != "term" or _kind(right) != "term":
+                raise UnsupportedRule("comparison of non-terms")
+            result = ("eq", left, right)
+            return _not(result) if isinstance(op, (ast.NotEq, ast.IsNot)) else result
+        raise UnsupportedRule(f"comparison {type(op).__name__}")
+
+
+def translate_rule(rule: Callable):
+    """
+    ルール関数を判定木 IR に変換する。対応範囲外なら UnsupportedRule を送出する。
+    """
+    source = rule_source(rule)
+    if not source:
+        raise UnsupportedRule("source is not available")
+    tree = ast.parse(textwrap.dedent(source))
+    func = next((n for n in tree.body if isinstance(n, ast.FunctionDef)), None)
+    if func is None:
+        raise UnsupportedRule("no function definition")
+    return _Translator(func).translate()
+
+
+# ============================================================
+# IR の評価
+# ============================================================
+
+def _eval_term(term, table: TransitionTable) -> np.ndarray:
+    tag = term[0]
+    if tag == "const":
+        return np.full(table.n, table.lookup(term[1]), dtype=np.int32)
+    if tag == "action":
+        return table.action
+    if tag == "arg":
+        return table.arg(term[1])
+    if tag == "pos":
+        return table.pos
+    if tag == "pos_status":
+        return table.pos_status
+    if tag == "hand":
+        return table.hand
+    if tag == "hand_status":
+        return table.hand_status
+    if tag == "loc_status":
+        return table.location_status(_eval_term(term[1], table))
+    if tag == "select":
+        return np.where(_eval_pred(term[1], table), _eval_term(term[2], table), _eval_term(term[3], table))
+    raise ValueError(f"unknown term {term!r}")
+
+
+def _eval_pred(pred, table: TransitionTable) -> np.ndarray:
+    tag = pred[0]
+    if tag == "true":
+        return np.ones(table.n, dtype=bool)
+    if tag == "false":
+        return np.zeros(table.n, dtype=bool)
+    if tag == "eq":
+        a, b = pred[1], pred[2]
+        if a[0] == "const" and b[0] == "const":
+            # 語彙にない定数同士 (どちらも UNKNOWN_ID) を等しいとみなさないよう値で比べる
+            return np.full(table.n, a[1] == b[1], dtype=bool)
+        return _eval_term(a, table) == _eval_term(b, table)
+    if tag == "not":
+        return ~_eval_pred(pred[1], table)
+    if tag == "and":
+        result = _eval_pred(pred[1], table)
+        for sub in pred[2:]:
+            result = result & _eval_pred(sub, table)
+        return result
+    if tag == "or":
+        result = _eval_pred(pred[1], table)
+        for sub in pred[2:]:
+            result = result | _eval_pred(sub, table)
+        return result
+    if tag == "has_loc":
+        return table.has_location(_eval_term(pred[1], table))
+    if tag == "state_has":
+        return table.state_has(pred[1])
+    if tag == "has_arg":
+        return table.has_arg(pred[1])
+    if tag == "member":
+        item = _eval_term(pred[1], table)
+        lst = pred[2]
+        if lst[0] == "loc_list":
+            return table.in_location_list(item, _eval_term(lst[1], table), lst[2])
+        if lst[0] == "reachable":
+            return table.in_reachable(item)
+    raise ValueError(f"unknown predicate {pred!r}")
+
+
+def _eval_decision(node, table: TransitionTable) -> np.ndarray:
+    if node[0] == "rule":
+        return _eval_decision(node[1], table)
+    if node[0] == "ret":
+        return _eval_pred(node[1], table)
+    _, cond, then, other = node
+    return np.where(_eval_pred(cond, table), _eval_decision(then, table), _eval_decision(other, table))
+
+
+# ============================================================
+# コンパイル済みルール
+# ============================================================
+
+# rule_hash -> IR (変換できなかった場合・検証で不一致だった場合は理由の文字列)
+_translation_cache: Dict[str, object] = {}
+# 元の関数と突き合わせて一致した rule_hash
+_verified_rules: Set[str] = set()
+
+# 突き合わせに使う行数 (行動の種類ごとに VERIFY_PER_ACTION 行まで)
+VERIFY_ROWS = 64
+VERIFY_PER_ACTION = 8
+
+
+def verification_rows(table: TransitionTable, per_action: int = VERIFY_PER_ACTION,
+                      limit: int = VERIFY_ROWS) -> np.ndarray:
+    """突き合わせに使う行 (行動の種類ごとに先頭から per_action 行、全体で limit 行まで)。"""
+    # StoreTable の置き換え前の行は transition() が今の内容を返すので使わない
+    candidates = table.live_rows() if isinstance(table, StoreTable) else table.rows()
+    if len(candidates) == 0:
+        return candidates
+    actions = np.asarray(table.action[candidates])
+    order = np.argsort(actions, kind="stable")
+    sorted_actions = actions[order]
+    first = np.searchsorted(sorted_actions, sorted_actions, side="left")
+    rank = np.arange(len(order)) - first
+    return np.sort(candidates[order[rank < per_action]])[:limit]
+
+
+class CompiledRule:
+    """
+    IR に変換できたルールは列に対してベクトル評価し、できなかったルールは元の関数で 1 件ずつ評価する。
+    IR は最初に評価するときに一度だけ、verification_rows() の行で元の関数と一致することを確かめる。
+    """
+
+    def __init__(self, rule: Callable, ir=None, reason: str = "", key: Optional[str] = None):
+        self.rule = rule
+        self.ir = ir
+        self.reason = reason
+        self.key = key or rule_hash(rule)
+
+    @property
+    def vectorized(self) -> bool:
+        return self.ir is not None
+
+    def evaluate(self, table: TransitionTable, start: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        start 行目以降の遷移に対するルールの success 予測と、実行エラーが起きた行を返す。
+        エラー行の success は True (stage4 の「カバーできていない」扱いに合わせる)。
+        """
+        if self.ir is None:
+            return evaluate_python(self.rule, [table.transition(i) for i in range(start, table.n)])
+
+        if self.key not in _verified_rules:
+            rows = verification_rows(table)
+            if len(rows):
+                success, errors = self._evaluate_ir(table.subset(rows))
+                expected, expected_errors = evaluate_python(self.rule, [table.transition(int(i)) for i in rows])
+                if not np.array_equal(success, expected) or not np.array_equal(errors, expected_errors):
+                    logger.debug("[rule_ir] %s: 元の関数と結果が一致しないため Python 評価に戻します", self.rule.__name__)
+                    self.ir = None
+                    self.reason = "verification mismatch"
+                    _translation_cache[self.key] = self.reason
+                    return self.evaluate(table, start)
+                _verified_rules.add(self.key)
+        return self._evaluate_ir(table if start == 0 else table.subset(np.arange(start, table.n)))
+
+    def _evaluate_ir(self, table: TransitionTable) -> Tuple[np.ndarray, np.ndarray]:
+        _, decision, error = self.ir
+        errors = _eval_pred(error, table)
+        return _eval_decision(decision, table) | errors, errors
+
+
+def evaluate_python(rule: Callable, transitions: List[Dict]) -> Tuple[np.ndarray, np.ndarray]:
+    """元のルール関数で 1 件ずつ評価する (IR の対象外のルール用)。"""
+    n = len(transitions)
+    success = np.ones(n, dtype=bool)
+    errors = np.zeros(n, dtype=bool)
+    for row, trans in enumerate(transitions):
+        try:
+            _, flag, _ = rule(trans.get("state", {}), trans.get("action", {}),
+                              trans.get("scene_graph", {"nodes": [], "edges": []}))
+            success[row] = flag is not False
+        except Exception:
+            errors[row] = True
+    return success, errors
+
+
+def compile_rule(rule: Callable) -> CompiledRule:
+    """
+    ルールを IR に変換する。変換できないルール・以前の検証で不一致だったルールは Python 評価になる。
+    """
+    key = rule_hash(rule)
+    cached = _translation_cache.get(key)
+    if cached is None:
+        try:
+            cached = translate_rule(rule)
+        except (UnsupportedRule, SyntaxError) as e:
+            cached = str(e) or type(e).__name__
+        _translation_cache[key] = cached
+
+    if isinstance(cached, str):
+        logger.debug("[rule_ir] %s: Python 評価 (%s)", rule.__name__, cached)
+        return CompiledRule(rule, reason=cached, key=key)
+    return CompiledRule(rule, ir=cached, key=key)
+
+
+def bool_to_bitset(values: np.ndarray) -> int:
+    """bool 配列を int のビット集合 (i ビット目 = values[i]) に変換する。"""
+    if len(values) == 0:
+        return 0
+    return int.from_bytes(np.packbits(values, bitorder="little").tobytes(), "little")
@@ -0,0 +1,212 @@
+"""
+コードルールの正規化 AST ハッシュによる重複排除。
+
+STAGE3 は Rule_61_put / Rule_2003_put のように番号だけ違う同一ルールを何度も生成する。
+ここでは各ルールの AST を正規化 (関数名・docstring・feedback/suggestion 文字列・ローカル変数名を除去) して
+ハッシュを取り、意味的に同じルールを 1 つにまとめてから stage4 に渡す。
+"""
+import ast
+import hashlib
+import inspect
+import textwrap
+from typing import Callable, Dict, List, Optional, Tuple
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# return (feedback, success, suggestion) のうち、判定に影響しない文字列の位置
+_MESSAGE_POSITIONS = (0, 2)
+_MESSAGE_NAMES = {"feedback", "suggestion", "msg", "message", "reason"}
+
+
+def _is_message_expr(node: ast.AST) -> bool:
+    """文字列リテラル / f-string / 文字列の連結なら True。"""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return True
+    if isinstance(node, ast.JoinedStr):
+        return True
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        return _is_message_expr(node.left) or _is_message_expr(node.right)
+    return False
+
+
+class _RuleCanonicalizer(ast.NodeTransformer):
+    """1 つのルール関数の AST を正規化する。"""
+
+    def __init__(self, local_names):
+        self.local_names = local_names
+        self.renames: Dict[str, str] = {}
+
+    def _rename(self, name: str) -> str:
+        if name not in self.local_names:
+            return name
+        if name not in self.renames:
+            self.renames[name] = f"v{len(self.renames)}"
+        return self.renames[name]
+
+    def visit_FunctionDef(self, node):
+        node.name = "Rule"
+        node.decorator_list = []
+        node.returns = None
+        body = node.body
+        if body and isinstance(body[0], ast.Expr) and isinstance(getattr(body[0], "value", None), ast.Constant) \
+                and isinstance(body[0].value.value, str):
+            body = body[1:] or [ast.Pass()]
+        node.body = body
+        self.generic_visit(node)
+        return node
+
+    def visit_arg(self, node):
+        node.arg = self._rename(node.arg)
+        node.annotation = None
+        return node
+
+    def visit_Name(self, node):
+        node.id = self._rename(node.id)
+        return node
+
+    def visit_Expr(self, node):
+        # 関数途中の文字列だけの式 (コメント代わりの docstring) は捨てる
+        if isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+            return None
+        return self.generic_visit(node)
+
+    def visit_Return(self, node):
+        if isinstance(node.value, ast.Tuple) and len(node.value.elts) == 3:
+            for pos in _MESSAGE_POSITIONS:
+                if _is_message_expr(node.value.elts[pos]):
+                    node.value.elts[pos] = ast.Constant(value="")
+        return self.generic_visit(node)
+
+    def visit_Assign(self, node):
+        if all(isinstance(t, ast.Name) and t.id in _MESSAGE_NAMES for t in node.targets) and _is_message_expr(node.value):
+            node.value = ast.Constant(value="")
+        return self.generic_visit(node)
+
+
+def _local_names(func_node: ast.FunctionDef) -> set:
+    names = {a.arg for a in func_node.args.posonlyargs + func_node.args.args + func_node.args.kwonlyargs}
+    if func_node.args.vararg:
+        names.add(func_node.args.vararg.arg)
+    if func_node.args.kwarg:
+        names.add(func_node.args.kwarg.arg)
+    for node in ast.walk(func_node):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+    return names
+
+
+def canonicalize_rule_source(source: str) -> str:
+    """
+    ルール関数のソースを正規化した AST ダンプを返す。
+    ソースに複数の定義がある場合は最初の関数定義だけを対象にする。
+    """
+    tree = ast.parse(textwrap.dedent(source))
+    func_node = next((n for n in tree.body if isinstance(n, ast.FunctionDef)), None)
+    if func_node is None:
+        return ast.dump(tree, annotate_fields=False, include_attributes=False)
+    func_node = _RuleCanonicalizer(_local_names(func_node)).visit(func_node)
+    return ast.dump(func_node, annotate_fields=False, include_attributes=False)
+
+
+def rule_source(rule: Callable) -> Optional[str]:
+    """load_rules_from_file が付与した __source_code__、なければ inspect で取得する。"""
+    source = getattr(rule, "__source_code__", None)
+    if source:
+        return source
+    try:
+        return inspect.getsource(rule)
+    except (OSError, TypeError):
+        return None
+
+
+def rule_hash(rule: Callable) -> str:
+    """
+    ルールの正規化 AST ハッシュ。関数に __rule_hash__ としてキャッシュする。
+    ソースが取れない/パースできない場合は関数名でハッシュする (重複排除されない)。
+    """
+    cached = getattr(rule, "__rule_hash__", None)
+    if cached:
+        return cached
+
+    source = rule_source(rule)
+    try:
+        key = canonicalize_rule_source(source) if source else f"name:{rule.__name__}"
+    except SyntaxError:
+        key = f"name:{rule.__name__}"
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    try:
+        rule.__rule_hash__ = digest
+    except AttributeError:
+        pass
+    return digest
+
+
+class RuleRegistry:
+    """
+    これまでに見たルールのハッシュ → 代表ルール の対応を保持する。
+    プロセス内で共有 (get_rule_registry) し、ステップをまたいで既知ルールを判別する。
+    """
+
+    def __init__(self):
+        self.by_hash: Dict[str, Callable] = {}
+
+    def __contains__(self, rule: Callable) -> bool:
+        return rule_hash(rule) in self.by_hash
+
+    def __len__(self) -> int:
+        return len(self.by_hash)
+
+    def register(self, rule: Callable) -> Tuple[Callable, bool]:
+        """
+        ルールを登録し、(代表ルール, 新規かどうか) を返す。
+        既知のハッシュなら、最初に登録されたルールが代表になる。
+        """
+        digest = rule_hash(rule)
+        if digest in self.by_hash:
+            return self.by_hash[digest], False
+        self.by_hash[digest] = rule
+        return rule, True
+
+    def dedupe(self, rules: List[Callable]) -> List[Callable]:
+        """順序を保ったまま、正規化 AST が同じルールを 1 つにまとめる。"""
+        seen = set()
+        unique = []
+        for rule in rules:
+            digest = rule_hash(rule)
+            if digest in seen:
+                continue
+            seen.add(digest)
+            unique.append(rule)
+        return unique
+
+    def merge(self, past_rules: List[Callable], new_rules: List[Callable]) -> List[Callable]:
+        """
+        過去ルールと新規ルールを統合する。
+        - 関数名が同じ場合は新規ルールを優先する (従来の merge_rules と同じ)
+        - 正規化 AST が同じルールは、先に現れたもの (過去ルール) を残す
+        """
+        new_rule_names = {rule.__name__ for rule in new_rules}
+        candidates = [rule for rule in past_rules if rule.__name__ not in new_rule_names] + list(new_rules)
+
+        merged = self.dedupe(candidates)
+
+        for rule in past_rules:
+            self.register(rule)
+        known = 0
+        for rule in new_rules:
+            _, is_new = self.register(rule)
+            if not is_new:
+                known += 1
+
+        logger.info("[RuleRegistry] 候補 %d件 -> 重複排除後 %d件 (新規ルールのうち既知: %d件)",
+                    len(candidates), len(merged), known)
+        return merged
+
+
+_registry = RuleRegistry()
+
+
+def get_rule_registry() -> RuleRegistry:
+    return _registry
@@ -0,0 +1,255 @@
+"""
+生成されたコードルールのローカル検証。
+
+STAGE3 が生成したコードを、LLM に「実行できるか」を聞く代わりに実際に実行して確かめる。
+
+0. 実行はワーカープロセスで行い、名前空間の builtins は制限する
+   (open / exec / eval などは使えず、import できるのは SAFE_MODULES だけ)。
+   ブロックごとに timeout 秒を超えたらワーカーを止め、そのルール (または import) だけを失敗にして
+   残りを新しいワーカーで続ける
+1. 独立した名前空間で、先頭の import / ヘルパを 1 つずつ exec してから Rule_* 関数を 1 つずつ exec する
+   (構文エラーや定義時のエラーはその関数だけの失敗になり、失敗した import は外される)
+2. 各 Rule_* 関数のシグネチャが (state, action, scene_graph) の 3 引数か確認する
+3. コーパスから取った遷移で各ルールを実行し、例外が出ないこと、戻り値が
+   (feedback, success, suggestion) のタプルで success が bool であることを確認する
+   (stage4 は `success is False` で判定するため、bool 以外は誤判定の元になる)
+
+結果はルールごとの pass/fail で返るので、壊れたルールだけを外せる。
+"""
+import builtins
+import contextlib
+import inspect
+import io
+import multiprocessing
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .translation_cache import assemble_code, split_rule_functions_lenient
+
+DEFAULT_SCENE_GRAPH = {"nodes": [], "edges": []}
+
+# コードルールが import してよいモジュール
+SAFE_MODULES = frozenset({
+    "re", "math", "json", "copy", "collections", "itertools", "functools", "operator", "string", "typing",
+})
+_BLOCKED_BUILTINS = frozenset({
+    "open", "exec", "eval", "compile", "input", "breakpoint", "exit", "quit", "help",
+    "globals", "locals", "vars", "memoryview", "__import__",
+})
+DEFAULT_TIMEOUT = 5.0
+
+
+def _step_data(entry: Dict) -> Dict:
+    return entry.get("step_data", entry)
+
+
+def sample_transitions(sources: Iterable[Iterable[Dict]], per_action: int = 4, limit: int = 64) -> List[Dict]:
+    """
+    コーパス (エントリまたは step_data のイテラブル) から、アクションの種類ごとに最大 per_action 件の
+    遷移を集める。ルールは自分のアクション以外は早期に True を返すことが多いので、種類ごとに取る。
+    """
+    by_action: Dict[str, List[Dict]] = {}
+    total = 0
+    for source in sources:
+        for entry in source:
+            trans = _step_data(entry)
+            if not isinstance(trans, dict) or "state" not in trans or "action" not in trans:
+                continue
+            bucket = by_action.setdefault(str(trans["action"].get("action_name")), [])
+            if len(bucket) >= per_action:
+                continue
+            bucket.append(trans)
+            total += 1
+            if total >= limit:
+                return [trans for bucket in by_action.values() for trans in bucket]
+    return [trans for bucket in by_action.values() for trans in bucket]
+
+
+def recent_entries(store, n: int = 200) -> Iterable[Dict]:
+    """CorpusStore などの末尾 n 件 (新しい順)。"""
+    for i in range(len(store) - 1, max(-1, len(store) - 1 - n), -1):
+        yield store[i]
+
+
+def _safe_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level != 0 or name.split(".")[0] not in SAFE_MODULES:
+        raise ImportError(f"import of '{name}' is not allowed in code rules")
+    return builtins.__import__(name, globals, locals, fromlist, level)
+
+
+def restricted_builtins() -> Dict:
+    """コードルールの検証に使う builtins (ファイル・動的実行を外し、import を SAFE_MODULES に限る)。"""
+    safe = {name: value for name, value in vars(builtins).items() if name not in _BLOCKED_BUILTINS}
+    safe["__import__"] = _safe_import
+    return safe
+
+
+def _check_signature(func) -> Optional[str]:
+    try:
+        params = list(inspect.signature(func).parameters.values())
+    except (TypeError, ValueError) as e:
+        return f"signature: {e}"
+    positional = [p for p in params if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)]
+    required = [p for p in positional if p.default is p.empty]
+    if len(required) > 3 or (len(positional) < 3 and not any(p.kind == p.VAR_POSITIONAL for p in params)):
+        return f"signature: expected (state, action, scene_graph), got ({', '.join(p.name for p in params)})"
+    return None
+
+
+def _check_result(result) -> Optional[str]:
+    if not isinstance(result, tuple) or len(result) != 3:
+        return f"return: expected (feedback, success, suggestion), got {type(result).__name__}"
+    if not isinstance(result[1], bool):
+        return f"return: success must be bool, got {type(result[1]).__name__}"
+    return None
+
+
+class RuleVerificationReport:
+    """verify_rule_code の結果。results は {関数名: {"passed", "error", "runs"}}。"""
+
+    def __init__(self, code: str):
+        self.code = code
+        self.prelude_errors: List[str] = []
+        self.results: Dict[str, Dict] = {}
+        self.prelude: List[str] = []
+        self.sources: Dict[str, str] = {}
+
+    @property
+    def passed(self) -> List[str]:
+        return [name for name, r in self.results.items() if r["passed"]]
+
+    @property
+    def failed(self) -> List[str]:
+        return [name for name, r in self.results.items() if not r["passed"]]
+
+    @property
+    def ok(self) -> bool:
+        """ルールが 1 つ以上あり、全て通ったか。"""
+        return bool(self.results) and not self.failed
+
+    def passing_sources(self) -> Dict[str, str]:
+        return {name: self.sources[name] for name in self.passed}
+
+    def passing_code(self) -> str:
+        """通ったルールだけを残したコード。"""
+        return assemble_code(self.prelude, list(self.passing_sources().values()))
+
+    def summary(self) -> str:
+        lines = [f"{len(self.passed)}/{len(self.results)} rules passed"]
+        for error in self.prelude_errors:
+            lines.append(f"  ✗ prelude: {error}")
+        for name in self.failed:
+            lines.append(f"  ✗ {name}: {self.results[name]['error']}")
+        return "\n".join(lines)
+
+
+def _run_prelude_block(namespace: Dict, block: str) -> Optional[str]:
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            exec(compile(block, "<code_rules_candidate>", "exec"), namespace)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    return None
+
+
+def _run_rule(namespace: Dict, name: str, source: str, runs: List[Dict], strict: bool) -> Dict:
+    """Rule_* 関数を 1 つ exec し、シグネチャと runs 上の実行を確認する。"""
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            exec(compile(source, f"<{name}>", "exec"), namespace)
+    except Exception as e:
+        return {"passed": False, "error": f"{type(e).__name__}: {e}", "runs": 0}
+    func = namespace.get(name)
+    error = _check_signature(func) if callable(func) else "not defined after exec"
+    count = 0
+    if error is None:
+        for trans in runs:
+            count += 1
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result = func(trans.get("state", {}), trans.get("action", {}),
+                                  trans.get("scene_graph", DEFAULT_SCENE_GRAPH))
+            except Exception as e:
+                # 空の状態での実行だけの場合は KeyError などを許す (stage4 でも同じ状態は来ない)
+                if strict:
+                    error = f"{type(e).__name__}: {e} (action={trans.get('action', {}).get('action_name')})"
+                    break
+                continue
+            error = _check_result(result)
+            if error is not None:
+                break
+    return {"passed": error is None, "error": error, "runs": count}
+
+
+def _worker(conn, prelude: List[str], jobs: List[Tuple], runs: List[Dict], strict: bool) -> None:
+    """
+    ワーカープロセス本体。prelude (通ったことが分かっている import / ヘルパ) を黙って exec してから、
+    jobs を 1 つずつ実行して結果を 1 件ずつ送る。
+    jobs: ("prelude", block) または ("rule", name, source)
+    """
+    namespace = {"__name__": "code_rules_candidate", "__builtins__": restricted_builtins()}
+    for block in prelude:
+        _run_prelude_block(namespace, block)
+    for job in jobs:
+        if job[0] == "prelude":
+            conn.send(_run_prelude_block(namespace, job[1]))
+        else:
+            conn.send(_run_rule(namespace, job[1], job[2], runs, strict))
+    conn.close()
+
+
+def verify_rule_code(code: str, samples: List[Dict] = (), timeout: float = DEFAULT_TIMEOUT) -> RuleVerificationReport:
+    """
+    コードをワーカープロセスの独立した名前空間で読み込み、各 Rule_* をシグネチャと samples 上の実行で検証する。
+    samples が空の場合はシグネチャと、空の状態での 1 回の実行だけを確認する。
+    timeout: import / ヘルパ 1 ブロック、またはルール 1 つ (全 samples の実行) にかける時間の上限 (秒)
+    """
+    report = RuleVerificationReport(code)
+    functions, prelude, broken = split_rule_functions_lenient(code)
+
+    for name, (source, error) in broken.items():
+        report.sources[name] = source
+        report.results[name] = {"passed": False, "error": error, "runs": 0}
+
+    runs = list(samples) or [{"state": {}, "action": {}, "scene_graph": DEFAULT_SCENE_GRAPH}]
+    pending: List[Tuple] = [("prelude", block) for block in prelude]
+    for name, source in functions.items():
+        report.sources[name] = source
+        pending.append(("rule", name, source))
+
+    # test.py / main.py は __main__ ガードなしで NSLearning を呼ぶので、使えるなら fork で起動する
+    # (spawn だと子プロセスでスクリプト全体が実行し直される)
+    ctx = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+    while pending:
+        receiver, sender = ctx.Pipe(duplex=False)
+        process = ctx.Process(target=_worker, args=(sender, list(report.prelude), pending, runs, bool(samples)),
+                              daemon=True)
+        process.start()
+        sender.close()
+        try:
+            while pending:
+                job = pending[0]
+                result, error = None, None
+                try:
+                    if receiver.poll(timeout):
+                        result = receiver.recv()
+                    else:
+                        error = f"timeout: exceeded {timeout:g}s"
+                except EOFError:
+                    process.join(1)
+                    error = f"worker exited (code {process.exitcode})"
+                pending.pop(0)
+                if job[0] == "prelude":
+                    if error is not None or result is not None:
+                        report.prelude_errors.append(error or result)
+                    else:
+                        report.prelude.append(job[1])
+                else:
+                    report.results[job[1]] = result if error is None else {"passed": False, "error": error, "runs": 0}
+                if error is not None:
+                    break   # 止まった / 落ちたワーカーは捨て、残りを新しいワーカーで続ける
+        finally:
+            receiver.close()
+            if process.is_alive():
+                process.kill()
+            process.join()
+    return report
@@ -1,109 +1,111 @@
 # stage1.py
 
-import json
-from typing import List, Dict, Any, Tuple
-import os
-import copy # deepcopy を使用
+from typing import List, Dict, Any, Tuple, Optional
+
+from .corpus_store import CorpusStore
+
+class Stage1State:
+    """
+    タスクごとの増分分類の状態。呼び出しをまたいで保持し、前回までに分類したステップは再分類しない。
+    """
+
+    def __init__(self, trajectory_id: int):
+        self.trajectory_id = trajectory_id   # 分類中の実軌跡 (dict) の id
+        self.next_step = 0                   # 次に分類するステップ番号
+        self.D_cor: Dict[str, Dict] = {}
+        self.D_inc: Dict[str, Dict] = {}
+
+
+# task_name -> Stage1State
+_stage1_states: Dict[str, Stage1State] = {}
+
+
+def _count_transitions(trajectory_dict: Dict, start: int = 0) -> int:
+    index = start
+    while f"state_{index}" in trajectory_dict:
+        index += 1
+    return index
+
 
 def implement_stage1(
     traj_real: Dict, 
     traj_pred: Dict, 
-    all_inc_list_existing: List[Dict[str, Any]], 
-    all_cor_list_existing: List[Dict[str, Any]],
+    inc_store: CorpusStore, 
+    cor_store: CorpusStore,
     scene_graph,
     task_name: str = "unknown_task"
-) -> Tuple[Dict, List[Dict], List[Dict]]: 
+) -> Tuple[Dict, Dict, CorpusStore, CorpusStore]: 
+    """
+    実軌跡と予測軌跡を比較して D_cor / D_inc に分類し、現在のタスクの遷移を
+    コーパスストア (D_cor_all / D_inc_all) に追加・更新する。
 
-    D_cor = {}
-    D_inc = {} 
-    D_cor_all_updated = copy.deepcopy(all_cor_list_existing)
-    D_inc_all_updated = copy.deepcopy(all_inc_list_existing)
-    
-    # --- マップ作成 ---
-    
-    # 失敗事例マップ
-    existing_steps_map_inc = {}
-    for index, entry in enumerate(D_inc_all_updated):
-        key = (entry.get('task_id'), entry.get('step_id'))
-        existing_steps_map_inc[key] = index 
-    
-    # 【修正1】成功事例マップ (参照先を D_cor_all_updated に修正)
-    existing_steps_map_cor = {}
-    for index, entry in enumerate(D_cor_all_updated): # ← ここを修正しました
-        key = (entry.get('task_id'), entry.get('step_id'))
-        existing_steps_map_cor[key] = index 
-
-    # グローバルIDのベース
-    global_id_base_inc = len(D_inc_all_updated) 
-    global_id_base_cor = len(D_cor_all_updated) # 分けたほうが安全です
-
-    real_transitions = extract_transitions(traj_real)
-    predicted_transitions = extract_transitions(traj_pred)
-    min_length = min(len(real_transitions), len(predicted_transitions))
-    
-    current_succ_count = 0
-    current_fail_count = 0
+    軌跡は 1 ステップずつ伸びるだけで過去の遷移は変わらないので、前回の呼び出し以降に
+    追加されたステップだけを分類する。別の軌跡 (同名タスクの新しいエピソード) が渡された場合や
+    軌跡が短くなった場合は、最初から分類し直す。
+    ストア全体は読み込まず、(task_id, step_id) の索引で既存エントリを探す。
+    """
+    state = _stage1_states.get(task_name)
+    if state is None or state.trajectory_id != id(traj_real) or _count_transitions(traj_real) < state.next_step:
+        state = Stage1State(id(traj_real))
+        _stage1_states[task_name] = state
 
-    for i in range(min_length):
-        real_transition = real_transitions[i]
-        predicted_transition = predicted_transitions[i]
+    min_length = min(_count_transitions(traj_real, state.next_step), _count_transitions(traj_pred, state.next_step))
+    real_transitions = extract_transitions(traj_real, start=state.next_step, stop=min_length)
+    predicted_transitions = extract_transitions(traj_pred, start=state.next_step, stop=min_length)
+    
+    appended = {"cor": 0, "inc": 0}
+    replaced = {"cor": 0, "inc": 0}
 
+    for i, real_transition, predicted_transition in zip(range(state.next_step, min_length), real_transitions, predicted_transitions):
         real_success = real_transition.get("action_result", {}).get("success", False)
         predicted_success = predicted_transition.get("action_result", {}).get("success", False)
         
-        current_step_id_tuple = (task_name, i) 
-
         # ---------------------------------------------------------------------
         # 成功/失敗の一致によって分類
         # ---------------------------------------------------------------------
         if real_success == predicted_success:
-            D_cor[str(i)] = real_transition
-            new_entry_data = copy.deepcopy(real_transition) 
-            
-            # 【重複チェック: 成功事例】
-            if current_step_id_tuple in existing_steps_map_cor:
-                index_to_update = existing_steps_map_cor[current_step_id_tuple]
-                D_cor_all_updated[index_to_update]['step_data'] = new_entry_data
-            else:
-                new_entry = {
-                    "global_id": global_id_base_cor + current_succ_count, 
-                    "task_id": task_name,
-                    "step_id": i, 
-                    "step_data": new_entry_data 
-                }
-                D_cor_all_updated.append(new_entry) 
-                current_succ_count += 1
-                
+            state.D_cor[str(i)] = real_transition
+            kind, store = "cor", cor_store
+        else:
+            state.D_inc[str(i)] = real_transition
+            kind, store = "inc", inc_store
+
+        # ストアには JSON として書き込まれるので、実軌跡の辞書は複製しない
+        # (シーングラフを足すために浅いコピーを 1 段だけ作る)
+        new_entry_data = attach_scene_graph(dict(real_transition), scene_graph, i)
+
+        # 【重複チェック】同じ (task_id, step_id) があれば置き換える
+        index_to_update = store.index_of(task_name, i)
+        if index_to_update is not None:
+            entry = store[index_to_update]
+            entry['step_data'] = new_entry_data
+            if store.replace(index_to_update, entry):
+                replaced[kind] += 1
         else:
-            D_inc[str(i)] = real_transition
-            new_entry_data = copy.deepcopy(real_transition) 
-            
-            # 【重複チェック: 失敗事例】
-            if current_step_id_tuple in existing_steps_map_inc:
-                index_to_update = existing_steps_map_inc[current_step_id_tuple]
-                D_inc_all_updated[index_to_update]['step_data'] = new_entry_data
-            else:
-                new_entry = {
-                    "global_id": global_id_base_inc + current_fail_count, 
-                    "task_id": task_name,
-                    "step_id": i, 
-                    "step_data": new_entry_data 
-                }
-                D_inc_all_updated.append(new_entry) 
-                current_fail_count += 1
-
-    # 【修正2 & 3】ループ終了後に一括でSceneGraphを注入 (効率化 & エラー回避)
-    # これにより D_cor_sg, D_inc_sg が確実に生成されます
-    D_cor_sg = inject_scene_graph(D_cor_all_updated, scene_graph)
-    D_inc_sg = inject_scene_graph(D_inc_all_updated, scene_graph)
-
-    return D_cor, D_inc, D_cor_sg, D_inc_sg
-
-
-def extract_transitions(trajectory_dict: Dict) -> List[Dict]:
+            new_entry = {
+                "global_id": len(store), 
+                "task_id": task_name,
+                "step_id": i, 
+                "step_data": new_entry_data 
+            }
+            store.append(new_entry)
+            appended[kind] += 1
+
+    state.next_step = max(state.next_step, min_length)
+
+    print(f"Stage1: D_cor 追加 {appended['cor']}件 / 更新 {replaced['cor']}件, "
+          f"D_inc 追加 {appended['inc']}件 / 更新 {replaced['inc']}件")
+
+    return dict(state.D_cor), dict(state.D_inc), cor_store, inc_store
+
+
+def extract_transitions(trajectory_dict: Dict, start: int = 0, stop: Optional[int] = None) -> List[Dict]:
+    """
+    軌跡の辞書から遷移のリストを作る。start / stop で範囲を絞れる (増分分類用)。
+    """
     transitions = []
-    index = 0
-    while f"state_{index}" in trajectory_dict:
+    index = start
+    while f"state_{index}" in trajectory_dict and (stop is None or index < stop):
         transition = {
             "state": trajectory_dict.get(f"state_{index}", {}),
             "action": trajectory_dict.get(f"action_{index}", {}),
@@ -114,6 +116,19 @@ def extract_transitions(trajectory_dict: Dict) -> List[Dict]:
     return transitions
 
 
+def attach_scene_graph(step_data: Dict[str, Any], scene_graph: Dict, step_id) -> Dict[str, Any]:
+    """
+    1 つの step_data に、そのステップのシーングラフを注入する。
+    """
+    sg_key = f"scene_graph_{step_id}"
+    if sg_key in scene_graph:
+        step_data["scene_graph"] = scene_graph[sg_key]
+    elif "scene_graph" not in step_data:
+        # フォールバック (Stage 4 で必要)
+        step_data["scene_graph"] = {"nodes": [], "edges": []}
+    return step_data
+
+
 def inject_scene_graph(inc_list: List[Dict[str, Any]], scene_graph: Dict):
     """
     D_inc/D_cor リストの各エントリの 'step_data' に scene_graph を注入する。
@@ -7,7 +7,10 @@ import re
 import inspect
 import textwrap
 from typing import List, Callable, Tuple, Dict, Optional
-import ast
+
+from .translation_cache import (TranslationCache, assemble_code, final_rules_of, function_name, match_rule_functions,
+                                split_rule_functions_lenient)
+from .rule_verifier import RuleVerificationReport, verify_rule_code
 
 # OpenAI APIキーの設定 (環境変数から取得することを推奨)
 try:
@@ -20,22 +23,136 @@ except Exception as e:
 
 class STAGE3:
 
-    def __init__(self, model: str = "gpt-3.5-turbo"):
+    def __init__(self, model: str = "gpt-3.5-turbo", translation_cache: Optional[TranslationCache] = None):
+        """
+        translation_cache: 自然言語ルール → 関数 の翻訳キャッシュ (None なら ./CodeRule/translation_cache.json)
+        """
         self.model = model
         self.client = client 
+        self.translation_cache = translation_cache if translation_cache is not None else TranslationCache()
+        # 直前の generate_coderule で出力した関数名 → ルール文 (検証に落ちた翻訳をキャッシュから外すため)
+        self.last_translations: Dict[str, str] = {}
 
         if self.client is None:
             print("[CodeRule] Warning: OpenAI client is not initialized. LLM calls will fail.")
 
     def generate_coderule(self, ar_data, input_dir):
-       
+        """
+        final_rules のうち翻訳キャッシュにないルールだけを LLM に送り、
+        キャッシュ済みの関数と合わせたコードを返す (LLM 呼び出しに失敗した場合は None)。
+        """
+        final_rules = final_rules_of(ar_data)
+
+        # キャッシュにあるルールは現在の番号に付け替えて再利用する
+        self.last_translations = {}
+        sources: Dict[int, str] = {}
+        prelude: List[str] = []
+        missing = []
+        for i, rule_text in enumerate(final_rules):
+            hit = self.translation_cache.source_for(rule_text)
+            if hit is None:
+                missing.append(i)
+                continue
+            sources[i], hit_prelude = hit
+            prelude.extend(hit_prelude)
+            self.last_translations[function_name(sources[i])] = rule_text
+        print(f"[CodeRule] 翻訳キャッシュ: ヒット {len(final_rules) - len(missing)}件 / LLM に送るルール {len(missing)}件")
+
+        extra = []
+        if missing:
+            generate_response = self.request_coderule([final_rules[i] for i in missing], input_dir)
+            if generate_response is None:
+                return None
+            new_sources, new_prelude, extra = self._adopt_response(final_rules, missing, generate_response)
+            sources.update(new_sources)
+            prelude.extend(new_prelude)
+
+        return assemble_code(prelude, [sources[i] for i in sorted(sources)] + extra)
+
+    def _adopt_response(self, final_rules: List[str], indices: List[int], response: str) -> Tuple[Dict[int, str], List[str], List[str]]:
+        """
+        LLM の出力を関数ごとに分けて final_rules[indices] に対応付け、パースできた関数を翻訳キャッシュに入れる。
+        戻り値: ({ルール番号(添字): 関数のソース}, prelude, どのルールにも対応しなかった関数のソース)
+        """
+        functions, prelude, broken = split_rule_functions_lenient(response)
+        # パースできなかった関数も検証で失敗として報告させるために残す
+        candidates = dict(functions)
+        candidates.update({name: source for name, (source, _) in broken.items()})
+
+        names = match_rule_functions(final_rules, indices, list(candidates))
+        sources = {}
+        for i, name in names.items():
+            sources[i] = candidates[name]
+            self.last_translations[name] = final_rules[i]
+            if name in functions:
+                self.translation_cache.put(final_rules[i], name, functions[name], prelude)
+        self.translation_cache.save()
+
+        extra = [source for name, source in candidates.items() if name not in names.values()]
+        return sources, prelude, extra
+
+    def build_coderule(self, ar_data, input_dir, samples: List[Dict] = (), max_attempts: int = 5) -> str:
+        """
+        コードルールを生成してローカルで検証し、通らなかった関数だけをエラー付きで LLM に作り直させる。
+        通った関数は以降のやり直しで送らない。戻り値は通ったルールだけのコード。
+        """
+        final_rules = final_rules_of(ar_data)
+        index_of = {}
+        for i, rule_text in enumerate(final_rules):
+            index_of.setdefault(rule_text, i)
+
+        passing: Dict[int, str] = {}
+        extra_passing: Dict[str, str] = {}
+        failures: Dict[int, Dict] = {}
+        prelude: List[str] = []
+
+        for attempt in range(max_attempts):
+            print("コードルールリプランカウント:", attempt)
+            if attempt == 0:
+                code = self.generate_coderule(ar_data, input_dir)
+            else:
+                pending = [i for i in range(len(final_rules)) if i not in passing]
+                if not pending:
+                    break
+                retry = [{"rule": final_rules[i], **failures.get(i, {"code": None, "error": "No function was generated for this rule."})}
+                         for i in pending]
+                response = self.request_coderule([final_rules[i] for i in pending], input_dir, failures=retry)
+                if response is None:
+                    continue
+                new_sources, new_prelude, extra = self._adopt_response(final_rules, pending, response)
+                code = assemble_code(prelude + new_prelude, list(new_sources.values()) + extra)
+            if code is None:
+                continue
+
+            report = self.verify_code_rules(code, samples)
+            prelude.extend(block for block in report.prelude if block not in prelude)
+            for name in report.passed:
+                i = index_of.get(self.last_translations.get(name))
+                if i is None:
+                    extra_passing[name] = report.sources[name]
+                else:
+                    passing[i] = report.sources[name]
+                    failures.pop(i, None)
+            for name in report.failed:
+                i = index_of.get(self.last_translations.get(name))
+                if i is not None and i not in passing:
+                    failures[i] = {"code": report.sources[name], "error": report.results[name]["error"]}
+
+            print(f"[CodeRule] 検証を通ったルール {len(passing)}/{len(final_rules)}件")
+            if len(passing) == len(final_rules):
+                break
+
+        return assemble_code(prelude, [passing[i] for i in sorted(passing)] + list(extra_passing.values()))
+
+    def request_coderule(self, rules: List[str], input_dir, failures: Optional[List[Dict]] = None):
+        """
+        ルール文のリストを LLM に送り、生成されたコード (文字列) を返す。失敗した場合は None。
+        failures: 前回の生成で検証に落ちた関数 ({"rule", "code", "error"}) のリスト。指定するとエラーを添えて作り直させる
+        """
         if self.client is None:
             print("[CodeRule] Error: OpenAI client is not available. Cannot generate action.")
-        
-        if isinstance(ar_data, str):
-            ar_data = json.loads(ar_data)
     
-        ar_str = json.dumps(ar_data.get("final_rules", []), indent=4, ensure_ascii=False)
+        ar_str = json.dumps(rules, indent=4, ensure_ascii=False)
 
         # プロンプト ===================================================================
         system_prompt = textwrap.dedent("""
@@ -178,6 +295,17 @@ given rules：
 
         user_prompt = header + ar_str
 
+        if failures:
+            user_prompt += "\n\n" + textwrap.dedent("""
+The functions below were generated for these rules before, but failed local verification
+(they were executed on recorded transitions). Rewrite only these functions, fixing the reported errors.
+Keep the same function names and the (state, action, scene_graph) signature, and return (feedback, success, suggestion) with success as a bool.
+            """).strip()
+            for failure in failures:
+                user_prompt += f"\n\nRule: {failure['rule']}\nError: {failure['error']}"
+                if failure.get("code"):
+                    user_prompt += f"\nPrevious code:\n{failure['code']}"
+
         messages = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt}
@@ -229,65 +357,24 @@ given rules：
     
     # ===========================================================================
 
-    def verify_code_rule_boolean(self, code_rule: str, model: str = "gpt-3.5-turbo") -> bool:
-
-        if self.client is None:
-            print("[CodeRule] Error: OpenAI client is not available. Cannot generate action.")
-        
-        try:
-            ast.parse(code_rule)
-            compile(code_rule, "<string>", "exec")
-        except Exception as e:
-            print(f"[Syntax/Compile Error Detected] {e}")
-            return False
-
-        # プロンプト ===================================================================
-        system_prompt = textwrap.dedent("""
-You are a strict Python code validator.
-Check whether the following string is a valid, executable Python code.
-
-If the code can be executed without syntax or import errors, output exactly "True".
-If the code cannot be executed due to any errors, output exactly "False".
-
-Do not explain or add any text other than "True" or "False".
-        """)
-        
-        header = "--- CODE START ---\n"
-
-        user_prompt = header + str(code_rule)
-
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-
-        # プロンプトのログ残す用
-        # ========================================================
-        log_text = "--- System Prompt ---\n"
-        log_text += system_prompt + "\n\n"
-        
-        for msg in messages[1:]:
-            log_text += f"--- {msg['role'].capitalize()} ---\n"
-            log_text += msg['content'] + "\n\n"
-        # ========================================================
-
-        parent_dir = "./Code_Check"
-        os.makedirs(parent_dir, exist_ok=True) 
-        file_path = os.path.join(parent_dir, "check_prompt.txt")
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write(log_text)
-
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            max_tokens=2000,
-            temperature=0,
-        )
-
-        result = response.choices[0].message.content.strip()
-        print(f"=== LLM Verification Result: {result} ===")
-
-        return result.strip().lower() == "true"
+    def verify_code_rules(self, code_rule: Optional[str], samples: List[Dict] = ()) -> RuleVerificationReport:
+        """
+        コードルールをローカルで実行して検証し、ルールごとの結果を返す (rule_verifier.py)。
+        検証に落ちたルールの翻訳はキャッシュから外し、次回 LLM に送り直す。
+        """
+        report = verify_rule_code(code_rule or "", samples)
+        print(f"=== Local Verification Result: {report.summary()} ===")
+
+        for name in report.failed:
+            rule_text = self.last_translations.get(name)
+            if rule_text is not None:
+                self.translation_cache.invalidate(rule_text, report.results[name]["error"])
+        self.translation_cache.save()
+        return report
+
+    def verify_code_rule_boolean(self, code_rule: str, model: str = "gpt-3.5-turbo", samples: List[Dict] = ()) -> bool:
+        """全てのルールがローカル検証を通れば True。"""
+        return self.verify_code_rules(code_rule, samples).ok
 
     # ===========================================================================
 
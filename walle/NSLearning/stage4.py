@@ -1,10 +1,306 @@
 import json
 import os
-from typing import List, Callable, Tuple, Dict, Union
+import re
+import hashlib
+from typing import List, Callable, Tuple, Dict, Union, Optional, Iterator
 
-def greedy_rule_selection(D_inc: Dict, D_cor: Dict, R_code: List[Callable], l: int, out_dir: str):
+import numpy as np
+
+from utils.logger import get_logger
+from .rule_ir import compile_rule, bool_to_bitset, evaluate_python
+from .rule_registry import rule_hash
+from .transition_table import StoreTable, TransitionTable
+
+logger = get_logger(__name__)
+
+# 直近の greedy_rule_selection で得られた振る舞いの同値類 (代表ルール名・サイズ・メンバー)
+last_equivalence_classes: List[Dict] = []
+
+
+def coverage_signature(row: int, n_transitions: int) -> str:
+    """カバー行 (ビット集合) のハッシュ署名。"""
+    row_bytes = row.to_bytes((n_transitions + 7) // 8 or 1, "little")
+    return hashlib.blake2b(row_bytes, digest_size=16).hexdigest()
+
+
+def collapse_equivalent_rules(rules: List[Callable], rows: List[int], n_transitions: int):
+    """
+    カバー行が同じルールを同値類にまとめ、各類の代表 (最初に現れたルール) だけを残す。
+
+    Returns:
+        representatives: 代表ルールのリスト
+        rep_rows: 代表ルールのカバー行
+        equivalence_classes: [{"signature", "representative", "size", "coverage", "members"}, ...]
+    """
+    index_by_row: Dict[int, int] = {}
+    representatives, rep_rows, equivalence_classes = [], [], []
+
+    for rule, row in zip(rules, rows):
+        if row in index_by_row:
+            cls = equivalence_classes[index_by_row[row]]
+            cls["size"] += 1
+            cls["members"].append(rule.__name__)
+            continue
+        index_by_row[row] = len(representatives)
+        representatives.append(rule)
+        rep_rows.append(row)
+        equivalence_classes.append({
+            "signature": coverage_signature(row, n_transitions),
+            "representative": rule.__name__,
+            "size": 1,
+            "coverage": row.bit_count(),
+            "members": [rule.__name__],
+        })
+
+    for rule, cls in zip(representatives, equivalence_classes):
+        try:
+            rule.__equivalent_rules__ = list(cls["members"])
+        except AttributeError:
+            pass
+
+    return representatives, rep_rows, equivalence_classes
+
+_RULE_ACTION_PATTERN = re.compile(r"^Rule_\d+_(.+)$")
+
+
+def rule_action_type(rule: Callable) -> Optional[str]:
+    """Rule_22_put -> "put"。命名規則に合わない場合は None。"""
+    match = _RULE_ACTION_PATTERN.match(getattr(rule, "__name__", ""))
+    return match.group(1) if match else None
+
+
+class FailureFirstOrder:
+    """
+    Validity Check で「ルールを無効化した成功遷移」を行動タイプごとに記録し、
+    よく無効化する遷移から先に試す順序を返す。
+
+    モジュール内で共有 (validity_order) するため、ルール間・greedy_rule_selection の呼び出し間で学習が引き継がれる。
+    遷移のキーは (task_id, step_id)。D_cor が伸びても既存のキーはそのまま使える。
+    """
+    ANY = "*"
+
+    def __init__(self):
+        self.kill_counts: Dict[str, Dict[Tuple, int]] = {}
+        self._hot_cache: Dict[str, List[Tuple]] = {}
+        self.evaluations = 0
+        self.rejections = 0
+
+    def record_kill(self, action_type: Optional[str], key: Tuple) -> None:
+        for bucket in (action_type or self.ANY, self.ANY):
+            counts = self.kill_counts.setdefault(bucket, {})
+            counts[key] = counts.get(key, 0) + 1
+            self._hot_cache.pop(bucket, None)
+            if action_type is None:
+                break
+
+    def hot_keys(self, bucket: str) -> List[Tuple]:
+        """無効化回数の多い順の遷移キー (同数なら最初に記録された順)。"""
+        if bucket not in self._hot_cache:
+            counts = self.kill_counts.get(bucket, {})
+            self._hot_cache[bucket] = sorted(counts, key=lambda k: -counts[k])
+        return self._hot_cache[bucket]
+
+    def order(self, action_type: Optional[str], actions: Dict[Tuple, Optional[str]],
+              keys_by_action: Dict[str, List[Tuple]]) -> Iterator[Tuple]:
+        """
+        評価順に遷移キーを返すジェネレータ (早期終了時に残りの並べ替えコストを払わない)。
+        actions は {遷移キー: 行動名} (保存順)。
+        1. この行動タイプのルールをよく無効化した遷移
+        2. 行動タイプを問わずよく無効化した遷移
+        3. 同じ行動タイプの遷移 (ルールが実際に判定する対象)
+        4. 残りの遷移 (保存順)
+        """
+        seen = set()
+        buckets = [self.ANY] if action_type is None else [action_type, self.ANY]
+        for bucket in buckets:
+            for key in self.hot_keys(bucket):
+                if key in actions and key not in seen:
+                    seen.add(key)
+                    yield key
+        matching = keys_by_action.get(action_type, []) if action_type is not None else []
+        for key in matching:
+            if key not in seen:
+                seen.add(key)
+                yield key
+        for key, action in actions.items():
+            if key not in seen and (action_type is None or action != action_type):
+                yield key
+
+    def summary(self) -> Dict:
+        return {
+            "evaluations": self.evaluations,
+            "rejections": self.rejections,
+            "tracked_transitions": len(self.kill_counts.get(self.ANY, {})),
+        }
+
+
+# 有効性チェックの評価順 (プロセス内で共有)
+validity_order = FailureFirstOrder()
+
+
+class CoverageCache:
+    """
+    ルールの正規化 AST ハッシュ (rule_registry.rule_hash) ごとに、テーブルの各行での評価結果
+    (success 予測・実行エラー) を保持する。テーブルに行が増えたときは新しい行だけを、
+    新しいルールは全行を評価する。テーブルは uid で区別する (作り直したテーブルは別のキャッシュになる)。
+    evaluations は元の関数を実行した回数、vectorized_rows は IR でまとめて評価した行数。
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.entries: Dict[Tuple[str, int], Dict[str, np.ndarray]] = {}
+        self.evaluations = 0
+        self.vectorized_rows = 0
+
+    def _entry(self, rule: Callable, table: TransitionTable) -> Dict[str, np.ndarray]:
+        key = (rule_hash(rule), table.uid)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            entry = {"predicted": np.ones(0, dtype=bool), "errors": np.zeros(0, dtype=bool),
+                     "known": np.zeros(0, dtype=bool)}
+            while len(self.entries) >= self.max_entries:
+                self.entries.pop(next(iter(self.entries)))
+        self.entries[key] = entry   # 最近使ったものを末尾に置く
+        grow = table.n - len(entry["known"])
+        if grow > 0:
+            entry["predicted"] = np.concatenate((entry["predicted"], np.ones(grow, dtype=bool)))
+            entry["errors"] = np.concatenate((entry["errors"], np.zeros(grow, dtype=bool)))
+            entry["known"] = np.concatenate((entry["known"], np.zeros(grow, dtype=bool)))
+        return entry
+
+    def evaluate(self, rule: Callable, table: TransitionTable, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        rows のうち未評価の行を評価し、全行分の (success 予測, エラー) を返す。
+        rows 以外の未評価の行は predicted=True, errors=False のまま。
+        """
+        entry = self._entry(rule, table)
+        todo = rows[~entry["known"][rows]]
+        if len(todo) == 0:
+            return entry["predicted"], entry["errors"]
+        compiled = compile_rule(rule)
+        if compiled.vectorized:
+            start = int(todo.min())
+            predicted, errors = compiled.evaluate(table, start)
+            entry["predicted"][start:] = predicted
+            entry["errors"][start:] = errors
+            entry["known"][start:] = True
+            self.vectorized_rows += table.n - start
+        else:
+            predicted, errors = evaluate_python(rule, [table.transition(int(row)) for row in todo])
+            entry["predicted"][todo] = predicted
+            entry["errors"][todo] = errors
+            entry["known"][todo] = True
+            self.evaluations += len(todo)
+        return entry["predicted"], entry["errors"]
+
+    def row(self, rule: Callable, table: TransitionTable, row: int) -> Tuple[bool, bool]:
+        """1 行の (success 予測, エラー)。評価済みならルールを実行しない。"""
+        entry = self._entry(rule, table)
+        if not entry["known"][row]:
+            predicted, errors = evaluate_python(rule, [table.transition(row)])
+            entry["predicted"][row] = predicted[0]
+            entry["errors"][row] = errors[0]
+            entry["known"][row] = True
+            self.evaluations += 1
+        return bool(entry["predicted"][row]), bool(entry["errors"][row])
+
+
+# ルールの評価結果 (プロセス内で共有し、greedy_rule_selection の呼び出し間で使い回す)
+coverage_cache = CoverageCache()
+
+
+def _flatten_success_transitions(D_cor) -> Dict[Tuple, Dict]:
+    """
+    D_cor を {(task_id, step_id): 遷移} に展開する。
+    action_result の位置の揺れを吸収し、実際に成功した遷移だけを残す。
+    """
+    if not D_cor:
+        return {}
+    if isinstance(D_cor, dict):
+        items = (((task_id, str(step_id)), trans)
+                 for task_id, task_data in D_cor.items() if task_data
+                 for step_id, trans in task_data.items())
+    else:
+        items = (((None, str(i)), trans) for i, trans in enumerate(D_cor))
+
+    flat = {}
+    for key, trans in items:
+        # データの構造の揺れに対応 (action_resultの位置)
+        real_success = False
+        if "action_result" in trans:
+            real_success = trans["action_result"].get("success", False)
+        elif "real_transitions" in trans:
+            real_success = trans["real_transitions"].get("action_result", {}).get("success", False)
+        elif "step_data" in trans: # ラップされている場合
+            real_success = trans["step_data"].get("action_result", {}).get("success", False)
+            trans = trans["step_data"] # 中身を取り出す
+
+        # 万が一、失敗データが混入していたらスキップ (成功データとの矛盾のみを検証するため)
+        if real_success:
+            flat[key] = trans
+    return flat
+
+
+def _corpus_rows(data, success_only: bool) -> Tuple[TransitionTable, np.ndarray]:
+    """
+    D_cor / D_inc を (テーブル, 対象の行番号) にする。
+    StoreTable (コーパスストアの隣に保存したテーブル) はそのまま使い、ストアの現在の内容に対応する行を返す。
+    {task_id: {step_id: 遷移}} の辞書からはその場でテーブルを作る。
+    """
+    if isinstance(data, StoreTable):
+        return data, data.live_rows(success=True if success_only else None)
+    if success_only:
+        flat = _flatten_success_transitions(data)
+    else:
+        flat = {(task_id, str(step_id)): trans.get("step_data", trans)
+                for task_id, task_data in (data or {}).items() if task_data
+                for step_id, trans in task_data.items()}
+    table = TransitionTable.from_transitions(list(flat.values()), list(flat))
+    return table, table.rows()
+
+
+def revalidate_rules(rules: List[Callable], D_cor_new: Union[StoreTable, Dict],
+                     rows: Optional[np.ndarray] = None) -> Tuple[List[Callable], List[Callable]]:
+    """
+    選定済みのルールを、新しく追加された D_cor の遷移だけで Validity Check し直す (増分更新)。
+    成功した遷移を『失敗』と予測するルールと実行エラーになるルールを外す。
+    D_inc のカバーは変わらないので、残ったルールの Maximum Coverage はやり直さない。
+    D_cor_new が StoreTable のときは rows (新しく追加された遷移の行) だけを評価する。
+    戻り値: (残ったルール, 外したルール)
+    """
+    table, cor_rows = _corpus_rows(D_cor_new, success_only=True)
+    if rows is not None:
+        cor_rows = np.intersect1d(cor_rows, rows)
+    if not len(cor_rows):
+        return list(rules), []
+
+    evaluations = coverage_cache.evaluations
+    valid, removed = [], []
+    for rule in rules:
+        is_invalid = False
+        for row in cor_rows:
+            rule_success_flag, error = coverage_cache.row(rule, table, int(row))
+            if error:
+                logger.debug("  [警告] %s 実行エラー: %s", rule.__name__, table.key(row))
+                is_invalid = True
+                break
+            if not rule_success_flag:
+                logger.debug("  [削除] %s: 成功事例を『失敗』と誤判定しました (False Positive).", rule.__name__)
+                validity_order.record_kill(rule_action_type(rule), table.key(row))
+                is_invalid = True
+                break
+        (removed if is_invalid else valid).append(rule)
+
+    validity_order.evaluations += coverage_cache.evaluations - evaluations
+    validity_order.rejections += len(removed)
+    logger.info("Validity Check (増分: %d遷移): %d -> %d ルール", len(cor_rows), len(rules), len(valid))
+    return valid, removed
+
+
+def greedy_rule_selection(D_inc: Union[StoreTable, Dict], D_cor: Union[StoreTable, Dict], R_code: List[Callable], l: int, out_dir: str):
     """
     Greedy Algorithm for Maximum Coverage Problem (WALL-E 2.0 Implementation)
+    D_inc / D_cor はコーパスストアのテーブル (StoreTable) か {task_id: {step_id: 遷移}} の辞書。
     
     論文の仕様に基づく2段階プロセス:
     1. Validity Check (Appendix E.3):
@@ -14,29 +310,21 @@ def greedy_rule_selection(D_inc: Dict, D_cor: Dict, R_code: List[Callable], l: i
        失敗事例(D_inc)を最も多く正しく予測(カバー)できるルールを貪欲法で選定する。
     """
 
-    print("\n=== Stage 4: Code Rule Pruning (WALL-E 2.0 Logic) ===")
+    logger.info("\n=== Stage 4: Code Rule Pruning (WALL-E 2.0 Logic) ===")
     
     # ---------------------------------------------------------
-    # データの前処理: 辞書形式をフラットなリストに変換
+    # データの前処理: 列指向のテーブルと対象の行
+    # new_nslearning.py はコーパスストアの隣に保存したテーブル (StoreTable) を渡す
     # ---------------------------------------------------------
-    
-    # 1. 成功事例 (D_cor) の展開
-    success_transitions = []
-    if D_cor:
-        if isinstance(D_cor, dict):
-            for task_data in D_cor.values():
-                if task_data:
-                    success_transitions.extend(task_data.values())
-        elif isinstance(D_cor, list):
-            success_transitions = D_cor
-            
-    # 2. 失敗事例 (D_inc) の展開
-    inc_transitions_list = []
-    for task_data in D_inc.values():
-        if task_data:
-            inc_transitions_list.extend(task_data.values())
-
-    if not inc_transitions_list:
+
+    # 1. 成功事例 (D_cor) のうち実際に成功した遷移
+    cor_table, cor_rows = _corpus_rows(D_cor, success_only=True)
+
+    # 2. 失敗事例 (D_inc)
+    inc_table, inc_rows = _corpus_rows(D_inc, success_only=False)
+    n_inc = len(inc_rows)
+
+    if not n_inc:
         print("⚠️ D_inc (失敗事例) が存在しません。ルール選定をスキップします。")
         return []
 
@@ -47,58 +335,63 @@ def greedy_rule_selection(D_inc: Dict, D_cor: Dict, R_code: List[Callable], l: i
     # Step 1: Validity Check (Appendix E.3)
     # 「実際には成功しているのに、失敗すると予測するルール」を排除
     # ---------------------------------------------------------
-    if success_transitions:
-        print(f"Checking validity against {len(success_transitions)} successful transitions...")
+    # 評価結果は coverage_cache がルールのハッシュごとに保持し、新しいルール・新しい行だけを評価する。
+    # IR に変換できるルールは D_cor 全体を列に対して一括評価する。
+    # それ以外のルールの評価順は validity_order が決める: 過去にルールを無効化した遷移・同じ行動タイプの遷移を
+    # 先に試し、1 つでも矛盾が出たら即座に打ち切る。判定結果は評価順によらない。
+    if len(cor_rows):
+        logger.info("Checking validity against %d successful transitions...", len(cor_rows))
+        row_of = {cor_table.key(row): int(row) for row in cor_rows}
+        actions = {key: cor_table.name(int(cor_table.action[row])) for key, row in row_of.items()}
+        keys_by_action: Dict[str, List[Tuple]] = {}
+        for key, action_name in actions.items():
+            keys_by_action.setdefault(action_name, []).append(key)
+
         temp_valid_rules = []
-        
+        evaluations = coverage_cache.evaluations
+
         for rule in valid_R_code:
             is_invalid = False
-            
-            for trans in success_transitions:
-                # データの構造の揺れに対応 (action_resultの位置)
-                real_success = False
-                if "action_result" in trans:
-                    real_success = trans["action_result"].get("success", False)
-                elif "real_transitions" in trans:
-                    real_success = trans["real_transitions"].get("action_result", {}).get("success", False)
-                elif "step_data" in trans: # ラップされている場合
-                     real_success = trans["step_data"].get("action_result", {}).get("success", False)
-                     trans = trans["step_data"] # 中身を取り出す
-
-                # 万が一、失敗データが混入していたらスキップ (成功データとの矛盾のみを検証するため)
-                if not real_success:
-                    continue
-
-                # 必要なデータを取得
-                state = trans.get("state", {})
-                action = trans.get("action", {})
-                # new_nslearning.py で注入されたシーングラフを使用
-                sg = trans.get("scene_graph", {"nodes": [], "edges": []})
-
-                try:
-                    # ルールを実行 [cite: 245]
-                    # return: feedback, success_flag, suggestion
-                    _, rule_success_flag, _ = rule(state, action, sg)
-
-                    # 【論文の核心ロジック】
-                    # "predicting failure when the transition actually succeeds" -> Invalid 
-                    # ルールが「False (失敗)」と判定したのに、実際は「True (成功)」だった場合
-                    if rule_success_flag is False:
-                        print(f"  [削除] {rule.__name__}: 成功事例を『失敗』と誤判定しました (False Positive).")
-                        is_invalid = True
-                        break # 1つでも矛盾があれば即アウト
-                
-                except Exception as e:
-                    print(f"  [警告] {rule.__name__} 実行エラー: {e}")
+            action_type = rule_action_type(rule)
+
+            if compile_rule(rule).vectorized:
+                predicted, errors = coverage_cache.evaluate(rule, cor_table, cor_rows)
+                false_positives = cor_rows[~predicted[cor_rows]]
+                if len(false_positives) or errors[cor_rows].any():
+                    logger.debug("  [削除] %s: 成功事例を『失敗』と誤判定しました (False Positive).", rule.__name__)
+                    if len(false_positives):
+                        validity_order.record_kill(action_type, cor_table.key(false_positives[0]))
+                else:
+                    temp_valid_rules.append(rule)
+                continue
+
+            # 評価済みの行はキャッシュから引くので、ルールを実行するのは新しいルール・新しい行だけ
+            for key in validity_order.order(action_type, actions, keys_by_action):
+                rule_success_flag, error = coverage_cache.row(rule, cor_table, row_of[key])
+
+                if error:
+                    logger.debug("  [警告] %s 実行エラー: %s", rule.__name__, key)
                     # 安全のためエラーが出るルールは除外
                     is_invalid = True
                     break
 
+                # 【論文の核心ロジック】
+                # "predicting failure when the transition actually succeeds" -> Invalid 
+                # ルールが「False (失敗)」と判定したのに、実際は「True (成功)」だった場合
+                if not rule_success_flag:
+                    logger.debug("  [削除] %s: 成功事例を『失敗』と誤判定しました (False Positive).", rule.__name__)
+                    validity_order.record_kill(action_type, key)
+                    is_invalid = True
+                    break # 1つでも矛盾があれば即アウト
+
             if not is_invalid:
                 temp_valid_rules.append(rule)
         
+        evaluations = coverage_cache.evaluations - evaluations
+        validity_order.evaluations += evaluations
+        validity_order.rejections += len(valid_R_code) - len(temp_valid_rules)
         valid_R_code = temp_valid_rules
-        print(f"Validity Check完了: {initial_rule_count} -> {len(valid_R_code)} ルールが通過")
+        logger.info("Validity Check完了: %d -> %d ルールが通過 (ルール実行 %d回)", initial_rule_count, len(valid_R_code), evaluations)
 
     if not valid_R_code:
         print("⚠️ 有効なルールが残りませんでした。空リストを返します。")
@@ -108,57 +401,48 @@ def greedy_rule_selection(D_inc: Dict, D_cor: Dict, R_code: List[Callable], l: i
     # Step 2: Maximum Coverage (Section 3.1.4)
     # 失敗事例 (D_inc) をカバーするルールを貪欲法で選定
     # ---------------------------------------------------------
-    print(f"Solving Maximum Coverage for {len(inc_transitions_list)} failed transitions...")
+    logger.info("Solving Maximum Coverage for %d failed transitions...", n_inc)
 
     # a_ij 行列の作成 (行:ルール, 列:失敗遷移) [cite: 209]
+    # 各行は int のビット集合で持つ (j ビット目 = 遷移 inc_rows[j] をカバー)
+    # カバーの定義: 「実環境で失敗」かつ「ルールも失敗と予測」した場合 (正しい失敗予測 = 1, それ以外 = 0)
+    # 実行エラーの行は predicted=True (カバーできていない) として返る
     a_matrix = []
-    
+    real_failed = ~inc_table.success[inc_rows]
+    evaluations = coverage_cache.evaluations
     for rule in valid_R_code:
-        row = []
-        for trans in inc_transitions_list:
-            # データ構造の正規化
-            if "step_data" in trans: trans = trans["step_data"]
-
-            state = trans.get("state", {})
-            action = trans.get("action", {})
-            current_sg = trans.get("scene_graph", {"nodes": [], "edges": []})
-
-            try:
-                _, rule_success, _ = rule(state, action, current_sg)
-            except:
-                rule_success = True # エラーならカバーできていないとみなす
-
-            # 実環境の結果
-            if "action_result" in trans:
-                real_success = trans["action_result"].get("success", False)
-            else:
-                real_success = trans.get("real_transitions", {}).get("action_result", {}).get("success", False)
-            
-            # カバーの定義:
-            # 「実環境で失敗」かつ「ルールも失敗と予測」した場合にカバーとみなす 
-            # (正しい失敗予測 = 1, それ以外 = 0)
-            pred_success = rule_success
-            covers = (not real_success) and (not pred_success)
-            
-            row.append(1 if covers else 0)
-        a_matrix.append(row)
+        predicted, _ = coverage_cache.evaluate(rule, inc_table, inc_rows)
+        a_matrix.append(bool_to_bitset(~predicted[inc_rows] & real_failed))
+    logger.info("カバー行の計算: ルール実行 %d回", coverage_cache.evaluations - evaluations)
+
+    # ---------------------------------------------------------
+    # 振る舞いが同じルールの集約
+    # D_cor での有効性は全ルール共通 (通過済み) なので、D_inc のカバー行が同じルールは
+    # 貪欲選択で区別できない。署名ごとに 1 つの代表 (最初に現れたルール) だけを残す。
+    # ---------------------------------------------------------
+    representatives, rep_rows, equivalence_classes = collapse_equivalent_rules(valid_R_code, a_matrix, n_inc)
+    global last_equivalence_classes
+    last_equivalence_classes = equivalence_classes
+    logger.info("振る舞いの同値類: %d -> %d ルール (クラスサイズ: %s)",
+                len(valid_R_code), len(representatives), [c["size"] for c in equivalence_classes])
 
     # 貪欲選択ロジック (Algorithm 1) 
     R_star = []     # 選択されたルールセット
-    D_cov = set()   # カバーされた遷移のインデックス集合
+    selected = set()  # 選択済みルールのインデックス
+    D_cov = 0       # カバーされた遷移のビット集合
+    all_covered = (1 << n_inc) - 1
 
     # ルール数上限 l または 全カバーするまでループ
-    while len(R_star) < l and len(D_cov) < len(inc_transitions_list):
+    while len(R_star) < l and D_cov != all_covered:
         gains = []
-        for i, row in enumerate(a_matrix):
+        for i, row in enumerate(rep_rows):
             # すでに選択済みのルールは除外 (gain = -1)
-            if valid_R_code[i] in R_star:
+            if i in selected:
                 gains.append(-1)
                 continue
 
             # 新たにカバーできる遷移の数を計算 (Marginal Gain) [cite: 223]
-            covered_indices = {j for j, val in enumerate(row) if val == 1}
-            gain = len(covered_indices - D_cov)
+            gain = (row & ~D_cov).bit_count()
             gains.append(gain)
 
         # 最大ゲインを持つルールを選択 [cite: 224]
@@ -168,21 +452,24 @@ def greedy_rule_selection(D_inc: Dict, D_cor: Dict, R_code: List[Callable], l: i
         if gains[i_star] <= 0:
             break 
 
-        selected_rule = valid_R_code[i_star]
-        R_star.append(selected_rule)
+        selected.add(i_star)
+        R_star.append(representatives[i_star])
         
         # カバー集合を更新 [cite: 231]
-        new_covered = {j for j, val in enumerate(a_matrix[i_star]) if val == 1}
-        D_cov |= new_covered
+        D_cov |= rep_rows[i_star]
+
+    D_cov_count = D_cov.bit_count()
 
     # 結果の出力と保存
-    coverage_percentage = (len(D_cov) / len(inc_transitions_list)) * 100 if inc_transitions_list else 0
-    text = f"最終選択ルール数: {len(R_star)}, カバー率: {coverage_percentage:.1f}% ({len(D_cov)}/{len(inc_transitions_list)})"
-    print(text)
+    coverage_percentage = (D_cov_count / n_inc) * 100 if n_inc else 0
+    text = f"最終選択ルール数: {len(R_star)}, カバー率: {coverage_percentage:.1f}% ({D_cov_count}/{n_inc})"
+    logger.info(text)
 
     text_dir = os.path.join(out_dir, "CoverRate")
     os.makedirs(text_dir, exist_ok=True)
     with open(os.path.join(text_dir, "cover_rate.txt"), "w", encoding="utf-8") as f:
         f.write(text + "\n")
+    with open(os.path.join(text_dir, "equivalence_classes.json"), "w", encoding="utf-8") as f:
+        json.dump(equivalence_classes, f, indent=4, ensure_ascii=False)
     
     return R_star
\ No newline at end of file
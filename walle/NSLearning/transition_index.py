@@ -0,0 +1,174 @@
+"""
+遷移コーパス (D_inc_all / D_cor_all) の近傍検索用ベクトル索引。
+
+ルールマイニングは従来、関係の有無によらず直近 k=3 遷移を LLM に送っていた。ここでは各遷移を
+状態・行動の特徴 (番号を除いた名前と、行動の引数と状態の関係) の feature hashing でベクトルにし、
+行動の種類ごとに索引を作る。予測を外した遷移と同じ種類の行動で、似た状況の過去の遷移
+(失敗した D_inc・成功した D_cor の両方) を検索してマイニングの根拠にする。
+
+- 特徴: "action=take", "arg:recep=countertop", "arg:recep:is_pos=True", "obj_in_recep=False" など。
+  具体的なアイテムや場所の番号は使わないので、別のタスクの同じ状況の遷移が近くなる。
+- ベクトルは dim 次元の符号付き feature hashing を L2 正規化したもので、類似度は内積 (cosine)。
+- sync() でコーパスストアに追加された分だけを索引に加える (プロセス内で shared() を使い回す)。
+
+使用例:
+    index = TransitionIndex.shared()
+    index.sync(D_inc_all, "inc")
+    index.sync(D_cor_all, "cor")
+    for score, (kind, i) in index.nearest(transition, n=3, kind="cor"):
+        print(score, D_cor_all[i]["step_data"]["action"])
+"""
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from utils.state_encoder import base_name
+
+SIMILAR_TRANSITIONS_NOTE = (
+    "The transitions are the mispredicted transitions ('source': 'current') followed by similar past transitions "
+    "of the same action type, both failed ('source': 'failed') and successful ('source': 'succeeded'). "
+    "Locations unrelated to each action are abbreviated to their relevant items only."
+)
+
+# 行動の引数と状態の関係を表す特徴の重み (名前だけの特徴は 1)
+RELATION_WEIGHT = 2.0
+
+
+def transition_features(trans: Dict) -> Dict[str, float]:
+    """遷移 (step_data) の特徴 {特徴: 重み}。action_result は使わない。"""
+    state = trans.get("state") or {}
+    action = trans.get("action") or {}
+    args = {key: value for key, value in (action.get("args") or {}).items() if value}
+    position = state.get("current_position") or {}
+    hand = state.get("item_in_hand") or {}
+    locations = state.get("items_in_locations") or {}
+    reachable = set(state.get("reachable_locations") or [])
+    pos_name = position.get("location_name")
+    hand_item = hand.get("item_name")
+
+    features = {
+        f"action={action.get('action_name')}": 1.0,
+        f"pos={base_name(pos_name)}": 1.0,
+        f"pos_status={position.get('status')}": 1.0,
+        f"hand={base_name(hand_item) or 'none'}": 1.0,
+        f"hand_status={hand.get('status')}": 1.0,
+    }
+    for key, value in args.items():
+        info = locations.get(value)
+        features[f"arg:{key}={base_name(value)}"] = 1.0
+        features[f"arg:{key}:is_pos={value == pos_name}"] = RELATION_WEIGHT
+        features[f"arg:{key}:in_hand={value == hand_item}"] = RELATION_WEIGHT
+        features[f"arg:{key}:reachable={value in reachable}"] = RELATION_WEIGHT
+        features[f"arg:{key}:known={info is not None}"] = RELATION_WEIGHT
+        if info:
+            features[f"arg:{key}:status={info.get('status')}"] = RELATION_WEIGHT
+            features[f"arg:{key}:empty={not info.get('items')}"] = RELATION_WEIGHT
+    obj, recep = args.get("obj"), args.get("recep")
+    if obj and recep:
+        features[f"obj_in_recep={obj in ((locations.get(recep) or {}).get('items') or [])}"] = RELATION_WEIGHT
+        features[f"obj_at_pos={obj in ((locations.get(pos_name) or {}).get('items') or [])}"] = RELATION_WEIGHT
+    return features
+
+
+def hash_vector(features: Dict[str, float], dim: int) -> np.ndarray:
+    """符号付き feature hashing で L2 正規化したベクトルにする。"""
+    vec = np.zeros(dim, dtype=np.float32)
+    for feature, weight in features.items():
+        h = zlib.crc32(feature.encode("utf-8"))
+        vec[h % dim] += weight if (h >> 31) & 1 else -weight
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm else vec
+
+
+class _ActionBucket:
+    """1 種類の行動の遷移のベクトル (行を追加するたびに配列を作り直さないよう、容量を倍々で確保する)。"""
+
+    def __init__(self, dim: int):
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.n = 0
+        self.keys: List[Tuple[str, int]] = []
+        self.signatures: List[int] = []
+
+    def add(self, vector: np.ndarray, key: Tuple[str, int], signature: int) -> None:
+        if self.n == len(self.vectors):
+            grown = np.zeros((max(16, 2 * len(self.vectors)), self.vectors.shape[1]), dtype=np.float32)
+            grown[:self.n] = self.vectors[:self.n]
+            self.vectors = grown
+        self.vectors[self.n] = vector
+        self.n += 1
+        self.keys.append(key)
+        self.signatures.append(signature)
+
+
+class TransitionIndex:
+    """
+    行動の種類ごとの遷移ベクトルの索引。キーは (kind, コーパスストアの添字)。
+    """
+
+    _shared: Optional["TransitionIndex"] = None
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.buckets: Dict[str, _ActionBucket] = {}
+        self.synced: Dict[str, int] = {}   # kind -> 索引に加えたストアの件数
+
+    @classmethod
+    def shared(cls, dim: int = 512) -> "TransitionIndex":
+        """プロセス内で使い回す索引。"""
+        if cls._shared is None or cls._shared.dim != dim:
+            cls._shared = cls(dim)
+        return cls._shared
+
+    def __len__(self) -> int:
+        return sum(bucket.n for bucket in self.buckets.values())
+
+    def add(self, trans: Dict, key: Tuple[str, int]) -> None:
+        features = transition_features(trans)
+        signature = hash(frozenset(features.items()))
+        bucket = self.buckets.setdefault(str((trans.get("action") or {}).get("action_name")), _ActionBucket(self.dim))
+        bucket.add(hash_vector(features, self.dim), key, signature)
+
+    def sync(self, store, kind: str) -> int:
+        """
+        コーパスストア (エントリのシーケンス) のうち、まだ索引にない末尾の分を加える。戻り値は加えた件数。
+        (同じ (task_id, step_id) の置き換えは索引に反映しない)
+        """
+        start = self.synced.get(kind, 0)
+        if len(store) < start:
+            # ストアが作り直された場合はその kind を入れ直す
+            for bucket in self.buckets.values():
+                keep = [j for j, key in enumerate(bucket.keys[:bucket.n]) if key[0] != kind]
+                bucket.vectors = bucket.vectors[keep].copy()
+                bucket.n = len(keep)
+                bucket.keys = [bucket.keys[j] for j in keep]
+                bucket.signatures = [bucket.signatures[j] for j in keep]
+            start = 0
+        for i in range(start, len(store)):
+            entry = store[i]
+            self.add(entry.get("step_data", entry), (kind, i))
+        self.synced[kind] = len(store)
+        return len(store) - start
+
+    def nearest(self, trans: Dict, n: int = 3, kind: Optional[str] = None,
+                exclude: Iterable[Tuple[str, int]] = ()) -> List[Tuple[float, Tuple[str, int]]]:
+        """
+        trans と同じ種類の行動の遷移から、類似度の高い順に最大 n 件の (類似度, キー) を返す。
+        特徴が完全に同じ遷移は 1 件だけ返す。
+        """
+        bucket = self.buckets.get(str((trans.get("action") or {}).get("action_name")))
+        if bucket is None or bucket.n == 0 or n <= 0:
+            return []
+        scores = bucket.vectors[:bucket.n] @ hash_vector(transition_features(trans), self.dim)
+        excluded = set(exclude)
+        seen_signatures = set()
+        result = []
+        for j in np.argsort(-scores, kind="stable"):
+            key = bucket.keys[j]
+            if key in excluded or (kind is not None and key[0] != kind) or bucket.signatures[j] in seen_signatures:
+                continue
+            seen_signatures.add(bucket.signatures[j])
+            result.append((float(scores[j]), key))
+            if len(result) >= n:
+                break
+        return result
@@ -0,0 +1,587 @@
+"""
+遷移コーパス (D_cor_all / D_inc_all) の列指向テーブル。
+
+D_*_all の各エントリは step_data.state.items_in_locations[...] や action.args などの入れ子の辞書で、
+stage4・確率計算・分析のたびに同じ辞書をたどり直している。ここでは一度だけ列に展開し、
+以降は NumPy の配列演算で走査できるようにする。
+
+- 文字列 (場所・アイテム・行動名・状態・タスク名) は共通の語彙で int32 の id にする。
+  None は NONE_ID、空文字列は他の文字列と同じく語彙の id (Python の == と同じ区別)。
+- 行ごとの列: task, step, action, pos, pos_status, hand, hand_status, success, state_flags, args[key]
+- 可変長のリストは CSR 形式で持つ:
+    行 -> 場所エントリ      (loc_offsets, loc_ids, loc_status)
+    場所エントリ -> items    (items_offsets, items_ids)
+    場所エントリ -> adjacent (adjacent_offsets, adjacent_ids)
+    行 -> reachable_locations (reach_offsets, reach_ids)
+- append() で行を追加できる (語彙の id は追加しても変わらない)。
+- save() したディレクトリは load(mmap=True) でメモリマップして開ける。
+- StoreTable はコーパスストア (corpus_store.py) の隣 (<base>.table/) に保存するテーブルで、
+  開くたびにストアに追加・置き換えられたエントリだけを append する。
+
+使用例:
+    table = TransitionTable.from_transitions([e["step_data"] for e in D_cor_all])
+    print(table.action_success_counts())
+
+    table = StoreTable.shared(cor_store)    # 保存済みならメモリマップで開いて差分だけ追加
+    rows = table.live_rows(success=True)
+    table.save()
+"""
+import itertools
+import json
+import os
+import shutil
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+NONE_ID = -1      # None
+UNKNOWN_ID = -2   # 語彙にない定数 (何とも一致しない)
+
+STATE_KEYS = ("reachable_locations", "items_in_locations", "item_in_hand", "current_position")
+LIST_KINDS = ("items", "adjacent")
+
+_ROW_COLUMNS = ("task", "step", "action", "pos", "pos_status", "hand", "hand_status")
+_ARRAY_NAMES = _ROW_COLUMNS + (
+    "success", "state_flags",
+    "loc_offsets", "loc_ids", "loc_status",
+    "items_offsets", "items_ids",
+    "adjacent_offsets", "adjacent_ids",
+    "reach_offsets", "reach_ids",
+)
+_META_FILE = "meta.json"
+_table_ids = itertools.count()
+
+
+def _sorted_contains(haystack: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """ソート済みの haystack に keys が含まれるか (二分探索)。"""
+    if len(haystack) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    pos = np.minimum(np.searchsorted(haystack, keys), len(haystack) - 1)
+    return haystack[pos] == keys
+
+
+def _offsets(lengths: List[int], start: int = 0) -> np.ndarray:
+    return start + np.concatenate(([0], np.cumsum(lengths, dtype=np.int64))).astype(np.int64)
+
+
+def _gather(offsets: np.ndarray, owners: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """CSR の owners 番目の要素だけを取り出した (新しい offsets, 元の要素番号)。"""
+    starts = np.asarray(offsets[owners], dtype=np.int64)
+    lengths = np.asarray(offsets[owners + 1], dtype=np.int64) - starts
+    new_offsets = _offsets(lengths)
+    index = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1], dtype=np.int64)
+    return new_offsets, index
+
+
+class TransitionTable:
+    """
+    遷移の列指向テーブル。from_transitions() で作成し、append() で増分更新する。
+    """
+
+    def __init__(self):
+        # プロセス内でテーブルを区別する番号 (作り直したテーブルは別の番号になる)。評価結果のキャッシュのキー
+        self.uid = next(_table_ids)
+        self.vocab: Dict[str, int] = {}
+        self.names: List[str] = []
+        self.n = 0
+        self.task = np.zeros(0, dtype=np.int32)
+        self.step = np.zeros(0, dtype=np.int32)
+        self.action = np.zeros(0, dtype=np.int32)
+        self.pos = np.zeros(0, dtype=np.int32)
+        self.pos_status = np.zeros(0, dtype=np.int32)
+        self.hand = np.zeros(0, dtype=np.int32)
+        self.hand_status = np.zeros(0, dtype=np.int32)
+        self.success = np.zeros(0, dtype=bool)
+        self.state_flags = np.zeros(0, dtype=np.uint8)
+        self.args: Dict[str, np.ndarray] = {}
+        self.loc_offsets = np.zeros(1, dtype=np.int64)
+        self.loc_ids = np.zeros(0, dtype=np.int32)
+        self.loc_status = np.zeros(0, dtype=np.int32)
+        self.items_offsets = np.zeros(1, dtype=np.int64)
+        self.items_ids = np.zeros(0, dtype=np.int32)
+        self.adjacent_offsets = np.zeros(1, dtype=np.int64)
+        self.adjacent_ids = np.zeros(0, dtype=np.int32)
+        self.reach_offsets = np.zeros(1, dtype=np.int64)
+        self.reach_ids = np.zeros(0, dtype=np.int32)
+        # 元の遷移 (Python 評価のフォールバック用)。load() したテーブルでは None
+        self.transitions: Optional[List[Dict]] = []
+        self._index_cache: Dict[str, Tuple] = {}
+
+    # ------------------------------------------------------------------
+    # 語彙
+    # ------------------------------------------------------------------
+
+    def intern(self, value) -> int:
+        if value is None:
+            return NONE_ID
+        value = str(value)
+        idx = self.vocab.get(value)
+        if idx is None:
+            idx = len(self.names)
+            self.vocab[value] = idx
+            self.names.append(value)
+        return idx
+
+    def lookup(self, value) -> int:
+        """定数の id (語彙にない文字列は UNKNOWN_ID)。"""
+        if value is None:
+            return NONE_ID
+        return self.vocab.get(str(value), UNKNOWN_ID)
+
+    def name(self, idx: int) -> Optional[str]:
+        return self.names[idx] if idx >= 0 else None
+
+    # ------------------------------------------------------------------
+    # 構築・増分更新
+    # ------------------------------------------------------------------
+
+    @classmethod
+    def from_transitions(cls, transitions: Iterable[Dict],
+                         keys: Optional[Sequence[Tuple]] = None) -> "TransitionTable":
+        """
+        step_data 形式の遷移 ({"state", "action", "action_result", ...}) から作る。
+        keys: 各遷移の (task_id, step_id)。省略時は task = None, step = 行番号。
+        """
+        table = cls()
+        table.append(transitions, keys)
+        return table
+
+    @classmethod
+    def from_corpus(cls, corpus: List[Dict]) -> "TransitionTable":
+        """D_cor_all / D_inc_all 形式 ({"task_id", "step_id", "step_data"} のリスト) から作る。"""
+        return cls.from_transitions([entry["step_data"] for entry in corpus],
+                                    [(entry.get("task_id"), entry.get("step_id")) for entry in corpus])
+
+    def append(self, transitions: Iterable[Dict], keys: Optional[Sequence[Tuple]] = None) -> None:
+        """行を末尾に追加する。既存の id・行番号は変わらない。"""
+        transitions = list(transitions)
+        if not transitions:
+            return
+        if keys is None:
+            keys = [(None, self.n + i) for i in range(len(transitions))]
+
+        rows = {name: [] for name in _ROW_COLUMNS}
+        success, state_flags = [], []
+        args: Dict[str, List[int]] = {}
+        loc_counts, loc_ids, loc_status = [], [], []
+        list_counts = {kind: [] for kind in LIST_KINDS}
+        list_ids = {kind: [] for kind in LIST_KINDS}
+        reach_counts, reach_ids = [], []
+
+        for row, (trans, (task_id, step_id)) in enumerate(zip(transitions, keys)):
+            state = trans.get("state") or {}
+            action = trans.get("action") or {}
+            position = state.get("current_position") or {}
+            hand = state.get("item_in_hand") or {}
+
+            rows["task"].append(self.intern(task_id))
+            rows["step"].append(self.intern(step_id))
+            rows["action"].append(self.intern(action.get("action_name")))
+            rows["pos"].append(self.intern(position.get("location_name")))
+            rows["pos_status"].append(self.intern(position.get("status")))
+            rows["hand"].append(self.intern(hand.get("item_name")))
+            rows["hand_status"].append(self.intern(hand.get("status")))
+            success.append(bool((trans.get("action_result") or {}).get("success", False)))
+            state_flags.append(sum(1 << i for i, key in enumerate(STATE_KEYS) if key in state))
+
+            for key, value in (action.get("args") or {}).items():
+                # 行ごとの値。まだ現れていない行は後で欠落 (UNKNOWN_ID) として埋める
+                args.setdefault(key, [UNKNOWN_ID] * row).append(self.intern(value))
+            for column in args.values():
+                if len(column) < row + 1:
+                    column.append(UNKNOWN_ID)
+
+            locations = state.get("items_in_locations") or {}
+            loc_counts.append(len(locations))
+            for loc, info in locations.items():
+                info = info or {}
+                loc_ids.append(self.intern(loc))
+                loc_status.append(self.intern(info.get("status")))
+                for kind in LIST_KINDS:
+                    values = info.get(kind) or []
+                    list_counts[kind].append(len(values))
+                    list_ids[kind].extend(self.intern(v) for v in values)
+
+            reachable = state.get("reachable_locations") or []
+            reach_counts.append(len(reachable))
+            reach_ids.extend(self.intern(v) for v in reachable)
+
+        count = len(transitions)
+        for name in _ROW_COLUMNS:
+            setattr(self, name, np.concatenate((getattr(self, name), np.asarray(rows[name], dtype=np.int32))))
+        self.success = np.concatenate((self.success, np.asarray(success, dtype=bool)))
+        self.state_flags = np.concatenate((self.state_flags, np.asarray(state_flags, dtype=np.uint8)))
+
+        # 引数の列: 既存テーブルにない引数は既存行を UNKNOWN_ID (= 欠落) で埋める
+        for key in set(self.args) | set(args):
+            old = self.args.get(key, np.full(self.n, UNKNOWN_ID, dtype=np.int32))
+            new = np.asarray(args.get(key, [UNKNOWN_ID] * count), dtype=np.int32)
+            self.args[key] = np.concatenate((old, new))
+
+        self.loc_offsets = np.concatenate((self.loc_offsets[:-1], _offsets(loc_counts, self.loc_offsets[-1])))
+        self.loc_ids = np.concatenate((self.loc_ids, np.asarray(loc_ids, dtype=np.int32)))
+        self.loc_status = np.concatenate((self.loc_status, np.asarray(loc_status, dtype=np.int32)))
+        for kind in LIST_KINDS:
+            offsets = getattr(self, f"{kind}_offsets")
+            setattr(self, f"{kind}_offsets", np.concatenate((offsets[:-1], _offsets(list_counts[kind], offsets[-1]))))
+            setattr(self, f"{kind}_ids", np.concatenate((getattr(self, f"{kind}_ids"), np.asarray(list_ids[kind], dtype=np.int32))))
+        self.reach_offsets = np.concatenate((self.reach_offsets[:-1], _offsets(reach_counts, self.reach_offsets[-1])))
+        self.reach_ids = np.concatenate((self.reach_ids, np.asarray(reach_ids, dtype=np.int32)))
+
+        if self.transitions is not None:
+            self.transitions.extend(transitions)
+        self.n += count
+        self._index_cache.clear()
+
+    # ------------------------------------------------------------------
+    # 保存・メモリマップ
+    # ------------------------------------------------------------------
+
+    def save(self, path: str) -> None:
+        """ディレクトリに配列 (.npy) と語彙 (meta.json) を書き出す。"""
+        os.makedirs(path, exist_ok=True)
+        for name in _ARRAY_NAMES:
+            np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(getattr(self, name)))
+        arg_keys = sorted(self.args)
+        for i, key in enumerate(arg_keys):
+            np.save(os.path.join(path, f"arg_{i}.npy"), np.ascontiguousarray(self.args[key]))
+        meta = {"n": self.n, "names": self.names, "arg_keys": arg_keys}
+        with open(os.path.join(path, _META_FILE), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "TransitionTable":
+        """
+        save() したテーブルを開く。mmap=True なら配列は読み取り専用のメモリマップになる
+        (append() すると追記分を含む配列がメモリ上に作り直される)。
+        """
+        with open(os.path.join(path, _META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        mode = "r" if mmap else None
+        table = cls()
+        table.names = list(meta["names"])
+        table.vocab = {name: i for i, name in enumerate(table.names)}
+        table.n = meta["n"]
+        for name in _ARRAY_NAMES:
+            setattr(table, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mode))
+        table.args = {key: np.load(os.path.join(path, f"arg_{i}.npy"), mmap_mode=mode)
+                      for i, key in enumerate(meta["arg_keys"])}
+        table.transitions = None
+        return table
+
+    @property
+    def nbytes(self) -> int:
+        """配列が占めるバイト数 (語彙を除く)。"""
+        return sum(getattr(self, name).nbytes for name in _ARRAY_NAMES) + sum(a.nbytes for a in self.args.values())
+
+    # ------------------------------------------------------------------
+    # 行の参照
+    # ------------------------------------------------------------------
+
+    def key(self, row: int) -> Tuple[Optional[str], Optional[str]]:
+        """行の (task_id, step_id)。step_id は文字列で返る。"""
+        return self.name(int(self.task[row])), self.name(int(self.step[row]))
+
+    def row_dict(self, row: int) -> Dict:
+        """
+        行を step_data 形式の辞書に戻す (scene_graph は含まない)。
+        元の遷移を持たないテーブル (load() したもの) で Python のルール関数を実行するときに使う。
+        """
+        name = self.name
+        locations = {}
+        for entry in range(int(self.loc_offsets[row]), int(self.loc_offsets[row + 1])):
+            info = {}
+            for kind in LIST_KINDS:
+                offsets, ids = getattr(self, f"{kind}_offsets"), getattr(self, f"{kind}_ids")
+                info[kind] = [name(int(i)) for i in ids[offsets[entry]:offsets[entry + 1]]]
+            info["status"] = name(int(self.loc_status[entry]))
+            locations[name(int(self.loc_ids[entry]))] = info
+
+        flags = int(self.state_flags[row])
+        state = {}
+        if flags & (1 << STATE_KEYS.index("reachable_locations")):
+            state["reachable_locations"] = [name(int(i)) for i in self.reach_ids[self.reach_offsets[row]:self.reach_offsets[row + 1]]]
+        if flags & (1 << STATE_KEYS.index("items_in_locations")):
+            state["items_in_locations"] = locations
+        if flags & (1 << STATE_KEYS.index("item_in_hand")):
+            state["item_in_hand"] = {"item_name": name(int(self.hand[row])), "status": name(int(self.hand_status[row]))}
+        if flags & (1 << STATE_KEYS.index("current_position")):
+            state["current_position"] = {"location_name": name(int(self.pos[row])), "status": name(int(self.pos_status[row]))}
+
+        args = {key: name(int(column[row])) for key, column in self.args.items() if column[row] != UNKNOWN_ID}
+        return {
+            "state": state,
+            "action": {"action_name": name(int(self.action[row])), "args": args},
+            "action_result": {"success": bool(self.success[row])},
+        }
+
+    def transition(self, row: int) -> Dict:
+        """元の遷移があればそれを、なければ row_dict() を返す。"""
+        if self.transitions is not None:
+            return self.transitions[row]
+        return self.row_dict(row)
+
+    def subset(self, rows: np.ndarray) -> "TransitionTable":
+        """
+        rows の行だけを持つテーブル (語彙は共有し、配列はコピーする)。
+        一部の行だけをベクトル評価するときに使う。元の遷移は持たない。
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        table = TransitionTable()
+        table.vocab, table.names = self.vocab, self.names
+        table.n = len(rows)
+        for name in _ROW_COLUMNS + ("success", "state_flags"):
+            setattr(table, name, np.asarray(getattr(self, name)[rows]))
+        table.args = {key: np.asarray(column[rows]) for key, column in self.args.items()}
+        table.loc_offsets, entries = _gather(self.loc_offsets, rows)
+        table.loc_ids = np.asarray(self.loc_ids[entries])
+        table.loc_status = np.asarray(self.loc_status[entries])
+        for kind in LIST_KINDS:
+            offsets, index = _gather(getattr(self, f"{kind}_offsets"), entries)
+            setattr(table, f"{kind}_offsets", offsets)
+            setattr(table, f"{kind}_ids", np.asarray(getattr(self, f"{kind}_ids")[index]))
+        table.reach_offsets, index = _gather(self.reach_offsets, rows)
+        table.reach_ids = np.asarray(self.reach_ids[index])
+        table.transitions = None
+        return table
+
+    # ------------------------------------------------------------------
+    # ベクトル化された問い合わせ (引数はすべて長さ n の id 配列)
+    # ------------------------------------------------------------------
+
+    def rows(self) -> np.ndarray:
+        return np.arange(self.n, dtype=np.int64)
+
+    @property
+    def width(self) -> int:
+        return len(self.names) + 1
+
+    def arg(self, key: str) -> np.ndarray:
+        """引数の id 列。引数がない行は NONE_ID (action["args"].get(key) と同じ)。"""
+        column = self.args.get(key)
+        if column is None:
+            return np.full(self.n, NONE_ID, dtype=np.int32)
+        return np.where(column == UNKNOWN_ID, NONE_ID, column).astype(np.int32)
+
+    def truthy(self, ids: np.ndarray) -> np.ndarray:
+        """id 列の Python での真偽値 (None と空文字列が偽)。"""
+        return (ids >= 0) & (ids != self.lookup(""))
+
+    def has_arg(self, key: str) -> np.ndarray:
+        column = self.args.get(key)
+        if column is None:
+            return np.zeros(self.n, dtype=bool)
+        return column != UNKNOWN_ID
+
+    def state_has(self, key: str) -> np.ndarray:
+        return (self.state_flags & np.uint8(1 << STATE_KEYS.index(key))) != 0
+
+    def _location_index(self):
+        """(row, loc) -> 場所エントリ番号 の検索用インデックス。"""
+        cached = self._index_cache.get("locations")
+        if cached is None:
+            entry_rows = np.repeat(self.rows(), np.diff(self.loc_offsets))
+            keys = entry_rows * self.width + self.loc_ids
+            order = np.argsort(keys, kind="stable")
+            cached = (keys[order], order)
+            self._index_cache["locations"] = cached
+        return cached
+
+    def _list_index(self, kind: str) -> np.ndarray:
+        cached = self._index_cache.get(kind)
+        if cached is None:
+            if kind == "reachable":
+                owners = np.repeat(self.rows(), np.diff(self.reach_offsets))
+                ids = self.reach_ids
+            else:
+                offsets = getattr(self, f"{kind}_offsets")
+                owners = np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+                ids = getattr(self, f"{kind}_ids")
+            cached = np.unique(owners * self.width + ids)
+            self._index_cache[kind] = cached
+        return cached
+
+    def location_entries(self, loc: np.ndarray) -> np.ndarray:
+        """各行の items_in_locations[loc] の場所エントリ番号 (ない行は -1)。"""
+        sorted_keys, order = self._location_index()
+        if len(sorted_keys) == 0:
+            return np.full(self.n, -1, dtype=np.int64)
+        keys = self.rows() * self.width + loc
+        pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+        found = (loc >= 0) & (sorted_keys[pos] == keys)
+        return np.where(found, order[pos], -1)
+
+    def has_location(self, loc: np.ndarray) -> np.ndarray:
+        return self.location_entries(loc) >= 0
+
+    def location_status(self, loc: np.ndarray) -> np.ndarray:
+        entries = self.location_entries(loc)
+        if len(self.loc_status) == 0:
+            return np.full(self.n, NONE_ID, dtype=np.int32)
+        return np.where(entries >= 0, self.loc_status[np.maximum(entries, 0)], NONE_ID).astype(np.int32)
+
+    def in_location_list(self, item: np.ndarray, loc: np.ndarray, kind: str) -> np.ndarray:
+        """item in items_in_locations[loc][kind] (kind は "items" / "adjacent")。"""
+        entries = self.location_entries(loc)
+        keys = entries * self.width + item
+        return (entries >= 0) & (item >= 0) & _sorted_contains(self._list_index(kind), keys)
+
+    def in_reachable(self, item: np.ndarray) -> np.ndarray:
+        keys = self.rows() * self.width + item
+        return (item >= 0) & _sorted_contains(self._list_index("reachable"), keys)
+
+    # ------------------------------------------------------------------
+    # 集計
+    # ------------------------------------------------------------------
+
+    def action_success_counts(self) -> Dict[str, Dict[str, int]]:
+        """行動ごとの {"total", "success"} の件数。"""
+        valid = self.action >= 0
+        size = len(self.names)
+        total = np.bincount(self.action[valid], minlength=size)
+        succeeded = np.bincount(self.action[valid & self.success], minlength=size)
+        return {self.names[i]: {"total": int(total[i]), "success": int(succeeded[i])}
+                for i in np.nonzero(total)[0]}
+
+    def rows_where(self, action: Optional[str] = None, success: Optional[bool] = None) -> np.ndarray:
+        """条件に合う行番号。"""
+        mask = np.ones(self.n, dtype=bool)
+        if action is not None:
+            mask &= self.action == self.lookup(action)
+        if success is not None:
+            mask &= self.success == success
+        return np.nonzero(mask)[0]
+
+
+class StoreTable(TransitionTable):
+    """
+    コーパスストアのエントリを行に持つ TransitionTable。ストアの隣 (<base>.table/) に保存し、
+    次に開くときはメモリマップで読み込んで、ストアに追加・置き換えられたエントリだけを append する。
+
+    - store_index[row]: 行の元になったストアのエントリ番号
+    - source[row]: そのときのエントリの .dat 上のオフセット。stage1 が replace() したエントリは
+      オフセットが変わるので、古い行を live=False にして新しい内容を末尾に追加する (既存の行番号は変わらない)
+    - 元の遷移はメモリに持たず、transition() でストアから 1 件ずつ読む
+    """
+
+    _shared: Dict[str, "StoreTable"] = {}
+    _STORE_ARRAYS = ("store_index", "source", "live")
+
+    def __init__(self, store=None):
+        super().__init__()
+        self.store = store
+        self.transitions = None
+        self.store_index = np.zeros(0, dtype=np.int64)
+        self.source = np.zeros(0, dtype=np.int64)
+        self.live = np.zeros(0, dtype=bool)
+        self.dat_size = 0
+        self.dirty = False
+
+    @staticmethod
+    def path_for(store) -> str:
+        return store.base_path + ".table"
+
+    @classmethod
+    def open(cls, store, mmap: bool = True) -> "StoreTable":
+        """保存済みのテーブルがあれば開き、ストアとの差分を取り込んで返す。"""
+        path = cls.path_for(store)
+        table = None
+        if os.path.exists(os.path.join(path, _META_FILE)):
+            try:
+                table = cls.load(path, mmap=mmap)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Warning: {path} を読み込めないため作り直します ({e})")
+        if table is None:
+            table = cls()
+        table.store = store
+        return table.sync()
+
+    @classmethod
+    def shared(cls, store) -> "StoreTable":
+        """プロセス内で使い回すテーブル (呼び出すたびにストアとの差分を取り込む)。"""
+        key = os.path.abspath(store.base_path)
+        table = cls._shared.get(key)
+        if table is None or table.store is not store:
+            table = cls.open(store)
+            cls._shared[key] = table
+            return table
+        return table.sync()
+
+    def sync(self) -> "StoreTable":
+        """ストアに追加・置き換えられたエントリを取り込む。"""
+        store = self.store
+        offsets = np.asarray(store.offsets(), dtype=np.int64)
+        dat_size = os.path.getsize(store.dat_path)
+        live_rows = np.nonzero(self.live)[0]
+        indices = self.store_index[live_rows]
+        # ストアが作り直された・compact() された (.dat が縮んだ) とき、置き換えで古い行の方が多くなったときは
+        # 全行を読み直す
+        if dat_size < self.dat_size or (len(indices) and int(indices.max()) >= len(offsets)) \
+                or self.n - len(live_rows) > len(live_rows):
+            self.__init__(store)
+            live_rows = indices = np.zeros(0, dtype=np.int64)
+        self.dat_size = dat_size
+
+        stale = offsets[indices] != self.source[live_rows]
+        current = np.zeros(len(offsets), dtype=bool)
+        current[indices[~stale]] = True
+        todo = np.nonzero(~current)[0]
+        if len(todo) == 0:
+            return self
+
+        if stale.any():
+            self.live = np.array(self.live)
+            self.live[live_rows[stale]] = False
+        entries = [store[int(i)] for i in todo]
+        self.append([entry["step_data"] for entry in entries],
+                    [(entry.get("task_id"), entry.get("step_id")) for entry in entries])
+        self.store_index = np.concatenate((self.store_index, todo.astype(np.int64)))
+        self.source = np.concatenate((self.source, offsets[todo]))
+        self.live = np.concatenate((self.live, np.ones(len(todo), dtype=bool)))
+        self.dirty = True
+        return self
+
+    def live_rows(self, success: Optional[bool] = None) -> np.ndarray:
+        """ストアの現在の内容に対応する行 (success を指定するとその結果の行だけ)。"""
+        mask = np.array(self.live)
+        if success is not None:
+            mask &= self.success == success
+        return np.nonzero(mask)[0]
+
+    def transition(self, row: int) -> Dict:
+        return self.store[int(self.store_index[row])]["step_data"]
+
+    def save(self, path: Optional[str] = None) -> None:
+        """
+        テーブルを保存する。一時ディレクトリに書いてから差し替えるので、読み込み中の他プロセスは
+        古いテーブルか新しいテーブルのどちらかを見る。前回の保存・読み込みから変化がなければ書かない。
+        """
+        if not self.dirty:
+            return
+        path = path or self.path_for(self.store)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        old_path = f"{path}.{os.getpid()}.old"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        super().save(tmp_path)
+        for name in self._STORE_ARRAYS:
+            np.save(os.path.join(tmp_path, f"{name}.npy"), np.ascontiguousarray(getattr(self, name)))
+        with open(os.path.join(tmp_path, "store.json"), "w", encoding="utf-8") as f:
+            json.dump({"dat_size": self.dat_size}, f)
+        if os.path.exists(path):
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "StoreTable":
+        table = super().load(path, mmap=mmap)
+        mode = "r" if mmap else None
+        for name in cls._STORE_ARRAYS:
+            setattr(table, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mode))
+        if len(table.store_index) != table.n:
+            raise ValueError(f"{path}: store_index has {len(table.store_index)} rows, expected {table.n}")
+        with open(os.path.join(path, "store.json"), "r", encoding="utf-8") as f:
+            table.dat_size = json.load(f)["dat_size"]
+        table.transitions = None
+        return table
@@ -0,0 +1,296 @@
+"""
+STAGE3 の自然言語ルール → Python 関数 の翻訳キャッシュ。
+
+action_rules_improve.json の final_rules は毎ステップほぼ同じ内容で、Rule 98, 99, 100... のように
+番号だけが振り直されることも多い。ここでは「Rule N:」を除いて正規化したルール文のハッシュをキーに、
+生成された関数のソースとコンパイル結果を ./CodeRule/translation_cache.json に保存する。
+STAGE3.generate_coderule はキャッシュにないルールだけを LLM に送り、キャッシュ済みの関数は
+現在の番号に関数名を付け替えて再利用する。
+
+エントリ:
+    {
+        "rule_text": 元のルール文 (最後に翻訳したもの),
+        "function_name": "Rule_69_goto",
+        "source": 関数定義のソース,
+        "prelude": [関数が依存するモジュール先頭の import / ヘルパ定義],
+        "compiles": bool,
+        "error": コンパイルエラー (あれば)
+    }
+"""
+import ast
+import hashlib
+import json
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+from filelock import FileLock
+
+DEFAULT_CACHE_PATH = os.path.join("CodeRule", "translation_cache.json")
+
+_RULE_PREFIX = re.compile(r"^\s*Rule\s+(\d+)\s*[:：.]\s*", re.IGNORECASE)
+_RULE_FUNC = re.compile(r"^Rule_(\d+)_(\w+)$")
+_DEF_NAME = re.compile(r"(\bdef\s+)Rule_\d+_(\w+)(\s*\()")
+
+
+def rule_number(rule_text: str) -> Optional[int]:
+    """"Rule 69: ..." の 69。番号がなければ None。"""
+    m = _RULE_PREFIX.match(rule_text)
+    return int(m.group(1)) if m else None
+
+
+def normalize_rule_text(rule_text: str) -> str:
+    """ルール番号・大文字小文字・空白の違いを除いたルール文。"""
+    text = _RULE_PREFIX.sub("", rule_text)
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def rule_text_hash(rule_text: str) -> str:
+    return hashlib.sha256(normalize_rule_text(rule_text).encode("utf-8")).hexdigest()
+
+
+def function_rule_number(function_name: str) -> Optional[int]:
+    """Rule_69_goto -> 69"""
+    m = _RULE_FUNC.match(function_name)
+    return int(m.group(1)) if m else None
+
+
+def final_rules_of(ar_data) -> List[str]:
+    """action_rules_improve.json の内容 (dict または JSON 文字列) から final_rules を取り出す。"""
+    if isinstance(ar_data, str):
+        ar_data = json.loads(ar_data)
+    return ar_data.get("final_rules", [])
+
+
+def match_rule_functions(rules: List[str], indices: List[int], names: List[str]) -> Dict[int, str]:
+    """
+    rules[indices] と生成された関数名を対応付ける ({添字: 関数名})。
+    関数名の番号 (Rule_<n>_...) で対応付け、残りは数が同じなら出現順で対応付ける。
+    """
+    by_number = {function_rule_number(name): name for name in names}
+    matched: Dict[int, str] = {}
+    unmatched_rules = []
+    for i in indices:
+        name = by_number.get(rule_number(rules[i]))
+        if name is None or name in matched.values():
+            unmatched_rules.append(i)
+        else:
+            matched[i] = name
+    unmatched_names = [name for name in names if name not in matched.values()]
+    if len(unmatched_rules) == len(unmatched_names):
+        matched.update(zip(unmatched_rules, unmatched_names))
+    return matched
+
+
+def function_name(source: str) -> Optional[str]:
+    """関数定義のソースから関数名を取り出す。"""
+    m = re.search(r"\bdef\s+(\w+)\s*\(", source)
+    return m.group(1) if m else None
+
+
+def rename_rule_function(source: str, number: int) -> str:
+    """関数定義の Rule_<n>_<action> の番号を付け替える。"""
+    return _DEF_NAME.sub(lambda m: f"{m.group(1)}Rule_{number}_{m.group(2)}{m.group(3)}", source, count=1)
+
+
+def _node_source(lines: List[str], node: ast.AST) -> str:
+    start = min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])]) - 1
+    return "\n".join(lines[start:node.end_lineno])
+
+
+def split_rule_functions(code: str) -> Tuple[Dict[str, str], List[str]]:
+    """
+    LLM の出力を Rule_* 関数ごとのソースに分ける。
+
+    Returns:
+        (functions, prelude)
+        functions: {関数名: 関数定義のソース} (出現順)
+        prelude: Rule_* 以外のトップレベルの文 (import やヘルパ関数) のソース
+    Raises:
+        SyntaxError: コード全体がパースできない場合
+    """
+    tree = ast.parse(code)
+    lines = code.split("\n")
+    functions: Dict[str, str] = {}
+    prelude: List[str] = []
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name.startswith("Rule_"):
+            functions[node.name] = _node_source(lines, node)
+        else:
+            prelude.append(_node_source(lines, node))
+    return functions, prelude
+
+
+_TOP_LEVEL_START = re.compile(r"^(?:@|def\s|async\s+def\s|class\s|import\s|from\s|[A-Za-z_][\w.]*\s*=)")
+_RULE_DEF = re.compile(r"^def\s+(Rule_\w+)\s*\(", re.MULTILINE)
+
+
+def _top_level_chunks(code: str) -> List[str]:
+    """トップレベルの文の先頭行でコードを区切る (デコレータは直後の定義と同じ塊にする)。"""
+    chunks: List[List[str]] = []
+    for line in code.split("\n"):
+        if _TOP_LEVEL_START.match(line) and not (chunks and all(l.startswith("@") for l in chunks[-1] if l.strip())
+                                                   and chunks[-1][0].startswith("@")):
+            chunks.append([line])
+        elif chunks:
+            chunks[-1].append(line)
+        elif line.strip():
+            chunks.append([line])
+    return ["\n".join(chunk).rstrip() for chunk in chunks]
+
+
+def split_rule_functions_lenient(code: str) -> Tuple[Dict[str, str], List[str], Dict[str, Tuple[str, str]]]:
+    """
+    split_rule_functions と同じだが、コード全体がパースできなくても関数ごとに分けて拾う。
+
+    Returns:
+        (functions, prelude, broken)
+        broken: {関数名: (ソース, 構文エラー)} (パースできなかった Rule_* 関数)
+    """
+    try:
+        functions, prelude = split_rule_functions(code)
+        return functions, prelude, {}
+    except SyntaxError:
+        pass
+
+    def parses(text: str) -> bool:
+        try:
+            ast.parse(text)
+            return True
+        except SyntaxError:
+            return False
+
+    # 文字列リテラル内の行で誤って区切った場合は、単独ではパースできない隣同士をつなぐ
+    chunks = _top_level_chunks(code)
+    merged: List[str] = []
+    i = 0
+    while i < len(chunks):
+        chunk = chunks[i]
+        while not parses(chunk) and i + 1 < len(chunks) and not parses(chunks[i + 1]) \
+                and parses(chunk + "\n" + chunks[i + 1]):
+            chunk = chunk + "\n" + chunks[i + 1]
+            i += 1
+        merged.append(chunk)
+        i += 1
+
+    functions: Dict[str, str] = {}
+    prelude: List[str] = []
+    broken: Dict[str, Tuple[str, str]] = {}
+    for chunk in merged:
+        m = _RULE_DEF.search(chunk)
+        try:
+            ast.parse(chunk)
+        except SyntaxError as e:
+            if m:
+                broken[m.group(1)] = (chunk, f"SyntaxError: {e}")
+            continue
+        if m:
+            functions[m.group(1)] = chunk
+        elif chunk.strip():
+            prelude.append(chunk)
+    return functions, prelude, broken
+
+
+def compile_status(source: str, prelude: List[str] = ()) -> Tuple[bool, Optional[str]]:
+    """関数 (と prelude) がコンパイルできるか。"""
+    try:
+        compile("\n\n".join(list(prelude) + [source]), "<code_rule>", "exec")
+        return True, None
+    except SyntaxError as e:
+        return False, f"{type(e).__name__}: {e}"
+
+
+def assemble_code(prelude: List[str], functions: List[str]) -> str:
+    """prelude (重複を除く) と関数を 1 つのコードにまとめる。"""
+    blocks = []
+    for block in prelude:
+        if block not in blocks:
+            blocks.append(block)
+    return "\n\n".join(blocks + list(functions)) + "\n"
+
+
+class TranslationCache:
+    """
+    正規化ルール文ハッシュ → 翻訳結果 の永続キャッシュ。
+    保存時は FileLock を取り、ディスク上の他プロセスのエントリとマージする。
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH):
+        self.path = path
+        self.entries: Dict[str, Dict] = {}
+        self._dirty = set()
+        self.load()
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            try:
+                self.entries.update(json.load(f))
+            except json.JSONDecodeError:
+                print(f"Warning: {self.path} のパース失敗。翻訳キャッシュなしで開始。")
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, rule_text: str) -> Optional[Dict]:
+        """コンパイルできる翻訳があれば返す。"""
+        entry = self.entries.get(rule_text_hash(rule_text))
+        if entry is None or not entry.get("compiles"):
+            return None
+        return entry
+
+    def source_for(self, rule_text: str) -> Optional[Tuple[str, List[str]]]:
+        """キャッシュ済みの関数を現在のルール番号に付け替えたソースと prelude。"""
+        entry = self.get(rule_text)
+        if entry is None:
+            return None
+        number = rule_number(rule_text)
+        source = entry["source"] if number is None else rename_rule_function(entry["source"], number)
+        return source, entry.get("prelude", [])
+
+    def put(self, rule_text: str, function_name: str, source: str, prelude: List[str] = ()) -> Dict:
+        compiles, error = compile_status(source, prelude)
+        key = rule_text_hash(rule_text)
+        entry = {
+            "rule_text": rule_text,
+            "function_name": function_name,
+            "source": source,
+            "prelude": list(prelude),
+            "compiles": compiles,
+            "error": error,
+        }
+        self.entries[key] = entry
+        self._dirty.add(key)
+        return entry
+
+    def invalidate(self, rule_text: str, error: str = None) -> None:
+        """翻訳が使えないと分かったルールを次回 LLM に送り直すようにする。"""
+        key = rule_text_hash(rule_text)
+        if key in self.entries:
+            self.entries[key]["compiles"] = False
+            self.entries[key]["error"] = error
+            self._dirty.add(key)
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        dir_name = os.path.dirname(self.path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        with FileLock(self.path + ".lock"):
+            on_disk = {}
+            if os.path.exists(self.path):
+                with open(self.path, "r", encoding="utf-8") as f:
+                    try:
+                        on_disk = json.load(f)
+                    except json.JSONDecodeError:
+                        on_disk = {}
+            for key in self._dirty:
+                on_disk[key] = self.entries[key]
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(on_disk, f, indent=4, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self.entries.update({k: v for k, v in on_disk.items() if k not in self.entries})
+        self._dirty.clear()
@@ -0,0 +1,484 @@
+"""
+ローカルの帰納論理プログラミング (ILP) による action_failed/1 ルールの学習。
+
+MakeILASPRule.py の ILASP_LLM は自然言語のアクションルールを GPT に Prolog へ書き換えさせていたが、
+ILPInducer は遷移 (D_all / D_cor_all / D_inc_all) から直接ルールを学習する。LLM を使わないので
+結果は決定的で、オフラインで動く。
+
+- 例: 各遷移を JSONtoFacts.state_action_to_facts のファクトにし、行動の種類ごとに
+      失敗した遷移を正例、成功した遷移を負例とする。
+- 語彙: JSONtoFacts の述語 (current_position/1, location_status/2, item_in_hand/2,
+        reachable_location/1, items_in_location/2, empty/1) とその否定 (\\+)。
+        引数は型 (item / loc / status) の合う束縛済み変数・新しい変数・無名変数・定数 (状態の値と null)。
+- 探索: 本体が空の節からリテラルを 1 つずつ加えるトップダウン探索 (本体の長さは max_len まで、各段は beam 件)。
+        カバーする例は int のビット集合で持ち、子の節は親がカバーした例だけで評価する。
+        1 つのヘッドで評価する (リテラル, 例) の組は max_work 件までで、超えたらそこまでの最良の節を使う。
+- 選択: 負例を max_neg 件以下しかカバーせず、まだカバーしていない正例を最も多くカバーする節を
+        貪欲に選ぶ (sequential covering)。本体にヘッドの変数を使うリテラルがない節は選ばない
+        (本体のない節や location_status(_, null) のような、行動の引数によらない節は無条件の失敗と同じになる)。
+- 行動の種類 (ヘッド) ごとに独立なので、ProcessPoolExecutor で並列に学習する。
+- 結果はヘッドごとに例の内容のハッシュで cache_file に保存し、例が変わったヘッドだけ学習し直す。
+
+使用例:
+    ilp = ILPInducer(max_len=3, cache_file="./OurRule/output/Prolog/ilp_cache.json")
+    prolog_rules = ilp.induce(D_all)
+    ilp.save_connect("./OurRule/output/Prolog/all_prolog_rules.pl", prolog_rules)
+"""
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .JSONtoFacts import state_action_to_facts
+
+# 述語 -> 引数の型
+PREDICATES: Dict[str, Tuple[str, ...]] = {
+    "current_position": ("loc",),
+    "location_status": ("loc", "status"),
+    "item_in_hand": ("item", "status"),
+    "reachable_location": ("loc",),
+    "items_in_location": ("item", "loc"),
+    "empty": ("loc",),
+}
+
+# 行動の引数 (JSONtoFacts の action(...) の順) -> (変数名, 型)
+ACTION_ARGS: Dict[str, Tuple[Tuple[str, str], ...]] = {
+    "goto": (("Recep", "loc"),),
+    "take": (("Obj", "item"), ("Recep", "loc")),
+    "put": (("Obj", "item"), ("Recep", "loc")),
+    "open": (("Recep", "loc"),),
+    "close": (("Recep", "loc"),),
+    "clean": (("Obj", "item"), ("Recep", "loc")),
+    "heat": (("Obj", "item"), ("Recep", "loc")),
+    "cool": (("Obj", "item"), ("Recep", "loc")),
+    "use": (("Tool", "item"),),
+}
+
+ANON = "_"
+NULL = "null"
+
+_FACT = re.compile(r"^(\w+)\((.*)\)\.?$")
+
+# 例: (行動名, 行動の引数, {述語: [引数のタプル]}, 成功したか)
+Example = Tuple[str, Tuple[str, ...], Dict[str, List[Tuple[str, ...]]], bool]
+# リテラル: (否定か, 述語, 引数)。引数は変数名 (大文字で始まる)・"_"・定数
+LiteralT = Tuple[bool, str, Tuple[str, ...]]
+
+
+def _split_args(text: str) -> Tuple[str, ...]:
+    return tuple(arg.strip() for arg in text.split(",")) if text.strip() else ()
+
+
+def transition_to_example(trans: Dict) -> Optional[Example]:
+    """遷移 (step_data) を例にする。行動が JSONtoFacts で表せない場合は None。"""
+    facts: Dict[str, List[Tuple[str, ...]]] = {}
+    action = None
+    for line in state_action_to_facts(trans).splitlines():
+        m = _FACT.match(line.strip())
+        if not m:
+            continue
+        name, inner = m.group(1), m.group(2)
+        if name == "action":
+            am = _FACT.match(inner)
+            if am:
+                action = (am.group(1), _split_args(am.group(2)))
+            continue
+        facts.setdefault(name, []).append(_split_args(inner))
+    if action is None or action[0] not in ACTION_ARGS:
+        return None
+    success = bool((trans.get("action_result") or {}).get("success", False))
+    return action[0], action[1], facts, success
+
+
+def iter_transitions(data) -> Iterable[Dict]:
+    """
+    D_all ({task_id: {step_id: 遷移}})・D_cor_all / D_inc_all 形式のリスト ({"step_data": ...})・
+    遷移のリストのいずれからも遷移を取り出す。
+    """
+    if isinstance(data, dict):
+        for task_data in data.values():
+            if isinstance(task_data, dict):
+                yield from task_data.values()
+        return
+    for entry in data:
+        yield entry.get("step_data", entry)
+
+
+def _is_var(term: str) -> bool:
+    return term[:1].isupper()
+
+
+class _FactIndex:
+    """1 つの例のファクトの索引 (述語ごとの集合と、(述語, 引数の位置, 値) ごとのリスト)。"""
+
+    def __init__(self, facts: Dict[str, List[Tuple[str, ...]]]):
+        self.sets = {name: set(rows) for name, rows in facts.items()}
+        self.by_arg: Dict[Tuple[str, int, str], List[Tuple[str, ...]]] = {}
+        for name, rows in self.sets.items():
+            for row in rows:
+                for pos, value in enumerate(row):
+                    self.by_arg.setdefault((name, pos, value), []).append(row)
+
+    def candidates(self, name: str, pattern: Tuple[str, ...]):
+        """pattern (束縛済みの値に置き換えたもの) に合いうるファクト。"""
+        if not any(_is_var(p) or p == ANON for p in pattern):
+            return (pattern,) if pattern in self.sets.get(name, ()) else ()
+        for pos, p in enumerate(pattern):
+            if not _is_var(p) and p != ANON:
+                return self.by_arg.get((name, pos, p), ())
+        return self.sets.get(name, ())
+
+
+def _substitute(args: Tuple[str, ...], binding: Dict[str, str]) -> Tuple[str, ...]:
+    return tuple(binding.get(a, a) if _is_var(a) else a for a in args)
+
+
+def _match(pattern: Tuple[str, ...], fact: Tuple[str, ...], binding: Dict[str, str]) -> Optional[Dict[str, str]]:
+    """pattern (束縛済みの変数は置き換え済み) と fact を単一化した代入。"""
+    new = None
+    for p, v in zip(pattern, fact):
+        if p == ANON:
+            continue
+        if _is_var(p):
+            bound = None if new is None else new.get(p)
+            if bound is None:
+                if new is None:
+                    new = dict(binding)
+                new[p] = v
+            elif bound != v:
+                return None
+        elif p != v:
+            return None
+    return binding if new is None else new
+
+
+def _satisfied(body: Sequence[LiteralT], facts: _FactIndex, binding: Dict[str, str]) -> bool:
+    """本体を満たす代入があるか (否定リテラルの変数は直前までに束縛されている)。"""
+    if not body:
+        return True
+    negated, name, args = body[0]
+    pattern = _substitute(args, binding)
+    candidates = facts.candidates(name, pattern)
+    if negated:
+        if any(_match(pattern, fact, binding) is not None for fact in candidates):
+            return False
+        return _satisfied(body[1:], facts, binding)
+    for fact in candidates:
+        new = _match(pattern, fact, binding)
+        if new is not None and _satisfied(body[1:], facts, new):
+            return True
+    return False
+
+
+def _bits(mask: int) -> List[int]:
+    result = []
+    while mask:
+        low = mask & -mask
+        result.append(low.bit_length() - 1)
+        mask ^= low
+    return result
+
+
+class _Clause:
+    def __init__(self, body: Tuple[LiteralT, ...], var_types: Dict[str, str], cover: int):
+        self.body = body
+        self.var_types = var_types
+        self.cover = cover
+
+
+def _literal_text(literal: LiteralT) -> str:
+    negated, name, args = literal
+    text = f"{name}({', '.join(args)})"
+    return f"\\+ {text}" if negated else text
+
+
+def clause_text(action: str, body: Sequence[LiteralT]) -> str:
+    # 本体で使わない引数は無名変数にする (singleton 警告を出さない)
+    used = {a for _, _, args in body for a in args}
+    head_vars = ", ".join(name if name in used else ANON for name, _ in ACTION_ARGS[action])
+    head = f"action_failed({action}({head_vars}))"
+    if not body:
+        return f"{head}."
+    return f"{head} :- {', '.join(_literal_text(lit) for lit in body)}."
+
+
+def _refinements(clause: _Clause, constants: Dict[Tuple[str, int], List[str]], max_vars: int):
+    """clause の本体にリテラルを 1 つ加えた節 (本体, 変数の型) を列挙する。"""
+    used = set(clause.body)
+    fresh = f"V{sum(1 for v in clause.var_types if v.startswith('V')) + 1}"
+    for name, types in PREDICATES.items():
+        for negated in (False, True):
+            options = []
+            for pos, arg_type in enumerate(types):
+                choices = [v for v, t in clause.var_types.items() if t == arg_type]
+                choices += constants.get((name, pos), [])
+                choices.append(ANON)
+                if not negated and len(clause.var_types) < max_vars:
+                    choices.append(fresh)
+                options.append(choices)
+
+            def product(i: int, acc: Tuple[str, ...]):
+                if i == len(options):
+                    yield acc
+                    return
+                for choice in options[i]:
+                    # 新しい変数は 1 つのリテラルに 1 回だけ
+                    if choice == fresh and fresh in acc:
+                        continue
+                    yield from product(i + 1, acc + (choice,))
+
+            for args in product(0, ()):
+                # 束縛済みの変数を含まず、定数もないリテラルは例によらないので使わない
+                if not any(a in clause.var_types for a in args) and not any(
+                        a != ANON and a != fresh for a in args):
+                    continue
+                literal = (negated, name, args)
+                if literal in used or (not negated, name, args) in used:
+                    continue
+                var_types = clause.var_types
+                if fresh in args:
+                    var_types = dict(var_types)
+                    var_types[fresh] = types[args.index(fresh)]
+                yield clause.body + (literal,), var_types
+
+
+def _has_singleton_fresh(body: Sequence[LiteralT]) -> bool:
+    counts: Dict[str, int] = {}
+    for _, _, args in body:
+        for a in args:
+            if a.startswith("V"):
+                counts[a] = counts.get(a, 0) + 1
+    return any(c == 1 for c in counts.values())
+
+
+def _uses_head_var(body: Sequence[LiteralT], head_vars: Dict[str, str]) -> bool:
+    return any(a in head_vars for _, _, args in body for a in args)
+
+
+def example_key(example: Example) -> str:
+    """例の内容の文字列 (並べ替えとハッシュ用。ファクトの順序によらない)。"""
+    action, args, facts, success = example
+    return json.dumps([action, list(args), sorted((name, sorted(rows)) for name, rows in facts.items()), success],
+                      ensure_ascii=False)
+
+
+def induce_head(action: str, examples: List[Example], max_len: int = 3, beam: int = 40, min_support: int = 2,
+                max_neg: int = 0, max_clauses: int = 5, max_vars: int = 4,
+                max_work: int = 300_000) -> List[Tuple[str, int, int, int]]:
+    """
+    1 種類の行動の action_failed 節を学習する。
+    max_work: 評価する (リテラル, 例) の組の数の上限 (超えたらその時点の最良の節で打ち切る)
+    戻り値: [(節, カバーした正例の数, 正例の数, カバーした負例の数)]
+    """
+    examples = sorted(examples, key=lambda e: e[3])   # 正例 (失敗) を先に
+    n_pos = sum(1 for e in examples if not e[3])
+    if n_pos < min_support:
+        return []
+    pos_mask = (1 << n_pos) - 1
+    all_mask = (1 << len(examples)) - 1
+    head_vars = {name: arg_type for name, arg_type in ACTION_ARGS[action]}
+    head_names = [name for name, _ in ACTION_ARGS[action]]
+    bindings = [dict(zip(head_names, e[1])) for e in examples]
+    indexes = [_FactIndex(e[2]) for e in examples]
+
+    constants: Dict[Tuple[str, int], List[str]] = {("item_in_hand", 0): [NULL]}
+    statuses = sorted({fact[1] for e in examples for fact in e[2].get("location_status", ())})
+    constants[("location_status", 1)] = statuses
+
+    cache: Dict[Tuple[LiteralT, ...], int] = {}
+    work = 0
+
+    def coverage(body, parent_cover: int) -> int:
+        nonlocal work
+        key = body
+        if key not in cache:
+            cover = 0
+            rows = _bits(parent_cover)
+            work += len(rows)
+            for i in rows:
+                if _satisfied(body, indexes[i], bindings[i]):
+                    cover |= 1 << i
+            cache[key] = cover
+        return cache[key]
+
+    def popcount(x: int) -> int:
+        return bin(x).count("1")
+
+    chosen: List[Tuple[str, int, int, int]] = []
+    uncovered = pos_mask
+    while uncovered and len(chosen) < max_clauses and work < max_work:
+        best, best_key = None, None
+        frontier = [_Clause((), dict(head_vars), all_mask)]
+        for _ in range(max_len):
+            children = []
+            for parent in frontier:
+                if work >= max_work:
+                    break
+                for body, var_types in _refinements(parent, constants, max_vars):
+                    cover = coverage(body, parent.cover)
+                    gain = popcount(cover & uncovered)
+                    if gain < min_support:
+                        continue
+                    neg = popcount(cover & ~pos_mask & all_mask)
+                    if neg <= max_neg and not _has_singleton_fresh(body) and _uses_head_var(body, head_vars):
+                        key = (gain, -neg, -len(body))
+                        if best is None or key > best_key:
+                            best, best_key = _Clause(body, var_types, cover), key
+                    if neg > max_neg:
+                        children.append((gain, -neg, len(children), _Clause(body, var_types, cover)))
+            children.sort(key=lambda c: (c[0], c[1], -c[2]), reverse=True)
+            frontier = [c[3] for c in children[:beam]]
+            if not frontier or work >= max_work:
+                break
+        if best is None:
+            break
+        chosen.append((clause_text(action, best.body), popcount(best.cover & pos_mask), n_pos,
+                       popcount(best.cover & ~pos_mask & all_mask)))
+        uncovered &= ~best.cover
+    return chosen
+
+
+def _induce_head_job(args):
+    return args[0], induce_head(*args[:2], **args[2])
+
+
+class ILPInducer:
+    """
+    遷移から action_failed/1 ルールを学習する。ILASP_LLM と同じ save / save_connect を持つ。
+    """
+
+    # (行動, 例と設定のハッシュ) -> 節。プロセス内で ILPInducer を作り直しても使い回す
+    _memo: Dict[Tuple[str, str], List[Tuple[str, int, int, int]]] = {}
+
+    def __init__(self, max_len: int = 3, beam: int = 40, min_support: int = 2, max_neg: int = 0,
+                 max_clauses: int = 5, max_workers: Optional[int] = None, max_work: int = 300_000,
+                 cache_file: Optional[str] = None):
+        """
+        max_len: 節の本体のリテラル数の上限
+        beam: 探索の各段で残す節の数
+        min_support: 節が新たにカバーしなければならない正例 (失敗) の数
+        max_neg: 節がカバーしてよい負例 (成功) の数
+        max_clauses: 行動 1 種類あたりの節の数の上限
+        max_workers: 並列に学習するプロセス数 (1 ならプロセスを使わない)
+        max_work: ヘッド 1 つあたりに評価する (リテラル, 例) の組の数の上限
+        cache_file: ヘッドごとの学習結果を保存する JSON (例が変わっていないヘッドは学習し直さない)
+        """
+        self.params = {"max_len": max_len, "beam": beam, "min_support": min_support,
+                       "max_neg": max_neg, "max_clauses": max_clauses, "max_work": max_work}
+        self.max_workers = max_workers
+        self.cache_file = cache_file
+        self.last_stats: List[Tuple[str, int, int, int]] = []
+
+    def examples(self, data) -> Dict[str, List[Example]]:
+        """行動の種類ごとの例。"""
+        by_action: Dict[str, List[Example]] = {}
+        for trans in iter_transitions(data):
+            example = transition_to_example(trans)
+            if example is not None:
+                by_action.setdefault(example[0], []).append(example)
+        return by_action
+
+    def _signature(self, examples: List[Example]) -> str:
+        digest = hashlib.sha256(json.dumps(self.params, sort_keys=True).encode("utf-8"))
+        for example in examples:
+            digest.update(example_key(example).encode("utf-8"))
+            digest.update(b"\n")
+        return digest.hexdigest()
+
+    def _load_cache(self) -> Dict[str, Dict]:
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return {}
+        with open(self.cache_file, "r", encoding="utf-8") as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                print(f"Warning: {self.cache_file} のパース失敗。キャッシュなしで開始。")
+                return {}
+
+    def _save_cache(self, cache: Dict[str, Dict]) -> None:
+        dir_name = os.path.dirname(self.cache_file)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        tmp_path = self.cache_file + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(tmp_path, self.cache_file)
+
+    def induce(self, data) -> str:
+        """
+        data (D_all / コーパス / 遷移のリスト) からルールを学習し、Prolog のテキストを返す。
+        例が前回と同じヘッドはキャッシュの結果を使い、例が変わったヘッドだけ学習する。
+        """
+        by_action = self.examples(data)
+        file_cache = self._load_cache()
+        cached: Dict[str, List[Tuple[str, int, int, int]]] = {}
+        signatures: Dict[str, str] = {}
+        jobs = []
+        for action, examples in sorted(by_action.items()):
+            # 結果が例の順序によらないように、内容で並べてから学習する
+            examples = sorted(examples, key=example_key)
+            signature = signatures[action] = self._signature(examples)
+            if (action, signature) in self._memo:
+                cached[action] = self._memo[(action, signature)]
+            elif file_cache.get(action, {}).get("signature") == signature:
+                cached[action] = [tuple(clause) for clause in file_cache[action]["clauses"]]
+            else:
+                jobs.append((action, examples, self.params))
+        if jobs:
+            print(f"[ILP] 例が変わった行動 {len(jobs)}種類を学習します: {[job[0] for job in jobs]}")
+        if self.max_workers == 1 or len(jobs) <= 1:
+            results = [_induce_head_job(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+                results = list(pool.map(_induce_head_job, jobs))
+        for action, clauses in results:
+            cached[action] = clauses
+        for action, clauses in cached.items():
+            self._memo[(action, signatures[action])] = clauses
+        if self.cache_file and (results or set(file_cache) != set(cached)):
+            self._save_cache({action: {"signature": signatures[action], "clauses": [list(c) for c in clauses]}
+                              for action, clauses in cached.items()})
+        results = sorted(cached.items())
+
+        self.last_stats = []
+        lines = []
+        for action, clauses in results:
+            for text, pos, n_pos, neg in clauses:
+                self.last_stats.append((text, pos, n_pos, neg))
+                lines.append(text)
+                print(f"[ILP] {text}  (失敗 {pos}/{n_pos}件, 成功 {neg}件をカバー)")
+        print(f"[ILP] {len(by_action)}種類の行動から {len(lines)}個のルールを学習しました")
+        return "\n".join(lines) + ("\n" if lines else "")
+
+    def save(self, path, data):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(data)
+
+    def save_connect(self, path, data):
+        """既存のルールファイルに、まだないルールだけを追記する (1 行 1 ルール)。"""
+        new_rules = [line.strip() for line in data.splitlines() if line.strip()]
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                existing = {re.sub(r'\s+', ' ', line.strip()) for line in f if line.strip()}
+        except FileNotFoundError:
+            existing = set()
+        rules_to_add = [r for r in new_rules if re.sub(r'\s+', ' ', r) not in existing]
+        if rules_to_add:
+            dir_name = os.path.dirname(path)
+            if dir_name:
+                os.makedirs(dir_name, exist_ok=True)
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write('\n'.join(rules_to_add) + '\n')
+
+
+if __name__ == '__main__':
+    with open("../../0109_Train1_result/D_inc_all.json", "r", encoding="utf-8") as f:
+        corpus = json.load(f)
+    with open("../../0109_Train1_result/D_cor_all.json", "r", encoding="utf-8") as f:
+        corpus += json.load(f)
+
+    ilp = ILPInducer()
+    prolog_rules = ilp.induce(corpus)
+    ilp.save("./PrologRule/ilp_rules.pl", prolog_rules)
@@ -0,0 +1,95 @@
+"""
+1 ステップ分のチェックを 1 回の Prolog 呼び出しで行うバッチチェッカー。
+
+従来はステップごとに、ファクト 1 行ずつの assertz、クエリ、述語ごとの retractall を呼んでおり、
+1 ステップで数十回の Python <-> Prolog 往復があった。StepBatchChecker.check() は
+step_batch.pl の check_step/3 を 1 回呼ぶだけで、
+    ファクトブロックの assert → 全クエリの評価 (結果はリスト) → ファクトの削除
+を行うので、ステップあたりの呼び出し回数はファクト数・クエリ数によらず一定になる。
+
+使用例:
+    prolog = Prolog()
+    load_rule_base(prolog, "./check3/all_generated_rules.pl")
+    checker = StepBatchChecker(prolog)
+    checker.check(state_action_to_facts(step), ["action_failed(goto(drawer_1))"])   # -> [True]
+"""
+import os
+from typing import List, Sequence, Union
+
+from .PrologRuleBase import STEP_PREDICATES, prolog_path
+
+BATCH_PROGRAM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "step_batch.pl")
+
+Facts = Union[str, Sequence[str]]
+
+
+def split_facts(facts: Facts) -> List[str]:
+    """
+    ファクトのブロック (1 行 1 ファクト, 末尾に '.') を assertz 用の項のリストにする。
+    リストが渡された場合も末尾の '.' を取り除く。
+    """
+    lines = facts.splitlines() if isinstance(facts, str) else list(facts)
+    result = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("%"):
+            continue
+        result.append(line[:-1] if line.endswith(".") else line)
+    return result
+
+
+def prolog_string(text: str) -> str:
+    """Python の文字列を Prolog の文字列リテラル ("...") にする。"""
+    escaped = text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{escaped}"'
+
+
+def _to_text(value) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else str(value)
+
+
+class StepBatchChecker:
+    """
+    pyswip の Prolog に check_step/3 を読み込み、ステップ単位でクエリをまとめて評価する。
+    ルールベース (action_failed/1 など) は呼び出し側で user に読み込んでおくこと。
+    """
+
+    def __init__(self, prolog):
+        self.prolog = prolog
+        list(prolog.query(f"load_files(user:{prolog_path(BATCH_PROGRAM)}, [if(not_loaded)])"))
+        list(prolog.query("retractall(step_batch:step_predicate(_, _))"))
+        for name, arity in STEP_PREDICATES:
+            list(prolog.query(f"assertz(step_batch:step_predicate({name}, {arity}))"))
+
+    @staticmethod
+    def facts_text(facts: Facts) -> str:
+        return "".join(f"{fact}.\n" for fact in split_facts(facts))
+
+    def load_facts(self, facts: Facts) -> None:
+        """ファクトブロックを 1 回の呼び出しで assert する (clear() と対で使う)。"""
+        list(self.prolog.query(f"step_batch:assert_facts({prolog_string(self.facts_text(facts))})"))
+
+    def clear(self) -> None:
+        """ステップのファクトを全て消す。"""
+        list(self.prolog.query("step_batch:clear_step_facts"))
+
+    def check(self, facts: Facts, queries: Sequence[str]) -> List[bool]:
+        """
+        ファクトを assert した状態で各クエリが 1 つでも解を持つかを返す。
+        未定義述語のクエリは False、それ以外のエラーはメッセージを表示して False。
+        """
+        if not queries:
+            return []
+        goals = ", ".join(prolog_string(query.strip().rstrip(".")) for query in queries)
+        solution = next(iter(self.prolog.query(f"check_step({prolog_string(self.facts_text(facts))}, [{goals}], Results)",
+                                               maxresult=1)))
+        results = []
+        for value in solution["Results"]:
+            text = _to_text(value)
+            if text == "true":
+                results.append(True)
+            else:
+                if text != "false":
+                    print(f"    クエリエラー: {text[:150]}")
+                results.append(False)
+        return results
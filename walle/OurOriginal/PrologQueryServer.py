@@ -0,0 +1,141 @@
+"""
+マルチプロセスの Prolog クエリサーバとクライアント。
+
+pyswip はスレッドセーフではないため、1 プロセス内で Prolog を使うと全ての問い合わせが直列になり、
+Python 側のループ (LLM 呼び出しなど) も止まる。ここでは SWI-Prolog のワーカープロセスを複数立ち上げ、
+各ワーカーにルールファイルを事前に読み込んでおく。
+
+1 リクエスト (バッチ) = 1 ステップ分の処理:
+    1. そのステップのファクトを assert する
+    2. K 個のクエリを順に実行する
+    3. ステップのファクトを retract する
+
+クライアントは concurrent.futures の Future を返すので、LLM 呼び出しと並行して Prolog の
+チェックを進められる。
+
+使用例:
+    with PrologQueryClient(["./check3/all_generated_rules.pl"]) as client:
+        future = client.submit(state_action_to_facts(step), ["action_failed(goto(drawer_1))"])
+        ...  # LLM 呼び出しなど
+        print(future.result())   # -> [True]
+"""
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from .PrologBatchCheck import Facts, StepBatchChecker, split_facts
+from .PrologRuleBase import build_rule_module, declare_schema, load_rule_base
+
+# ワーカープロセス内の Prolog インスタンスとバッチチェッカー
+_prolog = None
+_checker = None
+
+
+# ----------------------------------------------------------------------
+# ワーカー側
+# ----------------------------------------------------------------------
+
+def _init_worker(rules_files: List[str]) -> None:
+    """ワーカープロセスの初期化: ステップ用の述語を dynamic にし、ルールをコンパイル済みモジュールとして読み込む。"""
+    global _prolog, _checker
+    from pyswip import Prolog
+
+    _prolog = Prolog()
+    declare_schema(_prolog)
+    for path in rules_files:
+        load_rule_base(_prolog, path)
+    _checker = StepBatchChecker(_prolog)
+
+
+def _run_batch(facts: List[str], queries: List[str], all_solutions: bool = False) -> List:
+    """
+    1 ステップ分のファクトを assert してクエリを実行し、最後にファクトを消す。
+
+    Returns:
+        all_solutions=False: 各クエリが 1 つでも解を持つか (bool) のリスト
+        all_solutions=True:  各クエリの解 ({変数名: 値の文字列}) のリストのリスト
+    """
+    if not all_solutions:
+        # ファクトの assert からクエリ・retract までを check_step/3 の 1 回の呼び出しで行う
+        return _checker.check(facts, queries)
+
+    results = []
+    try:
+        _checker.load_facts(facts)
+        for query in queries:
+            query = query.strip().rstrip(".")
+            try:
+                results.append([{k: str(v) for k, v in solution.items()} for solution in _prolog.query(query)])
+            except Exception as e:
+                # 未定義述語 (existence_error) などは「解なし」とみなす
+                if "existence_error" not in str(e):
+                    print(f"    クエリエラー: {str(e)[:150]}")
+                results.append([])
+    finally:
+        _checker.clear()
+    return results
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+# ----------------------------------------------------------------------
+# クライアント側
+# ----------------------------------------------------------------------
+
+class PrologQueryClient:
+    """
+    Prolog ワーカープールへのクライアント。
+    ワーカーは spawn で起動するため、スクリプトから使う場合は if __name__ == "__main__": の中で作ること。
+    """
+
+    def __init__(self, rules_files: Iterable[str] = (), max_workers: Optional[int] = None):
+        """
+        Args:
+            rules_files: 各ワーカーで consult するルールファイル
+            max_workers: ワーカー数 (既定は CPU コア数)
+        """
+        self.rules_files = [os.path.abspath(path) for path in rules_files]
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.rules_files,),
+        )
+        # モジュールファイルは親プロセスで生成し、.qlf は最初のワーカーで作らせてから他のワーカーを起動する
+        for path in self.rules_files:
+            build_rule_module(path)
+        if self.rules_files:
+            self._executor.submit(_ping).result()
+
+    def submit(self, facts: Facts, queries: Sequence[str], all_solutions: bool = False) -> Future:
+        """1 ステップ分のバッチを投げ、結果の Future を返す。"""
+        return self._executor.submit(_run_batch, split_facts(facts), list(queries), all_solutions)
+
+    def run(self, facts: Facts, queries: Sequence[str], all_solutions: bool = False) -> List:
+        """submit() して結果を待つ。"""
+        return self.submit(facts, queries, all_solutions).result()
+
+    def map(self, batches: Iterable[Tuple[Facts, Sequence[str]]], all_solutions: bool = False) -> List[List]:
+        """
+        複数ステップ分のバッチをワーカーに分散して実行し、入力順に結果を返す。
+        """
+        futures = [self.submit(facts, queries, all_solutions) for facts, queries in batches]
+        return [future.result() for future in futures]
+
+    def warm_up(self) -> None:
+        """全ワーカーを起動してルールを読み込ませておく。"""
+        for future in [self._executor.submit(_ping) for _ in range(self.max_workers)]:
+            future.result()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
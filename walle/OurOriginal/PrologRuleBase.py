@@ -0,0 +1,198 @@
+"""
+action_failed ルールベースをコンパイル済みモジュールとして読み込むためのヘルパ。
+
+生成されたルールファイル (all_prolog_rules.pl / all_generated_rules.pl) をそのまま consult すると、
+ステップのファクト述語が未宣言のまま assert/retract され、ルールも毎回ソースから読み込まれる。
+ここではルールファイルから次のようなモジュールファイルを生成し、qcompile(auto) で .qlf にして読み込む。
+モジュールファイルと .qlf はルールファイルの隣の MODULE_CACHE_DIR (.prolog_cache/) に置く (生成物なので git では無視する)。
+
+    :- module(action_rules, [action_failed/1]).
+    :- set_prolog_flag(optimise, true).
+    :- dynamic user:action/1, user:current_position/1, ...     % ステップのファクトのスキーマ
+    :- table reach/2.                                          % 再帰している述語だけ tabling
+    action_failed(goto(Destination)) :- ...
+
+- action_failed/1 は静的述語としてコンパイルされ、第 1 引数 (goto/1, take/2, ...) でインデックスされる。
+- ステップのファクトは user モジュールの dynamic 述語。SWI-Prolog は dynamic 述語に対して
+  呼び出しパターンに応じた JIT インデックス (第 1 引数以外や複数引数も含む) を自動で作る。
+- ルール本体の未定義述語はモジュールの既定の import 先である user から探されるので、
+  ファクトは従来どおり user に assert すればよい。
+"""
+import os
+import re
+from typing import Dict, Iterable, List, Set, Tuple
+
+# JSONtoFacts.state_action_to_facts が生成するステップごとのファクト (述語名, 引数の数)
+STEP_PREDICATES: Tuple[Tuple[str, int], ...] = (
+    ("action", 1),
+    ("current_position", 1),
+    ("location_status", 2),
+    ("reachable_location", 1),
+    ("items_in_location", 2),
+    ("empty", 1),
+    ("item_in_hand", 2),
+)
+
+RULE_MODULE = "action_rules"
+MODULE_CACHE_DIR = ".prolog_cache"
+
+Indicator = Tuple[str, int]
+
+_TERM_START = re.compile(r"([a-z]\w*)\s*(\()?")
+
+
+def split_clauses(text: str) -> List[str]:
+    """ルールファイルの本文を節のリストにする (コメント行・ディレクティブ・空行は除く)。"""
+    clauses = []
+    current = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("%"):
+            continue
+        current.append(line)
+        if line.endswith("."):
+            clause = " ".join(current)
+            current = []
+            if not clause.startswith(":-"):
+                clauses.append(clause)
+    return clauses
+
+
+def _arity(text: str, open_pos: int) -> Tuple[int, int]:
+    """text[open_pos] の '(' に対応する引数の数と、閉じ括弧の次の位置を返す。"""
+    depth = 0
+    count = 1
+    i = open_pos
+    while i < len(text):
+        c = text[i]
+        if c in "([":
+            depth += 1
+        elif c in ")]":
+            depth -= 1
+            if depth == 0:
+                return count, i + 1
+        elif c == "," and depth == 1:
+            count += 1
+        elif c == "'":
+            i = text.index("'", i + 1)
+        i += 1
+    return count, len(text)
+
+
+def goal_indicators(text: str) -> List[Indicator]:
+    """文字列中に現れる述語 (name/arity) を出現順に返す (引数の中の項も含む)。"""
+    indicators = []
+    pos = 0
+    while True:
+        m = _TERM_START.search(text, pos)
+        if not m:
+            return indicators
+        if m.start() > 0 and (text[m.start() - 1].isalnum() or text[m.start() - 1] in "_'"):
+            pos = m.end()
+            continue
+        if m.group(2):
+            arity, _ = _arity(text, m.end() - 1)
+            indicators.append((m.group(1), arity))
+            pos = m.end()
+        else:
+            indicators.append((m.group(1), 0))
+            pos = m.end()
+
+
+def clause_head(clause: str) -> Indicator:
+    head = clause.split(":-", 1)[0].strip().rstrip(".")
+    return goal_indicators(head)[0]
+
+
+def recursive_predicates(clauses: Iterable[str]) -> Set[Indicator]:
+    """
+    ルール間の呼び出しグラフで循環に含まれる述語を返す (tabling の対象)。
+    action_failed/1 のように自分自身を呼ばないルールは含まれない。
+    """
+    graph: Dict[Indicator, Set[Indicator]] = {}
+    for clause in clauses:
+        head = clause_head(clause)
+        body = clause.split(":-", 1)[1] if ":-" in clause else ""
+        graph.setdefault(head, set()).update(goal_indicators(body))
+    defined = set(graph)
+    for head in graph:
+        graph[head] &= defined
+
+    recursive = set()
+    for start in graph:
+        stack = list(graph[start])
+        seen = set()
+        while stack:
+            node = stack.pop()
+            if node == start:
+                recursive.add(start)
+                break
+            if node in seen:
+                continue
+            seen.add(node)
+            stack.extend(graph.get(node, ()))
+    return recursive
+
+
+def schema_directives() -> str:
+    """ステップのファクトを user モジュールの dynamic 述語として宣言するディレクティブ。"""
+    preds = ", ".join(f"user:{name}/{arity}" for name, arity in STEP_PREDICATES)
+    return f":- dynamic {preds}.\n"
+
+
+def build_rule_module(rules_file: str, module_path: str = None, module_name: str = RULE_MODULE) -> str:
+    """
+    ルールファイルからモジュールファイルを生成し、そのパスを返す。
+    module_path を省略するとルールファイルの隣の MODULE_CACHE_DIR/<名前>_module.pl に書く。
+    ルールファイルより新しいモジュールファイルがあれば作り直さない。
+    """
+    if module_path is None:
+        stem = os.path.splitext(os.path.basename(rules_file))[0]
+        module_path = os.path.join(os.path.dirname(rules_file), MODULE_CACHE_DIR, stem + "_module.pl")
+    dir_name = os.path.dirname(module_path)
+    if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+    if os.path.exists(module_path) and os.path.getmtime(module_path) >= os.path.getmtime(rules_file):
+        return module_path
+
+    with open(rules_file, "r", encoding="utf-8") as f:
+        clauses = split_clauses(f.read())
+    tabled = sorted(recursive_predicates(clauses))
+
+    lines = [
+        f"% Generated from {os.path.basename(rules_file)} by PrologRuleBase.build_rule_module",
+        f":- module({module_name}, [action_failed/1]).",
+        ":- set_prolog_flag(optimise, true).",
+        schema_directives().rstrip("\n"),
+        ":- discontiguous action_failed/1.",
+    ]
+    if tabled:
+        lines.append(":- table " + ", ".join(f"{name}/{arity}" for name, arity in tabled) + ".")
+    lines.append("")
+    lines.extend(clauses)
+
+    with open(module_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    print(f"ルールモジュールを生成しました: {module_path} ({len(clauses)}節, tabled={tabled})")
+    return module_path
+
+
+def prolog_path(path: str) -> str:
+    return "'" + os.path.abspath(path).replace("\\", "/").replace("'", "\\'") + "'"
+
+
+def load_rule_base(prolog, rules_file: str) -> str:
+    """
+    pyswip の Prolog にルールベースを読み込む。
+    モジュールファイルを生成し、qcompile(auto) で .qlf を作成/再利用して読み込み、
+    action_failed/1 を user から呼べるように import する。
+    """
+    module_path = build_rule_module(rules_file)
+    list(prolog.query(f"load_files(user:{prolog_path(module_path)}, [qcompile(auto)])"))
+    return module_path
+
+
+def declare_schema(prolog) -> None:
+    """ルールベースを読み込まない場合でも、ステップのファクト述語を dynamic にしておく。"""
+    for name, arity in STEP_PREDICATES:
+        list(prolog.query(f"dynamic(user:{name}/{arity})"))
@@ -2,20 +2,31 @@ import json
 from pyswip import Prolog
 from pathlib import Path
 import re
-import tempfile
 import os
 
+from .PrologBatchCheck import StepBatchChecker
+from .PrologRuleBase import declare_schema
+from .RuleStatsStore import RuleStatsStore, rule_hash, step_key
+
 class PrologRuleProbabilityCalculator:
-    def __init__(self, json_file, fact_folder, rules_file):
+    def __init__(self, json_file, fact_folder, rules_file, client=None, stats_file=None, max_examples=10):
         """
         Args:
             json_file: D_all.jsonのパス
             fact_folder: fact_*.plファイルが入っているフォルダのパス
             rules_file: all_prolog_rules.plのパス
+            client: PrologQueryClient（指定するとステップごとにワーカープールへ並列に問い合わせる）
+            stats_file: ルールの統計を保存するJSONのパス（省略時は rules_file の隣の *_stats.json）
+            max_examples: ルールごとに残す適用例の数
         """
         self.json_file = json_file
         self.fact_folder = fact_folder
         self.rules_file = rules_file
+        self.client = client
+        self._checker = None
+        if stats_file is None:
+            stats_file = os.path.splitext(rules_file)[0] + "_stats.json"
+        self.store = RuleStatsStore(stats_file, max_examples=max_examples)
         
         # fact_*.plファイルを自動的に検索
         self.fact_files = self._load_fact_files()
@@ -64,38 +75,13 @@ class PrologRuleProbabilityCalculator:
             return match.group(1).strip()
         return None
     
-    def check_rule_applies(self, fact_file, rule_body):
-        """
-        ルールの条件部分が満たされるかチェック
-        各チェックごとに新しいPrologインスタンスを使用
-        Args:
-            fact_file: factファイルのパス
-            rule_body: ルールの条件部分（:- 以降）
-        Returns:
-            bool: 条件が満たされる場合True
-        """
-        try:
-            # 新しいPrologインスタンスを作成（重要！）
+    def _get_checker(self):
+        """プロセス内で使い回すバッチチェッカー"""
+        if self._checker is None:
             prolog = Prolog()
-            
-            # factファイルを読み込む
-            prolog.consult(fact_file)
-            
-            # クエリを実行
-            query = f"({rule_body})"
-            result = list(prolog.query(query))
-            
-            # Prologインスタンスを明示的にクリーンアップ
-            del prolog
-            
-            return len(result) > 0
-        except Exception as e:
-            # エラーメッセージを簡略化（existence_errorは述語が存在しない場合）
-            if "existence_error" in str(e):
-                # 述語が存在しない場合は条件が満たされないと判断
-                return False
-            print(f"    クエリエラー: {str(e)[:100]}")
-            return False
+            declare_schema(prolog)
+            self._checker = StepBatchChecker(prolog)
+        return self._checker
     
     def extract_action_from_rule(self, rule):
         """
@@ -107,95 +93,135 @@ class PrologRuleProbabilityCalculator:
             return match.group(1)
         return None
     
+    def rule_body(self, rule):
+        """ルールの条件部分 (:- 以降)。本体のない節は評価しないので None"""
+        if ':-' in rule:
+            return rule.split(':-', 1)[1].strip().rstrip('.')
+        return None
+    
+    def _evaluate(self, step_jobs):
+        """各ステップの (ルール, 条件) が満たされるかを評価する"""
+        if self.client is not None:
+            # 1ステップ = 1バッチ（ファクトのassert → 全条件のクエリ → retract）をワーカーに分散
+            futures = []
+            for *_, facts, checks in step_jobs:
+                futures.append(self.client.submit(facts, [f"({body})" for _, body in checks]))
+            return [future.result() for future in futures]
+        # 1ステップの全条件を check_step/3 の1回の呼び出しで評価する
+        checker = self._get_checker()
+        applies_list = []
+        for *_, facts, checks in step_jobs:
+            applies_list.append(checker.check(facts, [f"({body})" for _, body in checks]))
+        return applies_list
+    
     def calculate_probabilities(self):
-        """各ルールの確率を計算"""
+        """
+        各ルールの確率を計算
+        統計ストアに取り込み済みのステップ × 登録済みのルールは評価し直さず、
+        新しいステップは全ルールで、新しいルールは取り込み済みの全ステップで評価する
+        ステップは fact ファイルの内容と success で識別し、今回のデータにないステップの分は統計から除く
+        """
         # JSONデータを読み込む
         data = self.load_json_data()
         
         # ルールを読み込む
-        rules = self.load_rules()
+        rules = list(dict.fromkeys(self.load_rules()))
+        # ルールファイルから外れたルールは登録を外す (戻ってきたら全ステップで評価し直す)
+        dropped = self.store.retain(rules)
+        if dropped:
+            print(f"ルールファイルにないルール {dropped}件を統計から外しました")
+        new_rules = self.store.new_rules(rules)
+        rule_actions = {rule: self.extract_action_from_rule(rule) for rule in rules}
         
-        # 各ルールの統計を収集
-        rule_stats = {}
+        rule_bodies = {rule: self.rule_body(rule) for rule in rules}
         
-        for rule in rules:
-            rule_stats[rule] = {
-                'true_count': 0,
-                'false_count': 0,
-                'probability': 0.0,
-                'examples': []  # デバッグ用
-            }
+        def checks_for(action_name, target_rules):
+            # 本体のあるルールのうち、対象とするアクションが一致するものだけ
+            return [(rule, rule_bodies[rule]) for rule in target_rules
+                    if rule_bodies[rule] is not None
+                    and (not rule_actions[rule] or rule_actions[rule] == action_name)]
         
-        # 各タスクの各ステップを処理
+        # 各タスクの各ステップのfactファイルを読み、内容とsuccessからキーを作る
+        steps_in_data = []
         for task_name, steps in data.items():
-            print(f"\n処理中: {task_name}")
-            
             for step_id, step_data in steps.items():
-                print(f"  ステップ {step_id}", end="")
+                # action_resultのsuccessと実行されたアクションを取得
+                success = step_data.get('action_result', {}).get('success', True)
+                action_name = step_data.get('action', {}).get('action_name', '')
                 
                 # 対応するfactファイルを取得
                 fact_file = self.fact_files.get(step_id)
-                
                 if not fact_file or not Path(fact_file).exists():
-                    print(f" - 警告: fact_{step_id}.pl が見つかりません")
+                    print(f"  ステップ {step_id} - 警告: fact_{step_id}.pl が見つかりません")
                     continue
-                
-                # action_resultのsuccessを取得
-                action_result = step_data.get('action_result', {})
-                success = action_result.get('success', True)
-                
-                # 実行されたアクションを取得
-                action_data = step_data.get('action', {})
-                action_name = action_data.get('action_name', '')
-                
-                print(f" - アクション: {action_name}, Success: {success}")
-                
-                # 各ルールをチェック
-                for rule in rules:
-                    # このルールが対象とするアクションと一致するか確認
-                    rule_action = self.extract_action_from_rule(rule)
-                    if rule_action and rule_action != action_name:
-                        continue
-                    
-                    # ルールの条件部分を抽出
-                    if ':-' in rule:
-                        rule_body = rule.split(':-', 1)[1].strip().rstrip('.')
-                        
-                        # ルールの条件が満たされるかチェック
-                        applies = self.check_rule_applies(fact_file, rule_body)
-                        
-                        if applies:
-                            print(f"    ✓ ルールが適用: {rule[:60]}...")
-                            if success:
-                                rule_stats[rule]['true_count'] += 1
-                            else:
-                                rule_stats[rule]['false_count'] += 1
-                            
-                            # デバッグ用に例を保存
-                            rule_stats[rule]['examples'].append({
-                                'task': task_name,
-                                'step': step_id,
-                                'action': action_name,
-                                'success': success
-                            })
+                with open(fact_file, 'r', encoding='utf-8') as f:
+                    facts = f.read()
+                key = step_key(task_name, step_id, facts, success)
+                steps_in_data.append((key, task_name, step_id, action_name, success, facts))
+        
+        pruned = self.store.prune(key for key, *_ in steps_in_data)
+        if pruned:
+            print(f"今回のデータにないステップ {pruned}件を統計から除きました")
+        
+        # 各タスクの各ステップを処理
+        step_jobs = []
+        new_steps = []
+        for key, task_name, step_id, action_name, success, facts in steps_in_data:
+            if self.store.has_step(key):
+                # 取り込み済みのステップは新しいルールだけ評価する
+                target_rules = new_rules
+                success = self.store.steps[key]['success']
+                action_name = self.store.steps[key]['action']
+            else:
+                target_rules = rules
+            
+            checks = checks_for(action_name, target_rules)
+            if not checks and self.store.has_step(key):
+                continue
+            
+            if not self.store.has_step(key):
+                new_steps.append((key, action_name, success))
+                print(f"  ステップ {step_id} ({task_name}) - アクション: {action_name}, Success: {success}")
+            step_jobs.append((key, task_name, step_id, action_name, success, facts, checks))
+        
+        print(f"\n新しいステップ {len(new_steps)}件, 新しいルール {len(new_rules)}件を評価します")
+        
+        # ルールの条件が満たされるかチェック
+        applies_list = self._evaluate(step_jobs)
+        
+        for rule in new_rules:
+            self.store.register(rule)
+        for (key, task_name, step_id, action_name, success, _, checks), applies in zip(step_jobs, applies_list):
+            for (rule, _), applied in zip(checks, applies):
+                if applied:
+                    print(f"    ✓ ルールが適用: {rule[:60]}...")
+                    self.store.record(rule, success, {
+                        'task': task_name,
+                        'step': step_id,
+                        'action': action_name,
+                        'success': success
+                    }, step=key)
+        for key, action_name, success in new_steps:
+            self.store.add_step(key, action_name, success)
+        self.store.save()
         
         # 確率を計算
         print("\n" + "="*80)
         print("確率計算結果:")
         print("="*80)
         
-        for rule, stats in rule_stats.items():
+        rule_stats = {}
+        for rule in rules:
+            stats = self.store.stats(rule)
+            rule_stats[rule] = stats
             true_count = stats['true_count']
             false_count = stats['false_count']
-            total = true_count + false_count
             
-            if total > 0:
-                probability = false_count / total
-                stats['probability'] = probability
-                print(f"\nルール: {rule}")
+            print(f"\nルール: {rule}")
+            if true_count + false_count > 0:
                 print(f"  Success=True: {true_count}")
                 print(f"  Success=False: {false_count}")
-                print(f"  確率 p = {probability:.4f}")
+                print(f"  確率 p = {stats['probability']:.4f}")
                 
                 # 例を表示（最初の3つまで）
                 if stats['examples']:
@@ -203,32 +229,23 @@ class PrologRuleProbabilityCalculator:
                     for ex in stats['examples'][:3]:
                         print(f"    - {ex['task']}, step {ex['step']}: {ex['action']} -> {ex['success']}")
             else:
-                print(f"\nルール: {rule}")
                 print(f"  適用例なし（条件が一度も満たされませんでした）")
         
         return rule_stats
     
     def generate_probabilistic_rules(self, rule_stats, output_file):
-        """確率付きルールファイルを生成"""
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write("% Probabilistic Prolog Rules\n")
-            f.write("% Format: p :: rule\n")
-            f.write("% p = False / (True + False)\n\n")
-            
-            for rule, stats in rule_stats.items():
-                prob = stats['probability']
-                true_count = stats['true_count']
-                false_count = stats['false_count']
-                total = true_count + false_count
-                
-                if total > 0:
-                    f.write(f"% Statistics: Success=True: {true_count}, Success=False: {false_count}, Total: {total}\n")
-                    f.write(f"{prob:.4f} :: {rule}\n\n")
-                else:
-                    f.write(f"% No data for this rule (condition never satisfied)\n")
-                    f.write(f"% {rule}\n\n")
-        
-        print(f"\n確率付きルールを {output_file} に保存しました")
+        """確率付きルールファイルを生成（数が変わったルールだけ作り直し、内容が同じなら書き直さない）"""
+        for rule, stats in rule_stats.items():
+            h = rule_hash(rule)
+            if h not in self.store.rules:
+                self.store.register(rule)
+                self.store.rules[h]['true_count'] = stats['true_count']
+                self.store.rules[h]['false_count'] = stats['false_count']
+        
+        if self.store.write_probabilistic_rules(rule_stats, output_file):
+            print(f"\n確率付きルールを {output_file} に保存しました")
+        else:
+            print(f"\n確率付きルールに変更はありません: {output_file}")
 
 
 # 使用例
@@ -0,0 +1,262 @@
+"""
+action_failed ルールの確率 (p = False / (True + False)) を逐次更新する統計ストア。
+
+PrologRuleProbabilityCalculator.calculate_probabilities は従来、呼び出すたびに全ルール × 全ステップを
+数え直し、適用例を全てリストに保存していた。RuleStatsStore はルールごとの数え上げを JSON に保存し、
+
+- (ルールのハッシュ, ステップ) の組は 1 回だけ評価する。
+  ストアに取り込み済みのステップ × 登録済みのルールの組は全て評価済みなので、新しいステップは全ルールで、
+  新しいルールは取り込み済みの全ステップで評価するだけでよい (O(新しいステップ × ルール))。
+- ステップのキーはタスク名・ステップ番号に fact ファイルの内容と success のハッシュを加えたもの。
+  別の実行で同じタスク名・ステップ番号が使われても、内容が違えば別のステップとして評価する。
+  現在のデータにないステップは prune() で取り除き、そのステップで数えた分をルールの数から引く。
+- 現在のルールファイルにないルールは retain() で登録を外す。ルールファイルは毎回作り直されるので、
+  外れている間に取り込んだステップでは評価されていない。戻ってきたら新しいルールとして全ステップで評価し直す。
+- 適用例は件数の上限つきのリザーバサンプル (Algorithm R) で持つ。
+- probabilistic_rules.pl はルールごとのブロックをキャッシュし、数が変わったルールだけ作り直す。
+  内容が変わらなければファイルを書き直さない。
+
+保存形式:
+    {
+        "steps": {"<task>:<step_id>:<hash>": {"action": "goto", "success": true, "rules": [適用されたルールのハッシュ]}},
+        "rules": {"<hash>": {"rule": ルール, "true_count": 0, "false_count": 0,
+                             "examples": {"seen": 0, "items": [...]}}}
+    }
+
+使用例:
+    store = RuleStatsStore("./OurRule/rule_stats.json")
+    store.retain(rules)                                  # 現在のルールファイルにないルールを外す
+    store.prune(current_keys)                            # 現在のデータにないステップを除く
+    for rule in store.new_rules(rules): ...             # 取り込み済みのステップで評価して record()
+    store.add_step(step_key(task, step_id, facts, success), action_name, success)
+    store.save()
+    store.write_probabilistic_rules(rules, "probabilistic_rules.pl")
+"""
+import hashlib
+import json
+import os
+import random
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+PROBABILISTIC_RULES_HEADER = (
+    "% Probabilistic Prolog Rules\n"
+    "% Format: p :: rule\n"
+    "% p = False / (True + False)\n\n"
+)
+
+
+def rule_hash(rule: str) -> str:
+    """空白の違いを除いたルールのハッシュ。"""
+    return hashlib.sha256(re.sub(r"\s+", " ", rule).strip().encode("utf-8")).hexdigest()[:16]
+
+
+def step_key(task_name: str, step_id, facts: str = "", success: bool = True) -> str:
+    """ステップのキー。fact ファイルの内容と success が変われば別のキーになる。"""
+    digest = hashlib.sha256(f"{bool(success)}\n{facts}".encode("utf-8")).hexdigest()[:16]
+    return f"{task_name}:{step_id}:{digest}"
+
+
+def render_rule_block(rule: str, true_count: int, false_count: int) -> str:
+    """probabilistic_rules.pl の 1 ルール分。"""
+    total = true_count + false_count
+    if total == 0:
+        return f"% No data for this rule (condition never satisfied)\n% {rule}\n\n"
+    return (f"% Statistics: Success=True: {true_count}, Success=False: {false_count}, Total: {total}\n"
+            f"{false_count / total:.4f} :: {rule}\n\n")
+
+
+class Reservoir:
+    """件数の上限つきの一様サンプル。seen と items だけで状態を表す (乱数は (salt, seen) から決める)。"""
+
+    def __init__(self, capacity: int, salt: str = "", seen: int = 0, items: List = None):
+        self.capacity = capacity
+        self.salt = salt
+        self.seen = seen
+        self.items = list(items or [])
+
+    def add(self, item) -> None:
+        self.seen += 1
+        if len(self.items) < self.capacity:
+            self.items.append(item)
+            return
+        j = random.Random(f"{self.salt}:{self.seen}").randrange(self.seen)
+        if j < self.capacity:
+            self.items[j] = item
+
+    def to_dict(self) -> Dict:
+        return {"seen": self.seen, "items": self.items}
+
+
+class RuleStatsStore:
+    """
+    ルールごとの適用回数と適用例のリザーバを保持する永続ストア。
+    """
+
+    def __init__(self, path: Optional[str] = None, max_examples: int = 10):
+        """
+        path: 保存先の JSON (None なら保存しない)
+        max_examples: ルールごとに残す適用例の数
+        """
+        self.path = path
+        self.max_examples = max_examples
+        self.steps: Dict[str, Dict] = {}
+        self.rules: Dict[str, Dict] = {}
+        self._reservoirs: Dict[str, Reservoir] = {}
+        self._blocks: Dict[str, Tuple[int, int, str]] = {}   # hash -> (true, false, ブロック)
+        self._written: Optional[str] = None
+        self._applied: Dict[str, List[str]] = {}             # 取り込み前のステップで適用されたルール
+        self.load()
+
+    def load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            try:
+                data = json.load(f)
+            except json.JSONDecodeError:
+                print(f"Warning: {self.path} のパース失敗。統計なしで開始。")
+                return
+        self.steps = data.get("steps", {})
+        self.rules = data.get("rules", {})
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        for h, reservoir in self._reservoirs.items():
+            self.rules[h]["examples"] = reservoir.to_dict()
+        dir_name = os.path.dirname(self.path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"steps": self.steps, "rules": self.rules}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def has_step(self, key: str) -> bool:
+        return key in self.steps
+
+    def reset(self) -> None:
+        """全ステップ・全ルールの統計を捨てる。"""
+        self.steps = {}
+        self.rules = {}
+        self._reservoirs = {}
+        self._applied = {}
+
+    def prune(self, current_keys: Iterable[str]) -> int:
+        """
+        current_keys にないステップを取り除き、そのステップで数えた分をルールの数と適用例から引く。
+        取り除いたステップ数を返す。適用ルールを記録していない旧形式のステップがあれば全体を作り直す。
+        """
+        current = set(current_keys)
+        stale = [key for key in self.steps if key not in current]
+        if not stale:
+            return 0
+        if any("rules" not in self.steps[key] for key in stale):
+            print(f"Warning: {self.path} に旧形式のステップがあるため統計を作り直します。")
+            count = len(self.steps)
+            self.reset()
+            return count
+        for key in stale:
+            step = self.steps.pop(key)
+            task, step_id = key.rsplit(":", 2)[:2]
+            for h in step["rules"]:
+                stats = self.rules.get(h)
+                if stats is None:
+                    continue
+                stats["true_count" if step["success"] else "false_count"] -= 1
+                reservoir = self._reservoir(h)
+                kept = [ex for ex in reservoir.items if (ex.get("task"), str(ex.get("step"))) != (task, step_id)]
+                reservoir.seen = max(reservoir.seen - 1, len(kept))
+                reservoir.items = kept
+        return len(stale)
+
+    def retain(self, rules: Iterable[str]) -> int:
+        """rules にないルールの登録と統計を外し、外したルール数を返す。"""
+        keep = {rule_hash(rule) for rule in rules}
+        dropped = [h for h in self.rules if h not in keep]
+        if not dropped:
+            return 0
+        for h in dropped:
+            del self.rules[h]
+            self._reservoirs.pop(h, None)
+            self._blocks.pop(h, None)
+        dropped_set = set(dropped)
+        for step in self.steps.values():
+            if "rules" in step:
+                step["rules"] = [h for h in step["rules"] if h not in dropped_set]
+        return len(dropped)
+
+    def new_rules(self, rules: Iterable[str]) -> List[str]:
+        """まだ登録していないルール (取り込み済みのステップで評価してから register() する)。"""
+        return [rule for rule in rules if rule_hash(rule) not in self.rules]
+
+    def register(self, rule: str) -> None:
+        h = rule_hash(rule)
+        if h not in self.rules:
+            self.rules[h] = {"rule": rule, "true_count": 0, "false_count": 0,
+                             "examples": {"seen": 0, "items": []}}
+
+    def add_step(self, key: str, action_name: str, success: bool) -> None:
+        """ステップを取り込み済みにする (登録済みの全ルールで評価した後に呼ぶ)。"""
+        self.steps[key] = {"action": action_name, "success": bool(success), "rules": self._applied.pop(key, [])}
+
+    def _reservoir(self, h: str) -> Reservoir:
+        if h not in self._reservoirs:
+            examples = self.rules[h].get("examples") or {}
+            self._reservoirs[h] = Reservoir(self.max_examples, h, examples.get("seen", 0),
+                                            examples.get("items", [])[:self.max_examples])
+        return self._reservoirs[h]
+
+    def record(self, rule: str, success: bool, example: Dict = None, step: Optional[str] = None) -> None:
+        """ルールの条件が満たされたステップ (キーが step) を 1 件数える。"""
+        self.register(rule)
+        h = rule_hash(rule)
+        if step is not None:
+            applied = self.steps[step]["rules"] if step in self.steps else self._applied.setdefault(step, [])
+            applied.append(h)
+        stats = self.rules[h]
+        stats["true_count" if success else "false_count"] += 1
+        if example is not None:
+            self._reservoir(h).add(example)
+
+    def stats(self, rule: str) -> Dict:
+        """{'true_count', 'false_count', 'probability', 'examples'} (従来の rule_stats と同じ形)。"""
+        h = rule_hash(rule)
+        stats = self.rules.get(h)
+        if stats is None:
+            return {"true_count": 0, "false_count": 0, "probability": 0.0, "examples": []}
+        total = stats["true_count"] + stats["false_count"]
+        return {
+            "true_count": stats["true_count"],
+            "false_count": stats["false_count"],
+            "probability": stats["false_count"] / total if total else 0.0,
+            "examples": list(self._reservoir(h).items),
+        }
+
+    def probabilistic_rules_text(self, rules: Iterable[str]) -> str:
+        """rules の順の probabilistic_rules.pl の内容 (数が変わったルールのブロックだけ作り直す)。"""
+        parts = [PROBABILISTIC_RULES_HEADER]
+        for rule in rules:
+            h = rule_hash(rule)
+            stats = self.rules.get(h, {"true_count": 0, "false_count": 0})
+            counts = (stats["true_count"], stats["false_count"])
+            cached = self._blocks.get(h)
+            if cached is None or cached[:2] != counts:
+                cached = counts + (render_rule_block(rule, *counts),)
+                self._blocks[h] = cached
+            parts.append(cached[2])
+        return "".join(parts)
+
+    def write_probabilistic_rules(self, rules: Iterable[str], output_file: str) -> bool:
+        """probabilistic_rules.pl を書く。内容が前回と同じなら書かずに False を返す。"""
+        text = self.probabilistic_rules_text(rules)
+        if self._written is None and os.path.exists(output_file):
+            with open(output_file, "r", encoding="utf-8") as f:
+                self._written = f.read()
+        if text == self._written:
+            return False
+        with open(output_file, "w", encoding="utf-8") as f:
+            f.write(text)
+        self._written = text
+        return True
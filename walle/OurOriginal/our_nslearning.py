@@ -12,6 +12,7 @@ from .MakeDcorDinc import *
 from .MakeCodeRule import *
 from .MakeActionRule import *
 from .MakeILASPRule import *
+from .MakeILPRule import ILPInducer
 
 from networkx.readwrite import json_graph
 
@@ -87,18 +88,16 @@ def Our_NSLearning(real_trajectory, predicted_trajectory, outdir, task_name, t_i
     prolog_dir = os.path.join(output_dir, "Prolog")
     os.makedirs(prolog_dir, exist_ok=True)
 
-    ilasp = ILASP_LLM(model="gpt-4.1")
-
-    with open(AR_imp_file_name, "r", encoding="utf-8") as f:
-        action_rules = json.load(f)
-    
-    code_rule = ilasp.generate_coderule(action_rules, prompt_dir)
+    # 遷移 (D_all) から ILP で action_failed ルールを直接学習する (ILASP_LLM の代わり)
+    # 例が前回から変わっていない行動はキャッシュの結果を使う
+    ilasp = ILPInducer(max_len=3, cache_file=os.path.join(prolog_dir, "ilp_cache.json"))
+    code_rule = ilasp.induce(D_all)
     ilasp_filename = os.path.join(prolog_dir, f"prolog_rule_{t_index}.pl")
     all_ilasp_filename = os.path.join(prolog_dir, f"all_prolog_rules.pl")
     ilasp.save(ilasp_filename, code_rule)
     ilasp.save_connect(all_ilasp_filename, code_rule)
 
-    print("生成したLASルール:")
+    print("学習したPrologルール:")
     print(code_rule)
     # ====================================================================================================
 
@@ -0,0 +1,54 @@
+% ステップ単位のバッチチェック (PrologBatchCheck.StepBatchChecker から読み込む)
+%
+% 1 ステップ分のファクトの assert, 全クエリの評価, ファクトの削除を 1 つのゴールで行い、
+% Python <-> Prolog の呼び出し回数をステップあたり 1 回にする。
+
+:- module(step_batch, [check_step/3]).
+
+% ステップのファクト述語 (名前, 引数の数)。StepBatchChecker が STEP_PREDICATES から登録する。
+:- dynamic step_predicate/2.
+
+%  check_step(+FactsText, +GoalTexts, -Results)
+%
+%  FactsText (1 行 1 ファクト) を user に assert し、GoalTexts の各ゴールが成り立つかを
+%  true / false / error(Message) のリストで返す。終了時 (例外時も) にステップのファクトを消す。
+check_step(FactsText, GoalTexts, Results) :-
+    setup_call_cleanup(
+        assert_facts(FactsText),
+        maplist(goal_result, GoalTexts, Results),
+        clear_step_facts).
+
+assert_facts(Text) :-
+    setup_call_cleanup(
+        open_string(Text, In),
+        assert_stream(In),
+        close(In)).
+
+assert_stream(In) :-
+    read_term(In, Term, []),
+    (   Term == end_of_file
+    ->  true
+    ;   assertz(user:Term),
+        assert_stream(In)
+    ).
+
+clear_step_facts :-
+    forall(step_predicate(Name, Arity),
+           ( functor(Head, Name, Arity),
+             retractall(user:Head)
+           )).
+
+% 未定義述語 (existence_error) は「条件が満たされない」とみなす
+goal_result(Text, Result) :-
+    catch(( term_string(Goal, Text),
+            (   once(user:Goal)
+            ->  Result = true
+            ;   Result = false
+            )
+          ),
+          Error,
+          error_result(Error, Result)).
+
+error_result(error(existence_error(procedure, _), _), false) :- !.
+error_result(Error, error(Message)) :-
+    term_to_atom(Error, Message).